@@ -0,0 +1,95 @@
+from flask import Blueprint, abort, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from generic_views import JsonListView, JsonDetailView
+from models import db, Cafe, City
+from replicas import read_from_replica
+
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+CAFE_FIELDS = (
+    "id",
+    "name",
+    "description",
+    "url",
+    "address",
+    "city_code",
+    "image_url",
+    "like_count",
+    "updated_at",
+)
+
+api.add_url_rule(
+    "/cafes",
+    view_func=JsonListView.as_view(
+        "cafe_list",
+        Cafe,
+        fields=CAFE_FIELDS,
+        filters={"city": "city_code"},
+        order_fields=("name", "id", "like_count"),
+        depends_on=(City,),
+    ),
+)
+
+api.add_url_rule(
+    "/cafes/<int:id>",
+    view_func=JsonDetailView.as_view(
+        "cafe_detail",
+        Cafe,
+        fields=CAFE_FIELDS,
+        depends_on=(City,),
+    ),
+)
+
+
+def _liked_cafe():
+    """Return the cafe named by the request, or abort."""
+
+    if g.user is None:
+        abort(401, "Not logged in")
+
+    if request.method == "GET":
+        cafe_id = request.args.get("cafe_id", type=int)
+    else:
+        cafe_id = (request.get_json(silent=True) or {}).get("cafe_id")
+    if not isinstance(cafe_id, int):
+        abort(400, "cafe_id is required")
+
+    return db.get_or_404(Cafe, cafe_id, description="No such cafe")
+
+
+@api.get("/likes")
+@read_from_replica
+def likes():
+    """Does the current user like ?cafe_id=? {"likes": true|false}"""
+
+    cafe = _liked_cafe()
+    return jsonify(likes=g.user.has_liked(cafe.id))
+
+
+@api.post("/like")
+def like():
+    """Like the cafe given by {"cafe_id": ...}. Idempotent."""
+
+    cafe = _liked_cafe()
+    g.user.like(cafe.id)
+    db.session.commit()
+    return jsonify(liked=cafe.id, like_count=cafe.like_count)
+
+
+@api.post("/unlike")
+def unlike():
+    """Stop liking the cafe given by {"cafe_id": ...}. Idempotent."""
+
+    cafe = _liked_cafe()
+    g.user.unlike(cafe.id)
+    db.session.commit()
+    return jsonify(unliked=cafe.id, like_count=cafe.like_count)
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    """Report errors from the API as JSON rather than HTML pages."""
+
+    return jsonify(error=error.description), error.code
@@ -1,144 +1,115 @@
 """Flask App for Flask Cafe."""
 
-from flask import Flask, render_template, redirect, request, flash, session, g
-from flask_debugtoolbar import DebugToolbarExtension
 import os
-from sqlalchemy.exc import IntegrityError
-
-from decorators import login_required
-
-from models import db, connect_db, User
-from user.forms import UserAddForm, UserLoginForm
 
+from flask import Flask, render_template
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from assets import init_assets
+from async_db import init_async_db
+from compression import init_compression
+from config import CONFIGS
+from forking import reset_after_fork
+from metrics import init_metrics
+from templating import init_templates
+from models import db, connect_db
+from replicas import init_replicas
+
+from auth.views import auth, AppGlobals, CURR_USER_KEY  # noqa: F401
+from api.views import api
+from cli import cafe_cli
 from cafe.views import cafes
+from images.views import images
 from user.views import users
 
-app = Flask(__name__)
-app.register_blueprint(cafes)
-app.register_blueprint(users)
-
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///flaskcafe"
-app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "shhhh")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
 
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
-#######################################
-# auth & auth routes
+def create_app(config=None):
+    """Create and configure a Flask Cafe app.
 
-CURR_USER_KEY = "curr_user"
-NOT_LOGGED_IN_MSG = "You are not logged in."
-
-
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    `config` is a profile name from config.CONFIGS or a config object;
+    without one, the FLASK_CONFIG environment variable picks the profile
+    (default "dev").
+    """
 
-    else:
-        g.user = None
+    if config is None:
+        config = os.environ.get("FLASK_CONFIG", "dev")
+    if isinstance(config, str):
+        config = CONFIGS[config]
 
+    app = Flask(__name__)
+    app.app_ctx_globals_class = AppGlobals
+    app.config.from_object(config)
+    if not app.config.get("SECRET_KEY"):
+        raise ValueError(
+            "No SECRET_KEY: set FLASK_SECRET_KEY, which signs sessions and "
+            "image URLs."
+        )
 
-def do_login(user):
-    """Log in user."""
+    if app.config["DEBUG_TOOLBAR"]:
+        from flask_debugtoolbar import DebugToolbarExtension
 
-    session[CURR_USER_KEY] = user.id
+        DebugToolbarExtension(app)
 
+    connect_db(app)
+    init_replicas(app)
+    dispose_engines_after_fork(app)
+    init_async_db(app)
+    init_metrics(app)
+    init_assets(app)
+    init_compression(app)
+    trust_proxies(app)
 
-def do_logout():
-    """Logout user."""
+    app.register_blueprint(auth)
+    app.register_blueprint(api)
+    app.register_blueprint(cafes)
+    app.register_blueprint(images)
+    app.register_blueprint(users)
+    app.cli.add_command(cafe_cli)
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    app.add_url_rule("/", view_func=homepage)
 
+    # last, so every blueprint's templates are found
+    init_templates(app)
 
-@app.route("/signup", methods=["GET", "POST"])
-def signup():
-    """Handle user signup.
+    return app
 
-    Create new user and add to DB. Redirect to home page.
 
-    If form not valid, present form.
+def trust_proxies(app):
+    """Take the client's address and scheme from TRUSTED_PROXIES proxies.
 
-    If there already is a user with that username: flash message
-    and re-present form.
+    Each proxy appends the address it got the request from to
+    X-Forwarded-For, so only the last TRUSTED_PROXIES entries can be
+    believed; anything before them is whatever the client sent.
     """
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-
-    form = UserAddForm()
+    hops = app.config["TRUSTED_PROXIES"]
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
 
-    if form.validate_on_submit():
-        try:
-            user = User.register(
-                username=form.username.data,
-                first_name=form.first_name.data,
-                last_name=form.last_name.data,
-                description=form.description.data,
-                password=form.password.data,
-                email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
-            )
-            db.session.commit()
 
-        except IntegrityError:
-            flash("Username already taken", "danger")
-            return render_template("auth/signup-form.html", form=form)
-
-        do_login(user)
-
-        flash("You are signed up and logged in.")
-
-        return redirect("/")
-
-    else:
-        return render_template("auth/signup-form.html", form=form)
-
-
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    """Handle user login and redirect to homepage or next url on success."""
-
-    form = UserLoginForm()
-
-    if form.validate_on_submit():
-        user = User.authenticate(form.username.data, form.password.data)
-        next_url = request.form.get("next")
-        if user:
-            do_login(user)
-            flash(f"Hello, {user.username}!", "success")
-            if next_url:
-                return redirect(next_url)
-            return redirect("/")
-        else:
-            flash("Invalid credentials.", "danger")
-
-    return render_template("auth/login-form.html", form=form)
+def dispose_engines_after_fork(app):
+    """Give each forked worker its own database connections.
 
+    With a preloading server (`gunicorn --preload`) the app is created once
+    and workers are forked from it, sharing its memory copy-on-write. Any
+    pooled connections opened before the fork would then be shared by
+    every worker too, so each child drops them (without closing them out
+    from under the parent) and opens its own.
+    """
 
-@app.post("/logout")
-@login_required
-def logout():
-    """Handle logout of user and redirect to homepage."""
+    reset_after_fork(app, _dispose_engines)
 
-    flash("You should have successfully logged out.")
-    do_logout()
 
-    return redirect("/")
+def _dispose_engines(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
 
 
 #######################################
 # homepage
 
 
-@app.get("/")
 def homepage():
     """Show homepage."""
 
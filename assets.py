@@ -0,0 +1,194 @@
+"""Fingerprinted, precompressed static assets.
+
+CSS and JavaScript live under static/vendor (and any other ASSET_DIRS).
+`flask cafe build-assets` copies each file to static/dist with a content
+hash in its name (bootstrap.min.css -> bootstrap.min.3f9a1c2b7d4e.css),
+writes .gz and .br siblings next to it, and records the mapping in
+static/dist/manifest.json.
+
+Templates link assets with `asset_url("vendor/bootstrap.min.css")`. With a
+manifest that's /assets/<hashed name>, served with the best encoding the
+client accepts and cached forever (a new build means new names); without
+one (e.g. in development before a build) it's the plain /static URL.
+
+Brotli variants need the optional `brotli` package; without it the build
+only writes gzip.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+from datetime import datetime
+
+from flask import abort, current_app, request, send_file, url_for
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+ASSET_DIRS = ("vendor",)
+COMPRESSIBLE = {".css", ".js", ".map", ".svg", ".json", ".txt"}
+MANIFEST = "manifest.json"
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# (encoding, file suffix), most preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def fingerprint(name, data):
+    """'app.css' + contents -> 'app.<12 hex digits>.css'."""
+
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return f"{stem}.{digest}{ext}"
+
+
+def _write(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build_assets(static_dir, dist_dir, asset_dirs=ASSET_DIRS):
+    """Fingerprint and precompress assets; returns the new manifest.
+
+    Files from earlier builds that the new manifest doesn't mention are
+    removed.
+    """
+
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {}
+    written = {MANIFEST}
+
+    for asset_dir in asset_dirs:
+        root = os.path.join(static_dir, asset_dir)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                source = os.path.join(dirpath, filename)
+                logical = os.path.relpath(source, static_dir).replace(os.sep, "/")
+                with open(source, "rb") as f:
+                    data = f.read()
+
+                hashed = fingerprint(filename, data)
+                manifest[logical] = hashed
+                target = os.path.join(dist_dir, hashed)
+                written.add(hashed)
+                if not os.path.exists(target):
+                    _write(target, data)
+
+                if os.path.splitext(filename)[1] not in COMPRESSIBLE:
+                    continue
+                variants = {
+                    ".gz": lambda: gzip.compress(data, compresslevel=9, mtime=0),
+                }
+                if brotli is not None:
+                    variants[".br"] = lambda: brotli.compress(data, quality=11)
+                for suffix, compress in variants.items():
+                    written.add(hashed + suffix)
+                    if not os.path.exists(target + suffix):
+                        compressed = compress()
+                        if len(compressed) < len(data):
+                            _write(target + suffix, compressed)
+
+    _write(
+        os.path.join(dist_dir, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+    )
+
+    for name in os.listdir(dist_dir):
+        if name not in written:
+            os.remove(os.path.join(dist_dir, name))
+
+    return manifest
+
+
+def dist_dir(app):
+    return app.config.get("ASSETS_DIST_DIR") or os.path.join(app.static_folder, "dist")
+
+
+def _load_manifest(app):
+    """Return (manifest, digest of its file, build time).
+
+    Before a build that's ({}, None, None).
+    """
+
+    path = os.path.join(dist_dir(app), MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return {}, None, None
+
+    # re-read after a rebuild in development; production builds before
+    # starting, so it reads the file once
+    cached = app.extensions.get("assets")
+    if cached is None or (app.debug and cached[0] != mtime):
+        with open(path, "rb") as f:
+            data = f.read()
+        cached = app.extensions["assets"] = (
+            mtime,
+            json.loads(data),
+            hashlib.sha256(data).hexdigest()[:12],
+            datetime.utcfromtimestamp(int(mtime)),
+        )
+    return cached[1:]
+
+
+def _manifest(app):
+    return _load_manifest(app)[0]
+
+
+def manifest_version(app):
+    """Return (digest, build time) of the manifest pages link assets with.
+
+    Every page links assets by their hashed names, so a page cached under
+    one build is stale under the next: conditional GETs fold this in.
+    Before a build it's (None, None).
+    """
+
+    return _load_manifest(app)[1:]
+
+
+def asset_url(filename):
+    """URL for a static asset: fingerprinted if built, plain otherwise."""
+
+    hashed = _manifest(current_app).get(filename)
+    if hashed is None:
+        return url_for("static", filename=filename)
+    return url_for("asset", filename=hashed)
+
+
+def send_asset(filename):
+    """Serve a built asset, precompressed if the client accepts it."""
+
+    path = safe_join(dist_dir(current_app), filename)
+    if path is None or filename == MANIFEST or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, name
+            break
+
+    resp = send_file(path, mimetype=mimetype)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ONE_YEAR
+    resp.cache_control.immutable = True
+    return resp
+
+
+def init_assets(app):
+    """Serve built assets at /assets and add `asset_url` to templates."""
+
+    app.add_url_rule("/assets/<path:filename>", "asset", send_asset)
+    app.add_template_global(asset_url)
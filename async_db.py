@@ -0,0 +1,169 @@
+"""An async SQLAlchemy engine for the cafe read views.
+
+With ASYNC_VIEWS set, the cafe list, detail and search pages query through
+an async engine (see AsyncListView and AsyncDetailView in
+generic_views.py): asyncpg for Postgres, aiosqlite for SQLite. The views
+themselves are still sync WSGI views: the request thread waits while its
+queries run on the loop, so a worker serves no more requests at once than
+with the sync engine. What the async engine buys is running one request's
+independent queries -- a list page's table versions and its rows -- at the
+same time, each on its own connection. That pays off on a networked
+database; on a local one it only adds a hop to the loop thread and back.
+Only the queries run as coroutines; templates are rendered on the request
+thread, since they may run sync queries (e.g. for `g.user`) that would
+block the shared loop.
+
+Flask runs each async view by default in a fresh event loop that lasts one
+request, and async connections can't outlive the loop that opened them,
+so nothing could be pooled. Instead each process runs one event loop in a
+background thread; the app's `async_to_sync` hands coroutines to it, so
+every request thread shares the engine and its connection pool.
+
+Configuration:
+
+- ASYNC_VIEWS: default False.
+- ASYNC_DATABASE_URL: default SQLALCHEMY_DATABASE_URI with the async
+  driver swapped in.
+- ASYNC_ENGINE_OPTIONS: keyword arguments for create_async_engine.
+"""
+
+import asyncio
+import contextvars
+from concurrent.futures import Future
+from functools import wraps
+from threading import Lock, Thread
+
+from flask import current_app
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from forking import reset_after_fork
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url):
+    """Return `url` with the async driver for its database."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend!r} databases")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class AsyncDatabase:
+    """An async engine plus the event loop thread it runs on."""
+
+    def __init__(self, url, engine_options=None):
+        self.url = async_url(url)
+        self.engine_options = dict(engine_options or {})
+        self._forget_loop()
+        # a forked child has neither the loop thread nor its connections
+        reset_after_fork(self, AsyncDatabase._forget_loop)
+
+    def _forget_loop(self):
+        self._lock = Lock()
+        self._loop = None
+        self._engine = None
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = create_async_engine(self.url, **self.engine_options)
+        return self._engine
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    Thread(
+                        target=loop.run_forever,
+                        name="async-db",
+                        daemon=True,
+                    ).start()
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coro):
+        """Run `coro` on the loop thread and wait for its result.
+
+        The coroutine sees the caller's context variables, so Flask's
+        request context, `g` and `current_app` work inside it.
+        """
+
+        context = contextvars.copy_context()
+        future = Future()
+
+        def finish(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            # a task copies the context it's created in
+            asyncio.ensure_future(coro).add_done_callback(finish)
+
+        self.loop.call_soon_threadsafe(context.run, start)
+        return future.result()
+
+    def session(self):
+        return AsyncSession(self.engine, expire_on_commit=False)
+
+    async def read(self, fn, *args):
+        """Await `fn(session, *args)` in a session of its own.
+
+        Each call gets its own connection, so reads can run concurrently.
+        """
+
+        async with self.session() as session:
+            return await fn(session, *args)
+
+    def close(self):
+        """Dispose of the engine and stop the loop thread."""
+
+        with self._lock:
+            loop, engine = self._loop, self._engine
+            self._loop = self._engine = None
+        if loop is None:
+            return
+        if engine is not None:
+            asyncio.run_coroutine_threadsafe(engine.dispose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def get_async_db():
+    """Return the current app's AsyncDatabase."""
+
+    return current_app.extensions["async_db"]
+
+
+def init_async_db(app):
+    """With ASYNC_VIEWS, run the app's coroutines on a shared loop."""
+
+    if not app.config.get("ASYNC_VIEWS"):
+        return
+
+    db = app.extensions["async_db"] = AsyncDatabase(
+        app.config.get("ASYNC_DATABASE_URL") or app.config["SQLALCHEMY_DATABASE_URI"],
+        app.config.get("ASYNC_ENGINE_OPTIONS"),
+    )
+
+    def async_to_sync(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return db.run(func(*args, **kwargs))
+
+        return wrapper
+
+    app.async_to_sync = async_to_sync
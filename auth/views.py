@@ -0,0 +1,192 @@
+from flask import (
+    Blueprint,
+    render_template,
+    redirect,
+    request,
+    flash,
+    session,
+    g,
+    has_request_context,
+    make_response,
+    jsonify,
+)
+from flask.ctx import _AppCtxGlobals
+from sqlalchemy.exc import IntegrityError
+
+from decorators import login_required
+from hashing import HashingBusy
+from models import db, User
+from throttle import login_throttle
+from user.forms import UserAddForm, UserLoginForm
+
+auth = Blueprint("auth", __name__)
+
+CURR_USER_KEY = "curr_user"
+NOT_LOGGED_IN_MSG = "You are not logged in."
+BUSY_MSG = "We're very busy right now; please try again in a moment."
+THROTTLED_MSG = "Too many login attempts; please wait a while and try again."
+
+
+class AppGlobals(_AppCtxGlobals):
+    """Flask's `g`, with the logged-in user loaded on first use.
+
+    Most requests (static files, anonymous pages, redirects) never look at
+    `g.user`, so it's only fetched when something reads it, and then kept
+    on `g` for the rest of the request.
+    """
+
+    def __getattr__(self, name):
+        if name != "user":
+            return super().__getattr__(name)
+
+        user_id = session.get(CURR_USER_KEY) if has_request_context() else None
+        self.user = User.query.get(user_id) if user_id is not None else None
+        return self.user
+
+
+@auth.before_app_request
+def add_user_to_g():
+    """Forget any user left on `g`; AppGlobals loads it again if needed.
+
+    An app context pushed by hand (as the tests do) outlives a single
+    request, so a user memoized by an earlier request mustn't leak into
+    this one.
+    """
+
+    if request.endpoint != "static":
+        g.pop("user", None)
+
+
+def do_login(user):
+    """Log in user."""
+
+    session[CURR_USER_KEY] = user.id
+    g.user = user
+
+
+def do_logout():
+    """Logout user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+    g.user = None
+
+
+@auth.route("/signup", methods=["GET", "POST"])
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If there already is a user with that username: flash message
+    and re-present form.
+    """
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+
+    form = UserAddForm()
+
+    if form.validate_on_submit():
+        # check before register(), which spends a bcrypt hash on the password
+        if User.username_taken(form.username.data):
+            flash("Username already taken", "danger")
+            return render_template("auth/signup-form.html", form=form)
+
+        try:
+            user = User.register(
+                username=form.username.data,
+                first_name=form.first_name.data,
+                last_name=form.last_name.data,
+                description=form.description.data,
+                password=form.password.data,
+                email=form.email.data,
+                image_url=form.image_url.data or User.image_url.default.arg,
+            )
+            db.session.commit()
+
+        except IntegrityError:
+            db.session.rollback()
+            flash("Username already taken", "danger")
+            return render_template("auth/signup-form.html", form=form)
+
+        except HashingBusy:
+            flash(BUSY_MSG, "danger")
+            return render_template("auth/signup-form.html", form=form), 503
+
+        do_login(user)
+
+        flash("You are signed up and logged in.")
+
+        return redirect("/")
+
+    else:
+        return render_template("auth/signup-form.html", form=form)
+
+
+@auth.get("/api/username-available")
+def username_available():
+    """Tell the signup form whether ?username= is free, as JSON."""
+
+    username = request.args.get("username", "").strip()
+    if not username:
+        return jsonify(error="username is required"), 400
+
+    return jsonify(
+        username=username,
+        available=not User.username_taken(username),
+    )
+
+
+@auth.route("/login", methods=["GET", "POST"])
+def login():
+    """Handle user login and redirect to homepage or next url on success."""
+
+    form = UserLoginForm()
+
+    if request.method == "POST":
+        # turn away throttled attempts before they cost a query or a hash
+        retry_after = login_throttle.check(
+            request.remote_addr, request.form.get("username", "")
+        )
+        if retry_after:
+            flash(THROTTLED_MSG, "danger")
+            resp = make_response(
+                render_template("auth/login-form.html", form=form), 429
+            )
+            resp.retry_after = int(retry_after) + 1
+            return resp
+
+    if form.validate_on_submit():
+        try:
+            user = User.authenticate(form.username.data, form.password.data)
+        except HashingBusy:
+            flash(BUSY_MSG, "danger")
+            return render_template("auth/login-form.html", form=form), 503
+
+        next_url = request.form.get("next")
+        if user:
+            # persist the hash if authenticate() upgraded its cost
+            db.session.commit()
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            if next_url:
+                return redirect(next_url)
+            return redirect("/")
+        else:
+            flash("Invalid credentials.", "danger")
+
+    return render_template("auth/login-form.html", form=form)
+
+
+@auth.post("/logout")
+@login_required
+def logout():
+    """Handle logout of user and redirect to homepage."""
+
+    flash("You should have successfully logged out.")
+    do_logout()
+
+    return redirect("/")
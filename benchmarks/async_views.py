@@ -0,0 +1,144 @@
+"""Compare the cafe read views over the sync and async engines.
+
+The views are sync either way (see async_db.py); ASYNC_VIEWS only moves
+their queries onto the async engine, where a page's reads run at once.
+
+Seeds a synthetic dataset (see generator.py) into a scratch database, then
+drives /cafes, /cafes/<id> and /cafes/search once with ASYNC_VIEWS off and
+once with it on, at each --workers count (threads sending requests through
+the WSGI test client, or over HTTP to two servers started with the same
+number of workers), and prints throughput and latency side by side.
+
+    python benchmarks/async_views.py --cafes 5000 -n 1000 --workers 1,4,16
+    python benchmarks/async_views.py --database postgresql:///flaskcafe_bench
+    python benchmarks/async_views.py --no-seed \\
+        --database postgresql:///flaskcafe_bench \\
+        --sync-url http://localhost:8000 --async-url http://localhost:8001
+
+The database given with --database is dropped and recreated unless
+--no-seed is passed, so never point it at real data. On SQLite every query
+is local and CPU-bound, so expect the async views to pay their overhead
+without much to gain; the difference shows on a networked Postgres.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from config import Config  # noqa: E402
+from endpoints import (  # noqa: E402
+    HttpClient,
+    TestClient,
+    make_requests,
+    run_endpoint,
+    seed,
+)
+from models import db, Cafe  # noqa: E402
+
+ENDPOINTS = ("list", "detail", "search")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database", help="scratch database URL (default: a temporary SQLite file)"
+    )
+    parser.add_argument("--sync-url", help="a running server, sync views")
+    parser.add_argument("--async-url", help="a running server, async views")
+    parser.add_argument("--cities", type=int, default=50)
+    parser.add_argument("--cafes", type=int, default=1000)
+    parser.add_argument(
+        "--no-seed", action="store_true", help="reuse the data already in --database"
+    )
+    parser.add_argument(
+        "-n", type=int, default=500, help="requests per endpoint, mode and worker count"
+    )
+    parser.add_argument(
+        "--workers", default="1,4,16", help="comma-separated worker (thread) counts"
+    )
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument(
+        "--endpoints",
+        default=",".join(ENDPOINTS),
+        help=f"comma-separated subset of {', '.join(ENDPOINTS)}",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    database = args.database or "sqlite:///" + os.path.join(
+        tempfile.mkdtemp(), "bench.db"
+    )
+
+    apps = {}
+    for mode in ("sync", "async"):
+
+        class BenchConfig(Config):
+            SQLALCHEMY_DATABASE_URI = database
+            ASYNC_VIEWS = mode == "async"
+
+        apps[mode] = create_app(BenchConfig)
+
+    with apps["sync"].app_context():
+        if not args.no_seed:
+            seed(args.cities, args.cafes, 0, rounds=4)
+        cafe_ids = db.session.scalars(db.select(Cafe.id)).all()
+
+    urls = {"sync": args.sync_url, "async": args.async_url}
+    requests = make_requests(cafe_ids, [], [], [])
+
+    print(
+        f"{'endpoint':<8} {'workers':>7}   "
+        f"{'sync rps':>9} {'p50':>7} {'p95':>7}   "
+        f"{'async rps':>9} {'p50':>7} {'p95':>7}"
+    )
+    results = []
+    for name in args.endpoints.split(","):
+        for workers in map(int, args.workers.split(",")):
+            row = dict(endpoint=name, workers=workers)
+            for mode, app in apps.items():
+                if urls[mode]:
+
+                    def make_client(url=urls[mode]):
+                        return HttpClient(url)
+
+                else:
+
+                    def make_client(app=app):
+                        return TestClient(app)
+
+                row[mode] = run_endpoint(
+                    make_client, requests[name], args.n, workers, args.warmup
+                )
+            results.append(row)
+
+            sync, async_ = row["sync"], row["async"]
+            print(
+                f"{name:<8} {workers:>7}   "
+                f"{sync['rps']:>9.1f} {sync['p50_ms']:>7.2f} "
+                f"{sync['p95_ms']:>7.2f}   "
+                f"{async_['rps']:>9.1f} {async_['p50_ms']:>7.2f} "
+                f"{async_['p95_ms']:>7.2f}"
+            )
+            if sync["errors"] or async_["errors"]:
+                print(f"  errors: sync {sync['errors']}, " f"async {async_['errors']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                dict(
+                    database=database.split(":")[0],
+                    dataset=dict(cities=args.cities, cafes=args.cafes),
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
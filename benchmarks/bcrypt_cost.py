@@ -0,0 +1,96 @@
+"""Measure login throughput for each bcrypt cost.
+
+For every cost in the range this times single-threaded checks (logins/sec
+on one core) and then the same checks pushed through a PasswordHasher pool
+with one worker per CPU, which is what the app does under load.
+
+    python benchmarks/bcrypt_cost.py --min-cost 8 --max-cost 13
+    python benchmarks/bcrypt_cost.py --executor process --json costs.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import PasswordHasher, check_password, hash_password  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+def time_checks(check, hashed, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        check(hashed, PASSWORD)
+    return time.perf_counter() - start
+
+
+def bench_cost(app, cost, n, executor, workers):
+    hashed = hash_password(PASSWORD, cost)
+
+    single = time_checks(check_password, hashed, n)
+
+    hasher = PasswordHasher(executor=executor, workers=workers, max_queue=n * workers)
+
+    def check_in_app(_):
+        with app.app_context():
+            return hasher.check(hashed, PASSWORD)
+
+    with app.app_context():
+        hasher.check(hashed, PASSWORD)  # start the pool outside the timing
+
+    with ThreadPoolExecutor(max_workers=workers * 2) as clients:
+        start = time.perf_counter()
+        list(clients.map(check_in_app, range(n * workers)))
+        pooled = time.perf_counter() - start
+
+    hasher.shutdown()
+
+    return dict(
+        cost=cost,
+        ms_per_check=1000 * single / n,
+        logins_per_sec_per_core=n / single,
+        pool_logins_per_sec=n * workers / pooled,
+        pool_workers=workers,
+        executor=executor,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-cost", type=int, default=4)
+    parser.add_argument("--max-cost", type=int, default=12)
+    parser.add_argument("-n", type=int, default=10, help="checks per cost")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+
+    print(
+        f"{'cost':>4} {'ms/check':>10} {'logins/s/core':>14} " f"{'pool logins/s':>14}"
+    )
+    results = []
+    for cost in range(args.min_cost, args.max_cost + 1):
+        result = bench_cost(app, cost, args.n, args.executor, args.workers)
+        results.append(result)
+        print(
+            f"{cost:>4} {result['ms_per_check']:>10.1f} "
+            f"{result['logins_per_sec_per_core']:>14.1f} "
+            f"{result['pool_logins_per_sec']:>14.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""Measure latency and throughput of the main Flask Cafe endpoints.
+
+Seeds a synthetic dataset (see generator.py) into a scratch database,
+then drives /cafes, /cafes/<id>, /cafes/search, /cafes/nearby, /login
+and /cafes/add through the WSGI test client (or over HTTP against a server
+already running on that database) and reports p50/p95/p99 latency,
+requests per second and SQL queries per request (read from the
+Server-Timing header).
+
+    python benchmarks/endpoints.py --cafes 5000 -n 500
+    python benchmarks/endpoints.py --database postgresql:///flaskcafe_bench \\
+        --json after.json --compare before.json
+
+The database given with --database is dropped and recreated unless
+--no-seed is passed, so never point it at real data. --compare exits with
+status 1 if any endpoint's p95 latency or throughput regressed by more than
+--threshold (default 10%).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from config import Config  # noqa: E402
+from generator import generate, CAFE_PARTS, PASSWORD  # noqa: E402
+from models import db, Cafe, City, User  # noqa: E402
+
+ENDPOINTS = ("list", "detail", "search", "nearby", "login", "add")
+SEARCH_WORDS = [word for part in CAFE_PARTS[:2] for word in part]
+TIMING_RE = re.compile(r'desc="(\d+) queries"')
+
+
+#######################################
+# data
+
+
+def seed(cities, cafes, users, rounds):
+    """Recreate the tables and fill them with generated rows."""
+
+    db.drop_all()
+    db.create_all()
+    generate(db.engine, cities=cities, cafes=cafes, users=users, rounds=rounds)
+
+
+#######################################
+# clients
+
+
+class TestClient:
+    """Sends requests through the app's WSGI test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        resp = self.client.open(path, method=method, data=data)
+        return resp.status_code, resp.headers.get("Server-Timing", "")
+
+
+class HttpClient:
+    """Sends requests to a running server."""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(self.NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, resp.headers.get("Server-Timing", "")
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.headers.get("Server-Timing", "")
+
+
+def make_requests(cafe_ids, city_codes, usernames, locations):
+    """Return {endpoint: fn() -> (method, path, data, expected statuses)}."""
+
+    added = itertools.count()
+
+    def add():
+        n = next(added)
+        return (
+            "POST",
+            "/cafes/add",
+            dict(
+                name=f"Bench Cafe {n} {time.time_ns()}",
+                description="Added by the benchmark.",
+                url="https://example.com",
+                address=f"{n} Bench St",
+                city_code=city_codes[n % len(city_codes)],
+            ),
+            (302,),
+        )
+
+    return {
+        "list": lambda: ("GET", "/cafes", None, (200,)),
+        "detail": lambda: ("GET", f"/cafes/{random.choice(cafe_ids)}", None, (200,)),
+        "search": lambda: (
+            "GET",
+            f"/cafes/search?q={random.choice(SEARCH_WORDS)}",
+            None,
+            (200,),
+        ),
+        "nearby": lambda: (
+            "GET",
+            "/cafes/nearby?lat={}&lng={}&radius=2".format(*random.choice(locations)),
+            None,
+            (200,),
+        ),
+        "login": lambda: (
+            "POST",
+            "/login",
+            dict(
+                username=random.choice(usernames),
+                password=PASSWORD,
+            ),
+            (302,),
+        ),
+        "add": add,
+    }
+
+
+#######################################
+# measuring
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def run_endpoint(make_client, make_request, n, concurrency, warmup):
+    def worker(count):
+        client = make_client()
+        samples = []
+        for _ in range(count):
+            method, path, data, expected = make_request()
+            start = time.perf_counter()
+            status, timing = client.request(method, path, data)
+            elapsed = time.perf_counter() - start
+            match = TIMING_RE.search(timing)
+            samples.append(
+                (
+                    elapsed,
+                    int(match.group(1)) if match else None,
+                    status in expected,
+                )
+            )
+        return samples
+
+    worker(warmup)
+
+    per_worker = [n // concurrency + (i < n % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [s for batch in pool.map(worker, per_worker) for s in batch]
+    wall = time.perf_counter() - start
+
+    latencies = sorted(elapsed for elapsed, _, _ in samples)
+    queries = [q for _, q, _ in samples if q is not None]
+    return dict(
+        requests=len(samples),
+        errors=sum(not ok for _, _, ok in samples),
+        rps=len(samples) / wall,
+        p50_ms=1000 * percentile(latencies, 50),
+        p95_ms=1000 * percentile(latencies, 95),
+        p99_ms=1000 * percentile(latencies, 99),
+        queries_per_request=sum(queries) / len(queries) if queries else None,
+    )
+
+
+def compare(results, baseline, threshold):
+    """Print changes against `baseline`; return True if anything regressed."""
+
+    regressed = False
+    print(f"\n{'endpoint':<8} {'p95 change':>11} {'rps change':>11}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        p95 = result["p95_ms"] / before["p95_ms"] - 1
+        rps = result["rps"] / before["rps"] - 1
+        flag = ""
+        if p95 > threshold or rps < -threshold:
+            regressed = True
+            flag = "  REGRESSED"
+        print(f"{name:<8} {p95:>+10.1%} {rps:>+10.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database", help="scratch database URL (default: a temporary SQLite file)"
+    )
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--cities", type=int, default=50)
+    parser.add_argument("--cafes", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument(
+        "--no-seed", action="store_true", help="reuse the data already in --database"
+    )
+    parser.add_argument("-n", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument(
+        "--endpoints",
+        default=",".join(ENDPOINTS),
+        help=f"comma-separated subset of {', '.join(ENDPOINTS)}",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    database = args.database or "sqlite:///" + os.path.join(
+        tempfile.mkdtemp(), "bench.db"
+    )
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database
+        WTF_CSRF_ENABLED = False
+        LOGIN_THROTTLE_ENABLED = False
+        BCRYPT_LOG_ROUNDS = args.bcrypt_rounds
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        if not args.no_seed:
+            seed(args.cities, args.cafes, args.users, args.bcrypt_rounds)
+        cafe_ids = db.session.scalars(db.select(Cafe.id)).all()
+        city_codes = db.session.scalars(db.select(City.code)).all()
+        usernames = db.session.scalars(db.select(User.username)).all()
+        locations = db.session.execute(
+            db.select(Cafe.latitude, Cafe.longitude)
+            .where(Cafe.latitude.is_not(None))
+            .limit(1000)
+        ).all()
+
+    if args.url:
+
+        def make_client():
+            return HttpClient(args.url)
+
+    else:
+
+        def make_client():
+            return TestClient(app)
+
+    requests = make_requests(cafe_ids, city_codes, usernames, locations)
+    print(
+        f"{'endpoint':<8} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'queries':>8} {'errors':>7}"
+    )
+    results = {}
+    for name in args.endpoints.split(","):
+        result = run_endpoint(
+            make_client, requests[name], args.n, args.concurrency, args.warmup
+        )
+        results[name] = result
+        queries = result["queries_per_request"]
+        print(
+            f"{name:<8} {result['rps']:>8.1f} {result['p50_ms']:>8.2f} "
+            f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+            f"{'-' if queries is None else f'{queries:.1f}':>8} "
+            f"{result['errors']:>7}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                dict(
+                    database=app.config["SQLALCHEMY_DATABASE_URI"].split(":")[0],
+                    dataset=dict(
+                        cities=args.cities, cafes=args.cafes, users=args.users
+                    ),
+                    concurrency=args.concurrency,
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
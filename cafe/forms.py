@@ -27,6 +27,10 @@ class ModelForm(BaseModelForm):
         return db.session
 
 
+class LikeForm(FlaskForm):
+    """The like and unlike buttons: nothing but the CSRF token."""
+
+
 class AddCafeForm(ModelForm):
     """Form for adding or editing cafes."""
 
@@ -57,3 +61,5 @@ class AddCafeForm(ModelForm):
 
     class Meta:
         model = Cafe
+        # maintained by the app, never edited through the form
+        exclude = ["like_count", "latitude", "longitude", "geo_cell"]
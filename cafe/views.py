@@ -1,20 +1,218 @@
-from flask import Blueprint, render_template, flash, redirect
-from generic_views import ListView, DetailView
-from models import Cafe, City, db
-from cafe.forms import AddCafeForm
+from flask import (
+    Blueprint,
+    abort,
+    g,
+    render_template,
+    flash,
+    redirect,
+    request,
+    jsonify,
+    url_for,
+    current_app,
+)
+from async_db import get_async_db
+from decorators import login_required
+from geo import get_geocoder
+from generic_views import ListView, DetailView, AsyncListView, AsyncDetailView
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy.exc import IntegrityError
+
+from models import Cafe, City, Like, User, db, city_cache
+from cafe.forms import AddCafeForm, LikeForm
 
 
 cafes = Blueprint("cafes", __name__)
+# for forms rendered without a form object, e.g. the like buttons
+cafes.add_app_template_global(generate_csrf, "csrf_token")
 
-cafes.add_url_rule(
-    "/cafes",
-    view_func=ListView.as_view("cafe_list", Cafe),
-)
 
-cafes.add_url_rule(
-    "/cafes/<int:id>",
-    view_func=DetailView.as_view("cafe_detail", Cafe),
-)
+@cafes.record
+def register_read_views(state):
+    """Route the list, detail and search pages; with ASYNC_VIEWS they
+    query through the async engine."""
+
+    config = state.app.config
+    list_options = dict(
+        order_fields=("name", "id", "like_count"),
+        depends_on=(City,),
+        # the navbar shows the logged-in user's name
+        user_depends_on=(User,),
+    )
+    if config.get("ASYNC_VIEWS"):
+        list_view, detail_view, search = (
+            AsyncListView,
+            AsyncDetailView,
+            cafe_search_async,
+        )
+    else:
+        list_view, detail_view, search = ListView, DetailView, cafe_search
+        list_options["stream"] = config.get("STREAM_LIST_PAGES", False)
+
+    state.add_url_rule(
+        "/cafes",
+        view_func=list_view.as_view("cafe_list", Cafe, **list_options),
+    )
+    state.add_url_rule(
+        "/cafes/<int:id>",
+        view_func=detail_view.as_view(
+            "cafe_detail",
+            Cafe,
+            depends_on=(City,),
+            # the navbar, and whether the user likes the cafe
+            user_depends_on=(User, Like),
+        ),
+    )
+    state.add_url_rule("/cafes/search", "cafe_search", search, methods=["GET"])
+
+
+SEARCH_PER_PAGE = 20
+NEARBY_LIMIT = 50
+DEFAULT_RADIUS_KM = 2
+MAX_RADIUS_KM = 50
+DUPLICATE_MSG = "There's already a cafe with that name at that address."
+
+
+def cafe_search():
+    """Search cafes; returns JSON if the client prefers it or ?format=json."""
+
+    q, page = search_args()
+    results = Cafe.search(
+        q,
+        limit=SEARCH_PER_PAGE + 1,
+        offset=(page - 1) * SEARCH_PER_PAGE,
+    )
+    return search_response(q, page, results)
+
+
+def cafe_search_async():
+    """cafe_search, querying through the async engine.
+
+    Only the search runs on the engine's loop; the results are rendered
+    on the request thread, as in the async list and detail views.
+    """
+
+    q, page = search_args()
+
+    async def run_search(session):
+        return await session.run_sync(
+            lambda session: Cafe.search(
+                q,
+                limit=SEARCH_PER_PAGE + 1,
+                offset=(page - 1) * SEARCH_PER_PAGE,
+                session=session,
+            )
+        )
+
+    results = current_app.ensure_sync(get_async_db().read)(run_search)
+    return search_response(q, page, results)
+
+
+def search_args():
+    q = request.args.get("q", "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
+    return q, page
+
+
+def search_response(q, page, results):
+    """Render a page of (cafe, rank) results, fetched one past the page."""
+
+    has_next = len(results) > SEARCH_PER_PAGE
+    results = results[:SEARCH_PER_PAGE]
+
+    next_url = has_next and url_for(".cafe_search", q=q, page=page + 1)
+    prev_url = page > 1 and url_for(".cafe_search", q=q, page=page - 1)
+
+    if wants_json():
+        return jsonify(
+            query=q,
+            page=page,
+            results=[
+                dict(
+                    id=cafe.id,
+                    name=cafe.name,
+                    address=cafe.address,
+                    city=cafe.get_city_state(),
+                    url=url_for(".cafe_detail", id=cafe.id),
+                    rank=rank,
+                )
+                for cafe, rank in results
+            ],
+            next=next_url or None,
+            prev=prev_url or None,
+        )
+
+    return render_template(
+        "cafe/search.html",
+        q=q,
+        results=results,
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
+def wants_json():
+    return request.args.get("format") == "json" or (
+        request.accept_mimetypes.best_match(["text/html", "application/json"])
+        == "application/json"
+    )
+
+
+@cafes.get("/cafes/nearby")
+def cafe_nearby():
+    """Cafes within ?radius= km (default 2) of ?lat= and ?lng=.
+
+    Returns JSON if the client prefers it or ?format=json.
+    """
+
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    radius = request.args.get("radius", DEFAULT_RADIUS_KM, type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        abort(400, "lat and lng are required.")
+    if not 0 < radius <= MAX_RADIUS_KM:
+        abort(400, f"radius must be more than 0 and at most {MAX_RADIUS_KM} km.")
+
+    results = Cafe.nearby(lat, lng, radius, limit=NEARBY_LIMIT)
+
+    if wants_json():
+        return jsonify(
+            lat=lat,
+            lng=lng,
+            radius=radius,
+            results=[
+                dict(
+                    id=cafe.id,
+                    name=cafe.name,
+                    address=cafe.address,
+                    city=cafe.get_city_state(),
+                    url=url_for(".cafe_detail", id=cafe.id),
+                    latitude=cafe.latitude,
+                    longitude=cafe.longitude,
+                    distance_km=round(distance, 3),
+                )
+                for cafe, distance in results
+            ],
+        )
+
+    return render_template(
+        "cafe/nearby.html",
+        lat=lat,
+        lng=lng,
+        radius=radius,
+        results=results,
+    )
+
+
+def locate(cafe):
+    """Geocode `cafe`'s address if a geocoder is configured.
+
+    A failed lookup leaves the cafe unlocated (and out of nearby results)
+    rather than failing the save.
+    """
+
+    geocoder = get_geocoder()
+    if geocoder is None or not cafe.geocode(geocoder):
+        cafe.latitude = cafe.longitude = None
 
 
 @cafes.route("/cafes/add", methods=["POST", "GET"])
@@ -22,8 +220,7 @@ def cafe_add():
     """Show and handle form for adding a cafe."""
 
     form = AddCafeForm()
-    avail_cities = [(city.code, city.name) for city in City.query.all()]
-    form.city_code.choices = avail_cities
+    form.city_code.choices = city_cache.choices()
 
     if form.validate_on_submit():
         name = form.name.data
@@ -41,8 +238,14 @@ def cafe_add():
             city_code=city_code,
             image_url=image_url,
         )
+        locate(new_cafe)
         db.session.add(new_cafe)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(DUPLICATE_MSG, "danger")
+            return render_template("cafe/add-form.html", form=form)
 
         flash(f"{new_cafe.name} added.", "success")
 
@@ -58,13 +261,20 @@ def cafe_edit(cafe_id):
     cafe = Cafe.query.get_or_404(cafe_id)
 
     form = AddCafeForm(obj=cafe)
-    avail_cities = [(city.code, city.name) for city in City.query.all()]
-    form.city_code.choices = avail_cities
+    form.city_code.choices = city_cache.choices()
     form.city_code.default = cafe.city_code
 
     if form.validate_on_submit():
+        old_address = (cafe.address, cafe.city_code)
         form.populate_obj(cafe)
-        db.session.commit()
+        if (cafe.address, cafe.city_code) != old_address:
+            locate(cafe)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(DUPLICATE_MSG, "danger")
+            return render_template("cafe/edit-form.html", form=form)
 
         flash(f"{cafe.name} edited.", "success")
 
@@ -74,3 +284,37 @@ def cafe_edit(cafe_id):
             "cafe/edit-form.html",
             form=form,
         )
+
+
+#######################################
+# likes
+
+
+@cafes.post("/cafes/<int:cafe_id>/like")
+@login_required
+def cafe_like(cafe_id):
+    """Like a cafe. Liking it again changes nothing."""
+
+    if not LikeForm().validate_on_submit():
+        abort(400)
+
+    cafe = Cafe.query.get_or_404(cafe_id)
+    g.user.like(cafe.id)
+    db.session.commit()
+
+    return redirect(url_for("cafes.cafe_detail", id=cafe.id))
+
+
+@cafes.post("/cafes/<int:cafe_id>/unlike")
+@login_required
+def cafe_unlike(cafe_id):
+    """Stop liking a cafe. Un-liking it again changes nothing."""
+
+    if not LikeForm().validate_on_submit():
+        abort(400)
+
+    cafe = Cafe.query.get_or_404(cafe_id)
+    g.user.unlike(cafe.id)
+    db.session.commit()
+
+    return redirect(url_for("cafes.cafe_detail", id=cafe.id))
@@ -0,0 +1,193 @@
+"""Command-line tools for Flask Cafe: `flask cafe ...`."""
+
+import os
+import sys
+
+import click
+from flask.cli import AppGroup
+
+cafe_cli = AppGroup("cafe", help="Flask Cafe maintenance commands.")
+
+
+@cafe_cli.command("import")
+@click.argument("kind", type=click.Choice(["cities", "cafes"]))
+@click.argument("path", type=click.Path(allow_dash=True))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "jsonl"]),
+    help="Input format; guessed from the file extension if not given.",
+)
+@click.option(
+    "--chunk-size",
+    default=5000,
+    show_default=True,
+    help="Rows per INSERT/COPY and per transaction.",
+)
+def import_command(kind, path, fmt, chunk_size):
+    """Bulk load (upsert) cities or cafes from a CSV or JSONL file.
+
+    Use - as PATH to read from stdin. Cities are keyed on code and cafes on
+    (name, address, city_code), so re-running an import updates rows in
+    place. Rows that fail validation are reported and skipped.
+    """
+
+    from importer import import_file
+
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(ext)
+        if fmt is None:
+            raise click.UsageError("Can't tell the format; pass --format.")
+
+    if path == "-":
+        result = import_file(
+            kind, click.get_text_stream("stdin"), fmt, chunk_size=chunk_size
+        )
+    else:
+        with open(path, encoding="utf-8", newline="") as stream:
+            result = import_file(kind, stream, fmt, chunk_size=chunk_size)
+
+    for line_num, message in result.errors:
+        click.echo(f"{path}:{line_num}: {message}", err=True)
+
+    click.echo(
+        f"Imported {result.imported} {kind}; " f"{len(result.errors)} rows skipped."
+    )
+    if result.errors:
+        sys.exit(1)
+
+
+@cafe_cli.command("generate")
+@click.option("--cities", default=0, show_default=True)
+@click.option("--cafes", default=0, show_default=True)
+@click.option("--users", default=0, show_default=True)
+@click.option(
+    "--seed",
+    default=0,
+    show_default=True,
+    help="Random seed; the same seed generates the same rows.",
+)
+@click.option(
+    "--password",
+    default="password",
+    show_default=True,
+    help="Password shared by every generated user.",
+)
+@click.option(
+    "--chunk-size",
+    default=5000,
+    show_default=True,
+    help="Rows per INSERT/COPY and per transaction.",
+)
+def generate_command(cities, cafes, users, seed, password, chunk_size):
+    """Fill the database with synthetic cities, cafes and users.
+
+    Without --cities, cafes go into the cities already in the database.
+    """
+
+    from flask import current_app
+    from generator import generate
+    from hashing import DEFAULT_ROUNDS
+    from models import db
+
+    try:
+        result = generate(
+            db.engine,
+            cities=cities,
+            cafes=cafes,
+            users=users,
+            seed=seed,
+            password=password,
+            chunk_size=chunk_size,
+            rounds=current_app.config.get("BCRYPT_LOG_ROUNDS", DEFAULT_ROUNDS),
+        )
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+
+    click.echo(
+        f"Generated {result.cities} cities, {result.cafes} cafes "
+        f"and {result.users} users."
+    )
+
+
+@cafe_cli.command("recount-likes")
+def recount_likes_command():
+    """Recompute every cafe's like_count from the likes table."""
+
+    from models import db, recount_likes
+
+    with db.engine.begin() as conn:
+        recount_likes(conn)
+
+    click.echo("Recounted likes.")
+
+
+@cafe_cli.command("geocode")
+@click.option(
+    "--all",
+    "everything",
+    is_flag=True,
+    help="Re-geocode cafes that already have a location.",
+)
+@click.option(
+    "--batch-size", default=100, show_default=True, help="Cafes per transaction."
+)
+def geocode_command(everything, batch_size):
+    """Fill in cafe locations with the configured GEOCODER."""
+
+    from geo import get_geocoder
+    from models import db, Cafe
+
+    geocoder = get_geocoder()
+    if geocoder is None:
+        raise click.UsageError("No GEOCODER is configured.")
+
+    query = db.select(Cafe.id).order_by(Cafe.id)
+    if not everything:
+        query = query.where(Cafe.latitude.is_(None))
+    ids = db.session.scalars(query).all()
+
+    located = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start : start + batch_size]
+        for cafe in Cafe.query.filter(Cafe.id.in_(batch)):
+            located += cafe.geocode(geocoder)
+        db.session.commit()
+
+    click.echo(f"Located {located} of {len(ids)} cafes.")
+
+
+@cafe_cli.command("build-assets")
+def build_assets_command():
+    """Fingerprint and precompress static assets into static/dist."""
+
+    from flask import current_app
+    from assets import build_assets, dist_dir
+
+    manifest = build_assets(current_app.static_folder, dist_dir(current_app))
+    for logical, hashed in sorted(manifest.items()):
+        click.echo(f"{logical} -> {hashed}")
+
+
+@cafe_cli.command("compile-templates")
+def compile_templates_command():
+    """Compile every template into the bytecode cache.
+
+    Run it at deploy time so workers start with compiled templates; it also
+    fails (exit status 1) on any template with a syntax error.
+    """
+
+    from flask import current_app
+    from templating import compile_templates
+
+    if not current_app.config.get("TEMPLATE_CACHE_DIR"):
+        click.echo("TEMPLATE_CACHE_DIR isn't set; checking templates only.", err=True)
+
+    loaded, errors = compile_templates(current_app)
+    for name, exc in errors:
+        click.echo(f"{name}: {exc}", err=True)
+
+    click.echo(f"Compiled {loaded} templates; {len(errors)} failed.")
+    if errors:
+        sys.exit(1)
@@ -0,0 +1,316 @@
+"""gzip and brotli compression of the app's responses.
+
+`init_compression(app)` wraps the WSGI app in CompressionMiddleware, which
+compresses text responses (HTML, JSON, CSS, JavaScript and the like) for
+clients that accept it, preferring brotli when they accept both. Levels
+are tuned for compressing on every request rather than once ahead of
+time like the built assets.
+
+Responses that are already encoded (e.g. /assets, served precompressed),
+aren't a compressible type, are smaller than COMPRESSION_MIN_SIZE, or say
+`Cache-Control: no-transform` go out as they are. Streamed responses are
+compressed chunk by chunk, each chunk flushed as it comes, so they still
+reach the client as they're produced.
+
+Configuration:
+
+- COMPRESSION_ENABLED: default True.
+- COMPRESSION_MIN_SIZE: smallest body compressed, in bytes; default 500.
+- COMPRESSION_GZIP_LEVEL: 1-9, default 6.
+- COMPRESSION_BROTLI_QUALITY: 0-11, default 4.
+
+Brotli needs the optional `brotli` package; without it only gzip is used.
+"""
+
+import zlib
+from collections import Counter
+from threading import Lock
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_cache_control_header
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESSIBLE = {
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+    "text/xml",
+}
+
+# bodies up to this size are compressed in one go and get a Content-Length
+MAX_BUFFERED = 1024 * 1024
+
+
+class CompressionStats:
+    """Running totals of what compression saved, by encoding."""
+
+    def __init__(self):
+        self.responses = Counter()
+        self.bytes_saved = Counter()
+        self._lock = Lock()
+
+    def record(self, encoding, size, compressed_size):
+        with self._lock:
+            self.responses[encoding] += 1
+            self.bytes_saved[encoding] += size - compressed_size
+
+
+stats = CompressionStats()
+
+
+class _Gzip:
+    name = "gzip"
+
+    def __init__(self, level):
+        # wbits=31: a gzip header and trailer, not a bare zlib stream
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _Brotli:
+    name = "br"
+
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing responses with gzip or brotli."""
+
+    def __init__(
+        self,
+        app,
+        min_size=500,
+        gzip_level=6,
+        brotli_quality=4,
+        mimetypes=COMPRESSIBLE,
+    ):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.mimetypes = frozenset(mimetypes)
+
+    def encoder_for(self, accept_encoding):
+        """Return a compressor for the best encoding accepted, or None."""
+
+        accept = parse_accept_header(accept_encoding)
+        options = [(accept["gzip"], 0, "gzip")]
+        if brotli is not None:
+            options.append((accept["br"], 1, "br"))
+        quality, _, name = max(options)
+        if not quality:
+            return None
+        if name == "br":
+            return _Brotli(self.brotli_quality)
+        return _Gzip(self.gzip_level)
+
+    def is_compressible(self, status, headers):
+        mimetype = headers.get("Content-Type", "").split(";")[0].strip().lower()
+        return (
+            mimetype in self.mimetypes
+            and status.startswith("200")
+            and "Content-Encoding" not in headers
+            and not parse_cache_control_header(
+                headers.get("Cache-Control")
+            ).no_transform
+        )
+
+    def __call__(self, environ, start_response):
+        response = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, Headers(headers), exc_info]
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = response
+        if not self.is_compressible(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return _chain(written, app_iter)
+
+        headers.add("Vary", "Accept-Encoding")
+        encoder = None
+        if environ.get("REQUEST_METHOD") != "HEAD":
+            encoder = self.encoder_for(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        length = headers.get("Content-Length", type=int)
+        if encoder is None or (length is not None and length < self.min_size):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return _chain(written, app_iter)
+
+        chunks = _chain(written, app_iter)
+        if length is not None and length <= MAX_BUFFERED:
+            return self._compress_body(
+                status, headers, exc_info, start_response, encoder, chunks
+            )
+        return self._compress_stream(
+            status,
+            headers,
+            exc_info,
+            start_response,
+            encoder,
+            chunks,
+            flush_chunks=length is None,
+        )
+
+    def _compress_body(
+        self,
+        status,
+        headers,
+        exc_info,
+        start_response,
+        encoder,
+        chunks,
+    ):
+        try:
+            body = b"".join(chunks)
+        finally:
+            _close(chunks)
+        data = encoder.compress(body) + encoder.finish()
+        if len(data) >= len(body):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+
+        _set_encoding(headers, encoder.name)
+        headers["Content-Length"] = str(len(data))
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        stats.record(encoder.name, len(body), len(data))
+        return [data]
+
+    def _compress_stream(
+        self,
+        status,
+        headers,
+        exc_info,
+        start_response,
+        encoder,
+        chunks,
+        flush_chunks,
+    ):
+        # read ahead far enough to tell whether the body is big enough
+        it = iter(chunks)
+        head = []
+        size = 0
+        try:
+            for chunk in it:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+        except BaseException:
+            _close(chunks)
+            raise
+
+        if size < self.min_size:
+            _close(chunks)
+            headers["Content-Length"] = str(size)
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return head
+
+        _set_encoding(headers, encoder.name)
+        headers.pop("Content-Length", None)
+        start_response(status, headers.to_wsgi_list(), exc_info)
+
+        def generate():
+            compressed_size = 0
+            total = size
+            try:
+                data = encoder.compress(b"".join(head))
+                if flush_chunks:
+                    data += encoder.flush()
+                compressed_size += len(data)
+                yield data
+
+                for chunk in it:
+                    total += len(chunk)
+                    data = encoder.compress(chunk)
+                    if flush_chunks:
+                        data += encoder.flush()
+                    if data:
+                        compressed_size += len(data)
+                        yield data
+
+                data = encoder.finish()
+                compressed_size += len(data)
+                yield data
+                stats.record(encoder.name, total, compressed_size)
+            finally:
+                _close(chunks)
+
+        return generate()
+
+
+def _chain(written, app_iter):
+    """The app's body, after anything it sent through `write()`."""
+
+    if not written:
+        return app_iter
+    return _ClosingChain(written, app_iter)
+
+
+class _ClosingChain:
+    def __init__(self, written, app_iter):
+        self.written = written
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        yield from self.written
+        yield from self.app_iter
+
+    def close(self):
+        _close(self.app_iter)
+
+
+def _close(app_iter):
+    close = getattr(app_iter, "close", None)
+    if close is not None:
+        close()
+
+
+def _set_encoding(headers, encoding):
+    headers["Content-Encoding"] = encoding
+    # the compressed bytes are a different representation of the resource
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        headers["ETag"] = "W/" + etag
+
+
+def init_compression(app):
+    """Compress `app`'s responses, unless COMPRESSION_ENABLED is False."""
+
+    if not app.config.get("COMPRESSION_ENABLED", True):
+        return
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config.get("COMPRESSION_MIN_SIZE", 500),
+        gzip_level=app.config.get("COMPRESSION_GZIP_LEVEL", 6),
+        brotli_quality=app.config.get("COMPRESSION_BROTLI_QUALITY", 4),
+    )
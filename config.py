@@ -0,0 +1,129 @@
+"""Configuration profiles for Flask Cafe.
+
+Pick one with `create_app("dev" | "test" | "prod")`, or with the
+FLASK_CONFIG environment variable when the factory is called without one.
+"""
+
+import os
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance")
+REPLICA_URLS = [
+    url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url
+]
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "postgresql:///flaskcafe")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "shhhh")
+    # pages holding a CSRF token (e.g. the like buttons) can be revalidated
+    # with a 304 for as long as nothing on them changes, so tokens last as
+    # long as the session they're tied to
+    WTF_CSRF_TIME_LIMIT = None
+
+    # read replicas for the generic views and API; see replicas.py
+    SQLALCHEMY_BINDS = {f"replica{i}": url for i, url in enumerate(REPLICA_URLS)}
+    REPLICA_BINDS = tuple(SQLALCHEMY_BINDS)
+    REPLICA_EJECT_SECONDS = 30
+    REPLICA_STICKY_SECONDS = 10
+
+    # identifies the deployed code and templates (e.g. the release's
+    # commit); part of every page's ETag, so a deploy invalidates them
+    BUILD_ID = os.environ.get("FLASK_BUILD_ID")
+
+    # how many reverse proxies in front of the app to trust for the
+    # client's address (X-Forwarded-For) and scheme; 0 trusts none, which
+    # is right when clients connect to the app directly
+    TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+
+    DEBUG_TOOLBAR = False
+    METRICS_ENABLED = True
+    # who may read /metrics: addresses or networks, and a bearer token; with
+    # neither it's a 404. See metrics.py
+    METRICS_ALLOWED_IPS = tuple(
+        ip for ip in os.environ.get("METRICS_ALLOWED_IPS", "").split(",") if ip
+    )
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+    # "nominatim", "stub" or None; see geo.py
+    GEOCODER = os.environ.get("GEOCODER")
+    GEOCODER_USER_AGENT = "flask-cafe"
+
+    # compiled templates on disk, and whether to load them all at startup;
+    # see templating.py
+    TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR")
+    TEMPLATE_WARMUP = False
+
+    # query the cafe list, detail and search pages through an async engine
+    # (the views stay sync); see async_db.py
+    ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS") == "1"
+    ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL")
+
+    # send the (sync) cafe list as it renders; see ListView
+    STREAM_LIST_PAGES = os.environ.get("STREAM_LIST_PAGES") == "1"
+
+    # gzip/brotli for text responses; see compression.py
+    COMPRESSION_ENABLED = True
+    COMPRESSION_MIN_SIZE = 500
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_BROTLI_QUALITY = 4
+
+
+class DevConfig(Config):
+    """Local development: echo SQL and show the debug toolbar."""
+
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
+    GEOCODER = os.environ.get("GEOCODER", "stub")
+
+
+class TestConfig(Config):
+    """The test suite: its own database, no CSRF, cheap password hashes."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "TEST_DATABASE_URL", "postgresql:///flaskcafe_test"
+    )
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    GEOCODER = "stub"
+    SQLALCHEMY_BINDS = {}
+    REPLICA_BINDS = ()
+
+
+class ProdConfig(Config):
+    """Production: no SQL echo or toolbar, pool connections checked,
+    templates precompiled."""
+
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    ASYNC_ENGINE_OPTIONS = {
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    # no default: anyone who knows the key can forge sessions and image
+    # proxy URLs, so create_app() refuses to start without one
+    SECRET_KEY = os.environ.get("FLASK_SECRET_KEY")
+    SESSION_COOKIE_SECURE = True
+    # gunicorn behind one reverse proxy (see wsgi.py); without this every
+    # client has the proxy's address, and shares its login throttle bucket
+    TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 1))
+    TEMPLATE_CACHE_DIR = os.environ.get(
+        "TEMPLATE_CACHE_DIR", os.path.join(INSTANCE_DIR, "jinja-cache")
+    )
+    TEMPLATE_WARMUP = True
+
+
+CONFIGS = {
+    "dev": DevConfig,
+    "test": TestConfig,
+    "prod": ProdConfig,
+}
@@ -0,0 +1,27 @@
+"""Resetting per-process state in forked children.
+
+A forked child inherits objects as they were at the fork, but none of the
+threads behind them: a worker pool's threads, an event loop's thread, or
+whoever held a lock at that moment. Objects that start such things lazily
+register a reset here, so each child starts its own on first use.
+"""
+
+import os
+import weakref
+from functools import partial
+
+
+def reset_after_fork(obj, reset):
+    """Call `reset(obj)` in every child forked while `obj` is alive.
+
+    Only a weak reference to `obj` is kept, so registering doesn't keep it
+    alive; `reset` shouldn't be a method bound to `obj` for the same reason.
+    """
+
+    os.register_at_fork(after_in_child=partial(_reset, weakref.ref(obj), reset))
+
+
+def _reset(obj_ref, reset):
+    obj = obj_ref()
+    if obj is not None:
+        reset(obj)
@@ -0,0 +1,348 @@
+"""Synthetic data for load testing and local development.
+
+`generate()` fills the database with plausible-looking cities, cafes and
+users. The same seed always produces the same rows, and rows are keyed the
+same way the importer keys them, so re-running with the same seed updates
+rows in place rather than duplicating them.
+
+Rows go in through the importer's batched upsert (COPY on Postgres), a
+chunk per transaction, and every user gets the same precomputed password
+hash -- bcrypt per user would take longer than everything else combined.
+Each chunk reindexes the cafes whose search documents it changed.
+"""
+
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import tuple_
+
+import geo
+from hashing import hash_password, DEFAULT_ROUNDS
+from importer import index_cafes, upsert, CHUNK_SIZE
+from models import (
+    db,
+    Cafe,
+    City,
+    User,
+    city_cache,
+    username_index,
+    DEFAULT_CAFE_IMG_URL,
+    DEFAULT_IMG_URL,
+)
+
+PASSWORD = "password"
+CITY_RADIUS_KM = 15
+
+STATES = ("CA", "NY", "TX", "WA", "OR", "IL", "MA", "CO", "FL", "GA")
+CITY_PARTS = (
+    (
+        "Spring",
+        "Oak",
+        "River",
+        "Maple",
+        "Cedar",
+        "Lake",
+        "Fair",
+        "Green",
+        "Silver",
+        "Pine",
+        "Red",
+        "Clear",
+        "Mill",
+        "North",
+        "West",
+        "Bay",
+    ),
+    (
+        "field",
+        "dale",
+        "ton",
+        "wood",
+        "view",
+        "port",
+        "ville",
+        "brook",
+        "haven",
+        " Falls",
+        " Heights",
+        " Springs",
+        "burg",
+        "ford",
+    ),
+)
+CAFE_PARTS = (
+    (
+        "Blue",
+        "Little",
+        "Golden",
+        "Third",
+        "Old",
+        "Sunny",
+        "Quiet",
+        "Black",
+        "Copper",
+        "Wild",
+        "Morning",
+        "Corner",
+        "Velvet",
+        "Lucky",
+        "Urban",
+    ),
+    (
+        "Bean",
+        "Cup",
+        "Roast",
+        "Kettle",
+        "Grind",
+        "Crema",
+        "Press",
+        "Brew",
+        "Leaf",
+        "Mug",
+        "Pour",
+        "Drip",
+        "Saucer",
+        "Barrel",
+    ),
+    ("Cafe", "Coffee", "Roasters", "Espresso Bar", "Tea House", "Coffee Co."),
+)
+STREETS = (
+    "Main St",
+    "Market St",
+    "Grand Ave",
+    "Broadway",
+    "Park Ave",
+    "Elm St",
+    "College Ave",
+    "Mission St",
+    "Valencia St",
+    "Telegraph Ave",
+    "1st St",
+    "2nd St",
+    "Shattuck Ave",
+    "Lake Shore Dr",
+    "Union St",
+)
+DESCRIPTION_WORDS = (
+    "cozy",
+    "bright",
+    "spacious",
+    "laptop-friendly",
+    "quiet",
+    "busy",
+    "pour-over",
+    "pastries",
+    "patio",
+    "oat milk",
+    "single-origin",
+    "wifi",
+    "outlets",
+    "friendly staff",
+    "great music",
+    "local art",
+    "dog-friendly",
+)
+FIRST_NAMES = (
+    "Ada",
+    "Alan",
+    "Grace",
+    "Linus",
+    "Barbara",
+    "Ken",
+    "Margaret",
+    "Dennis",
+    "Frances",
+    "Guido",
+    "Radia",
+    "Edsger",
+    "Hedy",
+    "Donald",
+    "Sophie",
+    "Tim",
+)
+LAST_NAMES = (
+    "Lovelace",
+    "Turing",
+    "Hopper",
+    "Torvalds",
+    "Liskov",
+    "Thompson",
+    "Hamilton",
+    "Ritchie",
+    "Allen",
+    "Rossum",
+    "Perlman",
+    "Dijkstra",
+    "Lamarr",
+    "Knuth",
+    "Wilson",
+    "Berners",
+)
+
+
+@dataclass
+class GenerateResult:
+    cities: int = 0
+    cafes: int = 0
+    users: int = 0
+
+
+def city_rows(rng, count, now):
+    for i in range(count):
+        name = rng.choice(CITY_PARTS[0]) + rng.choice(CITY_PARTS[1])
+        yield dict(
+            code=f"{name[:4].lower()}{i}",
+            name=name,
+            state=rng.choice(STATES),
+            updated_at=now,
+        )
+
+
+def cafe_rows(rng, count, city_codes, now):
+    # each city gets a stable spot somewhere in the continental US, and
+    # its cafes are scattered up to CITY_RADIUS_KM around it
+    places = geo.StubGeocoder(center=(39.0, -98.0), spread_km=1500)
+    centers = {code: places.geocode(code) for code in city_codes}
+
+    for i in range(count):
+        name = " ".join(rng.choice(part) for part in CAFE_PARTS)
+        words = rng.sample(DESCRIPTION_WORDS, 3)
+        city_code = rng.choice(city_codes)
+        lat, lng = _scatter(rng, centers[city_code])
+        yield dict(
+            name=name,
+            description=f"A {words[0]} spot with {words[1]} and {words[2]}.",
+            url=f"https://example.com/cafes/{i}",
+            # numbering the address by i keeps the natural key unique
+            address=f"{100 + i} {rng.choice(STREETS)}",
+            city_code=city_code,
+            image_url=DEFAULT_CAFE_IMG_URL,
+            latitude=lat,
+            longitude=lng,
+            geo_cell=geo.grid_cell(lat, lng),
+            updated_at=now,
+        )
+
+
+def _scatter(rng, center):
+    distance = CITY_RADIUS_KM * math.sqrt(rng.random())
+    bearing = rng.uniform(0, 2 * math.pi)
+    lat, lng = center
+    dlat = distance * math.cos(bearing) / geo.KM_PER_DEGREE
+    dlng = (
+        distance * math.sin(bearing) / (geo.KM_PER_DEGREE * math.cos(math.radians(lat)))
+    )
+    return lat + dlat, lng + dlng
+
+
+def user_rows(rng, count, hashed):
+    for i in range(count):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        username = f"{first[:8]}{last[:8]}{i}".lower()
+        yield dict(
+            username=username,
+            admin=False,
+            email=f"{username}@example.com",
+            first_name=first,
+            last_name=last,
+            description=f"{first} likes {rng.choice(DESCRIPTION_WORDS)}.",
+            image_url=DEFAULT_IMG_URL,
+            password=hashed,
+        )
+
+
+def _insert(engine, table, rows, keys, chunk_size, touched=None):
+    # `touched` maps a chunk to a query for the cafes it needs reindexed
+    count = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return count
+        with engine.begin() as conn:
+            upsert(conn, table, chunk, keys)
+            if touched:
+                index_cafes(conn, touched(chunk))
+        count += len(chunk)
+
+
+def _city_cafes(chunk):
+    codes = [row["code"] for row in chunk]
+    return db.select(Cafe.id).where(Cafe.city_code.in_(codes))
+
+
+def _chunk_cafes(chunk):
+    keys = [(row["name"], row["address"], row["city_code"]) for row in chunk]
+    return db.select(Cafe.id).where(
+        tuple_(Cafe.name, Cafe.address, Cafe.city_code).in_(keys)
+    )
+
+
+def generate(
+    engine,
+    cities=0,
+    cafes=0,
+    users=0,
+    seed=0,
+    password=PASSWORD,
+    rounds=DEFAULT_ROUNDS,
+    chunk_size=CHUNK_SIZE,
+):
+    """Insert synthetic rows; returns a GenerateResult of the counts.
+
+    Cafes are spread over the generated cities, or over the cities already
+    in the database if `cities` is 0.
+    """
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    result = GenerateResult()
+
+    if cities:
+        codes = []
+
+        def remember(rows):
+            for row in rows:
+                codes.append(row["code"])
+                yield row
+
+        result.cities = _insert(
+            engine,
+            City.__table__,
+            remember(city_rows(rng, cities, now)),
+            ["code"],
+            chunk_size,
+            _city_cafes,
+        )
+        city_cache.invalidate()
+    else:
+        with engine.connect() as conn:
+            codes = sorted(conn.execute(db.select(City.code)).scalars())
+
+    if cafes:
+        if not codes:
+            raise ValueError("There are no cities to put cafes in.")
+        result.cafes = _insert(
+            engine,
+            Cafe.__table__,
+            cafe_rows(rng, cafes, codes, now),
+            ["name", "address", "city_code"],
+            chunk_size,
+            _chunk_cafes,
+        )
+
+    if users:
+        hashed = hash_password(password, rounds)
+        result.users = _insert(
+            engine,
+            User.__table__,
+            user_rows(rng, users, hashed),
+            ["username"],
+            chunk_size,
+        )
+        username_index.invalidate()
+
+    return result
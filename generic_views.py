@@ -1,24 +1,614 @@
+import asyncio
+from functools import cached_property
+from hashlib import sha1
+
 from flask.views import View
-from flask import render_template
+from flask_wtf.csrf import generate_csrf
+from flask import (
+    render_template,
+    request,
+    session,
+    url_for,
+    abort,
+    make_response,
+    current_app,
+    jsonify,
+    stream_template,
+)
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload, subqueryload, raiseload
+from werkzeug.http import is_resource_modified
+
+from assets import manifest_version
+from async_db import get_async_db
+from models import seen_versions, versions_query
+from replicas import read_from_replica
+from pagination import (
+    Keyset,
+    InvalidCursor,
+    StreamedPage,
+    make_page,
+    page_query,
+    paginate,
+)
+
+LOADER_STRATEGIES = {
+    "joined": joinedload,
+    "selectin": selectinload,
+    "subquery": subqueryload,
+    "raise": raiseload,
+}
+
+
+def loader_options(model, load):
+    """Turn a `{"relationship": "strategy"}` spec into loader options.
 
-class ListView(View):
-    """A generic ListView.
-    TODO: figure out how to pass ordering
+    e.g. `{"city": "joined"}` fetches each cafe's city in the same SELECT
+    instead of lazily issuing one query per cafe when a template uses it.
     """
-    def __init__(self, model):
+
+    return [
+        LOADER_STRATEGIES[strategy](getattr(model, relationship))
+        for relationship, strategy in (load or {}).items()
+    ]
+
+
+class ModelView(View):
+    """Base for the generic views: conditional GET.
+
+    When the model's table is versioned (see models.TableVersion),
+    responses carry a strong ETag worked out from the table's change
+    counter with a primary key lookup, and a request whose If-None-Match
+    (or, for anonymous pages, If-Modified-Since) still holds gets a 304
+    before any rows are loaded or templates rendered. Any write to the
+    table -- an edit, insert or delete -- changes the ETag.
+
+    `depends_on` lists other versioned models whose rows show up on the
+    page, e.g. the City for a cafe, so editing them changes the ETag.
+    `user_depends_on` lists those shown only to a logged-in user, e.g. the
+    User in the navbar or the Likes behind a Like button; they're part of
+    the ETag when there's a session.
+
+    GETs read from a replica when there are any (see replicas.py).
+    """
+
+    decorators = [read_from_replica]
+    depends_on = ()
+    user_depends_on = ()
+
+    def version_tables(self):
+        """Names of the tables whose versions make up the ETag, or None."""
+
+        models = (self.model, *self.depends_on)
+        if session:
+            models += self.user_depends_on
+        if not all(model.__table__.info.get("versioned") for model in models):
+            return None
+        return sorted(model.__table__.name for model in models)
+
+    def make_version(self, names, rows):
+        """The (name, version, changed_at) of each table, in order.
+
+        A table that has never been written to has no row yet. The
+        versions are recorded for the rest of the request (see
+        models.seen_versions).
+        """
+
+        found = {row.name: tuple(row) for row in rows}
+        version = tuple(found.get(name, (name, 0, None)) for name in names)
+        seen_versions().update((name, number) for name, number, _ in version)
+        return version
+
+    def get_version(self):
+        names = self.version_tables()
+        if names is None:
+            return None
+
+        rows = self.model.query.session.execute(versions_query(names))
+        return self.make_version(names, rows)
+
+    def get_validators(self, version):
+        """Return (etag, last_modified) for this request, or None.
+
+        `version` comes from `get_version()`. Whatever else shapes the page
+        -- the URL, the session, which holds the logged-in user, and the
+        deploy: BUILD_ID and the asset manifest -- is folded into the ETag
+        too. A date can't tell who the page was for, so only pages rendered
+        without a session get Last-Modified. With flashed messages waiting
+        the page must be rendered, so nothing is returned.
+        """
+
+        if "_flashes" in session:
+            return None
+
+        if session:
+            # a session's pages can carry its CSRF token, whose secret is
+            # kept in the session: create it now, so it's in the ETag from
+            # the first page on
+            generate_csrf()
+        state = sorted(session.items())
+        assets, built_at = manifest_version(current_app)
+        deploy = (current_app.config.get("BUILD_ID"), assets)
+        digest = sha1(repr((request.full_path, state, version, deploy)).encode())
+        last_modified = None
+        if not state:
+            dates = [changed_at for _, _, changed_at in version if changed_at]
+            if built_at:
+                dates.append(built_at)
+            last_modified = max(dates, default=None)
+        return digest.hexdigest(), last_modified
+
+    def not_modified(self, validators):
+        """Return a 304 if the client's copy is still current, else None."""
+
+        if validators is None or request.method not in ("GET", "HEAD"):
+            return None
+
+        etag, last_modified = validators
+        if is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified
+        ):
+            return None
+
+        return self.add_validators(current_app.response_class(status=304), validators)
+
+    def add_validators(self, response, validators):
+        if validators is not None:
+            etag, last_modified = validators
+            response.set_etag(etag)
+            # (assigning None would stamp the current time)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            if session:
+                # for this user only: shared caches mustn't keep it
+                response.cache_control.private = True
+                response.vary.add("Cookie")
+        return response
+
+
+class ListView(ModelView):
+    """A generic ListView with keyset pagination.
+
+    Pages are fetched by seeking past the last row shown rather than with
+    OFFSET, so a page deep into the list costs the same as the first one.
+
+    `order_fields` whitelists the fields accepted in `?order=`; prefix one
+    with `-` to sort descending. `?per_page=` is capped at `max_per_page`.
+    `load` is a loader spec for the relationships the template uses (see
+    `loader_options`).
+
+    With `stream=True` the page is sent while it renders: the top of the
+    page goes out before any rows are fetched, and the rows are read
+    `yield_per` at a time and sent in chunks of about `chunk_size`
+    characters, so big pages start arriving at once and never sit in
+    memory whole. Queries made while streaming come after the response
+    headers, so Server-Timing leaves them out. Pages fetched backwards
+    (`?before=`) come out of the database in reverse and aren't streamed.
+    """
+
+    per_page = 24
+    max_per_page = 100
+    stream = False
+    yield_per = 100
+    chunk_size = 16 * 1024
+
+    def __init__(
+        self,
+        model,
+        order_fields=("id",),
+        default_order=None,
+        per_page=None,
+        max_per_page=None,
+        load=None,
+        depends_on=(),
+        user_depends_on=(),
+        stream=None,
+    ):
         self.model = model
+        self.depends_on = tuple(depends_on)
+        self.user_depends_on = tuple(user_depends_on)
         self.template = f"{model.__name__.lower()}/list.html"
+        self.options = loader_options(model, load)
+        self.order_fields = tuple(order_fields)
+        self.default_order = default_order or self.order_fields[0]
+        if per_page is not None:
+            self.per_page = per_page
+        if max_per_page is not None:
+            self.max_per_page = max_per_page
+        if stream is not None:
+            self.stream = stream
+
+    def get_keyset(self):
+        """Return the Keyset for `?order=`, or 400 if it isn't whitelisted."""
+
+        order = request.args.get("order", self.default_order)
+        field = order.removeprefix("-")
+        if field not in self.order_fields:
+            abort(400, f"Can't order by {order!r}.")
+
+        return Keyset(self.model, field, descending=order.startswith("-"))
+
+    def get_per_page(self):
+        per_page = request.args.get("per_page", self.per_page, type=int)
+        return max(1, min(per_page, self.max_per_page))
+
+    def get_query(self):
+        return self.model.query.options(*self.options)
+
+    def get_page(self):
+        try:
+            return paginate(
+                self.get_query(),
+                self.get_keyset(),
+                self.get_per_page(),
+                after=request.args.get("after"),
+                before=request.args.get("before"),
+            )
+        except InvalidCursor:
+            abort(400, "Invalid page cursor.")
+
+    def page_url(self, **params):
+        """URL for this view with the current args, overriding `params`."""
+
+        args = request.args.to_dict()
+        args.pop("after", None)
+        args.pop("before", None)
+        args.update(params)
+        return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+    def stream_page(self):
+        """Return a streamed response rendering the page as it's fetched."""
+
+        keyset = self.get_keyset()
+        per_page = self.get_per_page()
+        after = request.args.get("after")
+        try:
+            query = page_query(self.get_query(), keyset, per_page, after=after)
+        except InvalidCursor:
+            abort(400, "Invalid page cursor.")
+
+        page = StreamedPage(
+            query.yield_per(self.yield_per), keyset, per_page, after=after
+        )
+        pieces = stream_template(
+            self.template,
+            items=page,
+            page=page,
+            # the nav links come after the rows, by when they're known
+            next_url=_Later(
+                lambda: page.has_next and self.page_url(after=page.next_cursor)
+            ),
+            prev_url=_Later(
+                lambda: page.has_prev and self.page_url(before=page.prev_cursor)
+            ),
+        )
+        return current_app.response_class(
+            _chunked(pieces, page, self.chunk_size), mimetype="text/html"
+        )
 
     def dispatch_request(self):
-        items = self.model.query
-        return render_template(self.template, items=items)
+        version = self.get_version()
+        validators = version and self.get_validators(version)
+        response = self.not_modified(validators)
+        if response is not None:
+            return response
+
+        if self.stream and "before" not in request.args:
+            return self.add_validators(self.stream_page(), validators)
 
+        page = self.get_page()
+        next_url = page.has_next and self.page_url(after=page.next_cursor)
+        prev_url = page.has_prev and self.page_url(before=page.prev_cursor)
+        response = make_response(
+            render_template(
+                self.template,
+                items=page.items,
+                page=page,
+                next_url=next_url,
+                prev_url=prev_url,
+            )
+        )
+        return self.add_validators(response, validators)
 
-class DetailView(View):
-    def __init__(self, model):
+
+class _Later:
+    """A template value worked out when the template first uses it."""
+
+    def __init__(self, get):
+        self.get = get
+
+    @cached_property
+    def value(self):
+        return self.get()
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+
+def _chunked(pieces, page, size):
+    """Join rendered pieces into chunks of at least `size` characters.
+
+    Until `page` starts fetching rows, pieces go out as they come, so the
+    top of the page isn't held back waiting for the database.
+    """
+
+    buffer = []
+    length = 0
+    for piece in pieces:
+        if not page.started:
+            yield piece
+            continue
+
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+
+    if buffer:
+        yield "".join(buffer)
+
+
+class DetailView(ModelView):
+    """A generic DetailView; `load` and the dependencies are as for ListView."""
+
+    def __init__(self, model, load=None, depends_on=(), user_depends_on=()):
         self.model = model
+        self.depends_on = tuple(depends_on)
+        self.user_depends_on = tuple(user_depends_on)
         self.template = f"{model.__name__.lower()}/detail.html"
+        self.options = loader_options(model, load)
 
     def dispatch_request(self, id):
-        item = self.model.query.get_or_404(id)
-        return render_template(self.template, item=item)
+        version = self.get_version()
+        validators = version and self.get_validators(version)
+        response = self.not_modified(validators)
+        if response is not None:
+            return response
+
+        item = self.model.query.options(*self.options).get_or_404(id)
+        response = make_response(render_template(self.template, item=item))
+        return self.add_validators(response, validators)
+
+
+def _is_conditional():
+    """Could this request be answered with a 304?"""
+
+    return request.method in ("GET", "HEAD") and bool(
+        request.if_none_match or request.if_modified_since
+    )
+
+
+async def _gather_reads(*reads):
+    """Run `(fn, *args)` reads concurrently, each on its own connection."""
+
+    db = get_async_db()
+    return await asyncio.gather(*(db.read(*read) for read in reads))
+
+
+async def _fetch_if_modified(view, read):
+    """Fetch `view`'s table versions and, unless a 304 will do, `read`.
+
+    Returns `(validators, content)`, with `content` None when the client's
+    copy is current. A request without If-None-Match or If-Modified-Since
+    can't get a 304, so both are fetched at the same time; otherwise the
+    versions go first.
+    """
+
+    if _is_conditional():
+        (version,) = await _gather_reads((view.get_version,))
+        validators = version and view.get_validators(version)
+        if view.not_modified(validators) is not None:
+            return validators, None
+        (content,) = await _gather_reads(read)
+    else:
+        version, content = await _gather_reads((view.get_version,), read)
+        validators = version and view.get_validators(version)
+    return validators, content
+
+
+def _fetch_on_loop(view, read):
+    """Run `_fetch_if_modified` on the async engine's loop and wait for it.
+
+    Only the queries run there: the page is rendered back on the request
+    thread, where templates can use `g.user` and run sync queries (e.g.
+    `g.user.has_liked()`) without blocking the loop every async request
+    shares.
+    """
+
+    return current_app.ensure_sync(_fetch_if_modified)(view, read)
+
+
+class AsyncListView(ListView):
+    """A ListView that queries through the async engine (see async_db.py).
+
+    Takes the same options. It's still a sync view: the table versions and
+    the page are fetched concurrently on the async engine's loop (see
+    `_fetch_if_modified`) while the request thread waits, and the page is
+    rendered on the request thread. Templates mustn't lazy-load the
+    fetched rows' relationships: give them to `load` instead.
+    """
+
+    def get_query(self):
+        return select(self.model).options(*self.options)
+
+    async def get_version(self, session):
+        names = self.version_tables()
+        if names is None:
+            return None
+
+        rows = await session.execute(versions_query(names))
+        return self.make_version(names, rows)
+
+    async def get_items(self, session, query):
+        result = await session.execute(query)
+        return result.unique().scalars().all()
+
+    def dispatch_request(self):
+        keyset = self.get_keyset()
+        per_page = self.get_per_page()
+        after = request.args.get("after")
+        before = request.args.get("before")
+        try:
+            query = page_query(self.get_query(), keyset, per_page, after, before)
+        except InvalidCursor:
+            abort(400, "Invalid page cursor.")
+
+        validators, items = _fetch_on_loop(self, (self.get_items, query))
+        if items is None:
+            return self.not_modified(validators)
+
+        page = make_page(items, keyset, per_page, after, before)
+        next_url = page.has_next and self.page_url(after=page.next_cursor)
+        prev_url = page.has_prev and self.page_url(before=page.prev_cursor)
+        response = make_response(
+            render_template(
+                self.template,
+                items=page.items,
+                page=page,
+                next_url=next_url,
+                prev_url=prev_url,
+            )
+        )
+        return self.add_validators(response, validators)
+
+
+class AsyncDetailView(DetailView):
+    """A DetailView that queries through the async engine; see AsyncListView."""
+
+    get_version = AsyncListView.get_version
+
+    async def get_item(self, session, id):
+        item = await session.get(self.model, id, options=self.options)
+        if item is None:
+            abort(404)
+        return item
+
+    def dispatch_request(self, id):
+        validators, item = _fetch_on_loop(self, (self.get_item, id))
+        if item is None:
+            return self.not_modified(validators)
+
+        response = make_response(render_template(self.template, item=item))
+        return self.add_validators(response, validators)
+
+
+def _json_value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+class SparseFieldsMixin:
+    """Lets JSON views SELECT only the columns asked for with `?fields=`.
+
+    `fields` whitelists the model's columns that can be requested; without
+    a `fields` parameter all of them are returned, and an empty one is a
+    400. Rows come back as plain tuples and are turned into dicts
+    directly, never into ORM objects.
+    """
+
+    def get_fields(self):
+        fields = request.args.get("fields")
+        if fields is None:
+            return list(self.fields)
+
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+        if not fields:
+            abort(400, "No fields requested.")
+        unknown = set(fields) - set(self.fields)
+        if unknown:
+            abort(400, f"Unknown fields: {', '.join(sorted(unknown))}.")
+        return fields
+
+    def columns_for(self, fields, *extra):
+        """Model columns for `fields`, plus any `extra` ones, no repeats."""
+
+        columns = {}
+        for column in [getattr(self.model, field) for field in fields] + list(extra):
+            columns.setdefault(column.key, column)
+        return list(columns.values())
+
+    def serialize(self, row, fields):
+        mapping = row._mapping
+        return {field: _json_value(mapping[field]) for field in fields}
+
+
+class JsonListView(SparseFieldsMixin, ListView):
+    """A ListView that returns a page of rows as JSON.
+
+    Takes the ListView options plus `fields` (see SparseFieldsMixin) and
+    `filters`, a mapping of query args to columns that must equal them,
+    e.g. `{"city": "city_code"}` for `?city=sf`.
+    """
+
+    def __init__(self, model, fields, filters=None, **kwargs):
+        super().__init__(model, **kwargs)
+        self.fields = tuple(fields)
+        self.filters = dict(filters or {})
+
+    def get_query(self):
+        fields = self.get_fields()
+        keyset = self.get_keyset()
+        query = self.model.query.session.query(
+            *self.columns_for(fields, *keyset.columns)
+        )
+
+        for arg, field in self.filters.items():
+            value = request.args.get(arg)
+            if value is not None:
+                query = query.filter(getattr(self.model, field) == value)
+
+        return query
+
+    def dispatch_request(self):
+        version = self.get_version()
+        validators = version and self.get_validators(version)
+        response = self.not_modified(validators)
+        if response is not None:
+            return response
+
+        fields = self.get_fields()
+        page = self.get_page()
+        next_url = page.has_next and self.page_url(after=page.next_cursor)
+        prev_url = page.has_prev and self.page_url(before=page.prev_cursor)
+        response = jsonify(
+            items=[self.serialize(row, fields) for row in page.items],
+            next=page.next_cursor,
+            prev=page.prev_cursor,
+            next_url=next_url or None,
+            prev_url=prev_url or None,
+        )
+        return self.add_validators(response, validators)
+
+
+class JsonDetailView(SparseFieldsMixin, DetailView):
+    """A DetailView that returns one row as JSON; see SparseFieldsMixin."""
+
+    def __init__(self, model, fields, **kwargs):
+        super().__init__(model, **kwargs)
+        self.fields = tuple(fields)
+
+    def dispatch_request(self, id):
+        version = self.get_version()
+        validators = version and self.get_validators(version)
+        response = self.not_modified(validators)
+        if response is not None:
+            return response
+
+        fields = self.get_fields()
+        row = (
+            self.model.query.session.query(*self.columns_for(fields))
+            .filter(self.model.id == id)
+            .first()
+        )
+        if row is None:
+            abort(404)
+
+        response = jsonify(self.serialize(row, fields))
+        return self.add_validators(response, validators)
@@ -0,0 +1,193 @@
+"""Locations for cafes: geocoding, distances and a grid index.
+
+The world is cut into GRID_DEGREES x GRID_DEGREES cells and every located
+cafe stores the number of its cell in an indexed column. A nearby query
+turns its search circle into a bounding box, looks up the handful of cells
+that box touches, and only computes real distances for the cafes in them.
+
+Geocoders turn an address into (latitude, longitude). Pick one with the
+GEOCODER config key: "nominatim" (OpenStreetMap; set GEOCODER_USER_AGENT),
+"stub" (made-up but stable coordinates, for tests and development) or None
+to leave new cafes unlocated.
+"""
+
+import math
+import time
+from hashlib import blake2b
+from threading import Lock
+
+import requests
+from flask import current_app
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+GRID_DEGREES = 0.1
+GRID_ROWS = round(180 / GRID_DEGREES)
+GRID_COLS = round(360 / GRID_DEGREES)
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle (haversine) distance between two points, in km."""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _row(lat):
+    return min(GRID_ROWS - 1, max(0, math.floor((lat + 90) / GRID_DEGREES)))
+
+
+def _col(lng):
+    return math.floor((lng + 180) / GRID_DEGREES) % GRID_COLS
+
+
+def grid_cell(lat, lng):
+    """Return the number of the grid cell containing (lat, lng)."""
+
+    return _row(lat) * GRID_COLS + _col(lng)
+
+
+def bounding_box(lat, lng, radius_km):
+    """Return (min_lat, max_lat, lng_ranges) around a circle.
+
+    `lng_ranges` is a list of (min_lng, max_lng); it has two entries when
+    the box crosses the antimeridian, and spans every longitude when it
+    reaches a pole.
+    """
+
+    dlat = radius_km / KM_PER_DEGREE
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90), min(max_lat, 90), [(-180, 180)]
+
+    dlng = math.degrees(
+        math.asin(min(1.0, math.sin(math.radians(dlat)) / math.cos(math.radians(lat))))
+    )
+    min_lng, max_lng = lng - dlng, lng + dlng
+    if min_lng < -180:
+        return min_lat, max_lat, [(min_lng + 360, 180), (-180, max_lng)]
+    if max_lng > 180:
+        return min_lat, max_lat, [(min_lng, 180), (-180, max_lng - 360)]
+    return min_lat, max_lat, [(min_lng, max_lng)]
+
+
+def cells_for(min_lat, max_lat, lng_ranges):
+    """Return the grid cells that cover a bounding box."""
+
+    cols = set()
+    for min_lng, max_lng in lng_ranges:
+        first, last = _col(min_lng), _col(max_lng)
+        if max_lng >= 180:
+            last = GRID_COLS - 1
+        cols.update(range(first, last + 1))
+
+    return [
+        row * GRID_COLS + col
+        for row in range(_row(min_lat), _row(max_lat) + 1)
+        for col in sorted(cols)
+    ]
+
+
+#######################################
+# geocoders
+
+
+class Geocoder:
+    """Turns a postal address into coordinates."""
+
+    def geocode(self, address):
+        """Return (latitude, longitude) for `address`, or None if unknown."""
+
+        raise NotImplementedError
+
+
+class StubGeocoder(Geocoder):
+    """Answers from a dict, or else with a point derived from the address.
+
+    Unknown addresses land within `spread_km` of `center`, always at the
+    same spot, so tests and local data get stable, plausible locations
+    without a network.
+    """
+
+    def __init__(self, locations=None, center=(37.7749, -122.4194), spread_km=10):
+        self.locations = dict(locations or {})
+        self.center = center
+        self.spread_km = spread_km
+
+    def geocode(self, address):
+        if address in self.locations:
+            return self.locations[address]
+
+        digest = blake2b(address.encode("utf-8"), digest_size=8).digest()
+        x = int.from_bytes(digest[:4], "little") / 2**32 * 2 - 1
+        y = int.from_bytes(digest[4:], "little") / 2**32 * 2 - 1
+        lat, lng = self.center
+        dlat = y * self.spread_km / KM_PER_DEGREE
+        dlng = x * self.spread_km / (KM_PER_DEGREE * math.cos(math.radians(lat)))
+        return lat + dlat, lng + dlng
+
+
+class NominatimGeocoder(Geocoder):
+    """Geocodes with OpenStreetMap's Nominatim service.
+
+    The public server allows one request a second and requires a
+    descriptive User-Agent; requests are spaced out accordingly.
+    """
+
+    URL = "https://nominatim.openstreetmap.org/search"
+
+    def __init__(self, user_agent, url=URL, timeout=5, min_interval=1.0):
+        self.user_agent = user_agent
+        self.url = url
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self._last = 0.0
+        self._lock = Lock()
+
+    def geocode(self, address):
+        with self._lock:
+            wait = self._last + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last = time.monotonic()
+
+        try:
+            resp = requests.get(
+                self.url,
+                params={"q": address, "format": "jsonv2", "limit": 1},
+                headers={"User-Agent": self.user_agent},
+                timeout=self.timeout,
+            )
+            resp.raise_for_status()
+            results = resp.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+        if not results:
+            return None
+        return float(results[0]["lat"]), float(results[0]["lon"])
+
+
+def get_geocoder():
+    """Return the current app's geocoder, or None if GEOCODER isn't set."""
+
+    app = current_app._get_current_object()
+    if "geocoder" not in app.extensions:
+        kind = app.config.get("GEOCODER")
+        if kind == "nominatim":
+            geocoder = NominatimGeocoder(
+                app.config.get("GEOCODER_USER_AGENT", "flask-cafe")
+            )
+        elif kind == "stub":
+            geocoder = StubGeocoder()
+        elif kind is None or isinstance(kind, Geocoder):
+            geocoder = kind
+        else:
+            raise ValueError(f"Unknown GEOCODER {kind!r}")
+        app.extensions["geocoder"] = geocoder
+    return app.extensions["geocoder"]
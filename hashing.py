@@ -0,0 +1,139 @@
+"""Password hashing for Flask Cafe, run on a bounded worker pool.
+
+bcrypt is deliberately slow (~250ms at the default cost of 12), so rather
+than letting every login and signup burn a request thread, hashes run on a
+fixed-size pool. The number of hashes waiting for the pool is capped: past
+that, callers get `HashingBusy` straight away instead of piling up behind a
+login storm. A hash that outlasts PASSWORD_HASH_TIMEOUT raises it too.
+
+Configuration (read from the current app):
+
+- BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes (default 12).
+  Hashes made with another cost are redone on the next successful login.
+- PASSWORD_HASH_EXECUTOR: "thread" (default) or "process".
+- PASSWORD_HASH_WORKERS: pool size (default: number of CPUs).
+- PASSWORD_HASH_MAX_QUEUE: hashes allowed in flight (default: 4 x workers).
+- PASSWORD_HASH_TIMEOUT: seconds to wait for a result (default 10).
+"""
+
+import os
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError,
+)
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+from flask import current_app
+
+from forking import reset_after_fork
+
+DEFAULT_ROUNDS = 12
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already in flight, or one
+    took longer than PASSWORD_HASH_TIMEOUT."""
+
+
+def hash_password(password, rounds):
+    """Return a bcrypt hash of `password` with cost `rounds`."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+
+def check_password(hashed, password):
+    """Return True if `password` matches the bcrypt hash `hashed`."""
+
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+def hash_rounds(hashed):
+    """Return the cost a bcrypt hash was made with ('$2b$12$...' -> 12)."""
+
+    return int(hashed.split("$")[2])
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded pool.
+
+    Arguments override the app config; the pool itself is created on first
+    use, so nothing is started at import time.
+    """
+
+    def __init__(self, executor=None, workers=None, max_queue=None):
+        self.executor = executor
+        self.workers = workers
+        self.max_queue = max_queue
+        self._forget_pool()
+        reset_after_fork(self, PasswordHasher._forget_pool)
+
+    def _forget_pool(self):
+        self._pool = None
+        self._slots = None
+        self._lock = Lock()
+
+    @property
+    def rounds(self):
+        return current_app.config.get("BCRYPT_LOG_ROUNDS", DEFAULT_ROUNDS)
+
+    def _start(self):
+        config = current_app.config
+        kind = self.executor or config.get("PASSWORD_HASH_EXECUTOR", "thread")
+        workers = self.workers or config.get(
+            "PASSWORD_HASH_WORKERS", os.cpu_count() or 1
+        )
+        max_queue = self.max_queue or config.get("PASSWORD_HASH_MAX_QUEUE", 4 * workers)
+
+        pool_class = ProcessPoolExecutor if kind == "process" else ThreadPoolExecutor
+        self._slots = BoundedSemaphore(max_queue)
+        self._pool = pool_class(max_workers=workers)
+
+    def submit(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result.
+
+        Raises HashingBusy without queueing if the pool is full, and if
+        the result takes longer than PASSWORD_HASH_TIMEOUT.
+        """
+
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._start()
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        timeout = current_app.config.get("PASSWORD_HASH_TIMEOUT", 10)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            raise HashingBusy() from None
+        finally:
+            # a job we gave up waiting for still holds its slot until it ends
+            future.add_done_callback(lambda future: self._slots.release())
+
+    def hash(self, password):
+        return self.submit(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self.submit(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """True if `hashed` wasn't made with the configured cost."""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
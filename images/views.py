@@ -0,0 +1,46 @@
+import hmac
+
+from flask import Blueprint, abort, current_app, request, send_file
+
+from thumbnails import (
+    SIZES,
+    ImageError,
+    ImageUnavailable,
+    get_proxy,
+    mimetype_of,
+    sign,
+    thumbnail_url,
+)
+
+images = Blueprint("images", __name__)
+
+# a thumbnail URL names its source and is signed, so its bytes never change
+ONE_YEAR = 365 * 24 * 60 * 60
+
+images.add_app_template_global(thumbnail_url, "thumbnail_url")
+
+
+@images.get("/img/<size>/<signature>")
+def thumbnail(size, signature):
+    """Serve ?src= resized to `size` from the image cache."""
+
+    src = request.args.get("src", "")
+    if size not in SIZES or not hmac.compare_digest(signature, sign(size, src)):
+        abort(404)
+
+    proxy = get_proxy()
+    try:
+        path = proxy.get(size, src)
+    except ImageError as exc:
+        # a source that just failed isn't fetched again for a while
+        status = 404 if isinstance(exc, ImageUnavailable) else 502
+        resp = current_app.response_class(status=status)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = proxy.failure_ttl
+        return resp
+
+    resp = send_file(path, mimetype=mimetype_of(path), etag=signature)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ONE_YEAR
+    resp.cache_control.immutable = True
+    return resp
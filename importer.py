@@ -0,0 +1,269 @@
+"""Streaming bulk import of cities and cafes.
+
+Input (CSV with a header row, or JSON lines) is read a chunk at a time and
+each chunk is upserted on its natural key -- a city's code, a cafe's
+(name, address, city_code) -- with one Core statement, or through COPY and a
+staging table on Postgres. Only one chunk is held in memory at a time, and
+re-running an import updates rows instead of duplicating them. Core
+statements bypass the mapper events that keep the search index current, so
+each chunk reindexes the cafes it touched in its own transaction.
+"""
+
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from hashlib import sha1
+from itertools import islice
+
+from sqlalchemy import select, text, tuple_
+
+import search
+from models import (
+    db,
+    Cafe,
+    City,
+    city_cache,
+    note_write,
+    _dialect_insert,
+    DEFAULT_CAFE_IMG_URL,
+)
+
+CHUNK_SIZE = 5000
+
+
+class RowError(ValueError):
+    """A row that can't be imported."""
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    errors: list = field(default_factory=list)
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, dict) for each record in a CSV or JSONL stream."""
+
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+
+    elif fmt == "jsonl":
+        for line_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                yield line_num, RowError(f"invalid JSON: {exc}")
+                continue
+            if not isinstance(row, dict):
+                yield line_num, RowError("expected a JSON object")
+                continue
+            yield line_num, row
+
+    else:
+        raise ValueError(f"Unknown format {fmt!r}")
+
+
+def _required(row, name, max_length=None):
+    value = row.get(name)
+    value = "" if value is None else str(value).strip()
+    if not value:
+        raise RowError(f"{name} is required")
+    if max_length and len(value) > max_length:
+        raise RowError(f"{name} is longer than {max_length} characters")
+    return value
+
+
+def _optional(row, name, default=""):
+    value = row.get(name)
+    value = "" if value is None else str(value).strip()
+    return value or default
+
+
+class Importer:
+    """Loads rows into the database in chunks, one transaction per chunk."""
+
+    def __init__(self, engine, chunk_size=CHUNK_SIZE):
+        self.engine = engine
+        self.chunk_size = chunk_size
+
+    def _run(self, rows, clean, table, keys, touched):
+        """Upsert the rows `clean` accepts into `table` on `keys`.
+
+        `touched` maps a chunk's key tuples to a query for the ids of the
+        cafes whose search documents the chunk changed.
+        """
+
+        result = ImportResult()
+        rows = iter(rows)
+        now = datetime.utcnow()
+
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+
+            # last row wins when a key repeats within a chunk
+            records = {}
+            for line_num, row in chunk:
+                try:
+                    if isinstance(row, RowError):
+                        raise row
+                    record = clean(row)
+                except RowError as exc:
+                    result.errors.append((line_num, str(exc)))
+                    continue
+                record["updated_at"] = now
+                records[tuple(record[key] for key in keys)] = record
+
+            if records:
+                with self.engine.begin() as conn:
+                    upsert(conn, table, list(records.values()), keys)
+                    index_cafes(conn, touched(list(records)))
+                result.imported += len(records)
+
+        return result
+
+    def import_cities(self, rows):
+        def clean(row):
+            return dict(
+                code=_required(row, "code"),
+                name=_required(row, "name"),
+                state=_required(row, "state", max_length=2).upper(),
+            )
+
+        # a city's name is part of its cafes' documents
+        def touched(codes):
+            return select(Cafe.id).where(Cafe.city_code.in_([code for code, in codes]))
+
+        result = self._run(rows, clean, City.__table__, ["code"], touched)
+        city_cache.invalidate()
+        return result
+
+    def import_cafes(self, rows):
+        with self.engine.connect() as conn:
+            city_codes = set(conn.execute(select(City.code)).scalars())
+
+        def clean(row):
+            record = dict(
+                name=_required(row, "name"),
+                address=_required(row, "address"),
+                city_code=_required(row, "city_code"),
+                description=_optional(row, "description"),
+                url=_optional(row, "url"),
+                image_url=_optional(row, "image_url", DEFAULT_CAFE_IMG_URL),
+            )
+            if record["city_code"] not in city_codes:
+                raise RowError(f"unknown city_code {record['city_code']!r}")
+            return record
+
+        def touched(keys):
+            return select(Cafe.id).where(
+                tuple_(Cafe.name, Cafe.address, Cafe.city_code).in_(keys)
+            )
+
+        return self._run(
+            rows, clean, Cafe.__table__, ["name", "address", "city_code"], touched
+        )
+
+
+def index_cafes(conn, query):
+    """Reindex the cafes `query` selects the ids of.
+
+    Core upserts skip the mapper events that keep the search index
+    current, so bulk loads call this for the rows they wrote.
+    """
+
+    backend = search.backend_for(conn)
+    if backend:
+        cafe_ids = conn.execute(query).scalars().all()
+        if cafe_ids:
+            backend.index(conn, cafe_ids)
+
+
+def upsert(conn, table, records, keys):
+    """Insert `records` into `table`, updating rows whose `keys` match."""
+
+    if conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg2":
+        return _copy_upsert(conn, table, records, keys)
+
+    stmt = _dialect_insert(conn)(table)
+    columns = list(records[0])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={col: stmt.excluded[col] for col in columns if col not in keys},
+    )
+    conn.execute(stmt, records)
+
+
+def _copy_upsert(conn, table, records, keys):
+    """COPY a chunk into a temp table, then upsert it in one statement.
+
+    There's a temp table per column list, kept for the session and
+    emptied on commit, so a later call with other columns gets its own.
+    """
+
+    columns = list(records[0])
+    column_list = ", ".join(columns)
+    updates = ", ".join(f"{col} = excluded.{col}" for col in columns if col not in keys)
+    staging = f"import_{table.name}_{sha1(column_list.encode()).hexdigest()[:8]}"
+
+    conn.execute(
+        text(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} "
+            f"ON COMMIT DELETE ROWS "
+            f"AS SELECT {column_list} FROM {table.name} WITH NO DATA"
+        )
+    )
+
+    buf = io.StringIO()
+    for record in records:
+        buf.write(",".join(_copy_field(record[col]) for col in columns))
+        buf.write("\n")
+    buf.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+        buf,
+    )
+
+    conn.execute(
+        text(
+            f"INSERT INTO {table.name} ({column_list}) "
+            f"SELECT {column_list} FROM {staging} "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}"
+        )
+    )
+    note_write(conn, table)
+
+
+def _copy_field(value):
+    """`value` as a field of COPY's CSV format.
+
+    COPY reads an unquoted empty field as NULL, so None is written that
+    way and every string, even "", is quoted.
+    """
+
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+def import_file(kind, stream, fmt, chunk_size=CHUNK_SIZE):
+    """Import `kind` ("cities" or "cafes") from an open text stream."""
+
+    importer = Importer(db.engine, chunk_size=chunk_size)
+    rows = read_rows(stream, fmt)
+    if kind == "cities":
+        return importer.import_cities(rows)
+    return importer.import_cafes(rows)
@@ -0,0 +1,308 @@
+"""Per-request SQL instrumentation and Prometheus metrics.
+
+`init_metrics(app)` times every request and every SQL statement it runs.
+Each response gets a `Server-Timing` header (total app time, DB time and
+query count, visible in browser dev tools), and per-endpoint histograms of
+request latency, DB time and queries per request are served at /metrics in
+the Prometheus text format.
+
+The hooks only read a clock and bump a few numbers, so they're cheap enough
+to leave on in production; set METRICS_ENABLED = False to turn them off.
+
+/metrics shows traffic and SQL timing per endpoint, so it's a 404 unless
+the client's address is in METRICS_ALLOWED_IPS (addresses or networks, e.g.
+"10.0.0.0/8") or it sends `Authorization: Bearer <METRICS_TOKEN>`. Neither
+is set by default outside development.
+
+The numbers live in the memory of the process that served the request, so
+under a server with several worker processes /metrics shows only the one
+worker that answered the scrape. Scrape each worker on its own port, or run
+a single process per instance, to see the whole picture.
+"""
+
+import hmac
+import ipaddress
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import compression
+from models import city_cache
+from throttle import login_throttle
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """A Prometheus histogram with one series per label value."""
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = defaultdict(lambda: [[0] * len(self.buckets), 0, 0])
+        self._lock = Lock()
+
+    def observe(self, label_value, value):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series[label_value]
+            if idx < len(self.buckets):
+                series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+
+        for label_value, (counts, total, count) in sorted(series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{{{label},le="{bound}"}}', cumulative
+            yield f'{self.name}_bucket{{{label},le="+Inf"}}', count
+            yield f"{self.name}_sum{{{label}}}", total
+            yield f"{self.name}_count{{{label}}}", count
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        lines.extend(f"{name} {_number(value)}" for name, value in self.samples())
+        return lines
+
+
+class Counters:
+    """A named group of counters read from a callable at scrape time.
+
+    `read` returns a mapping of label value -> count, so existing tallies
+    (e.g. the login throttle's) can be exported without double bookkeeping.
+    """
+
+    def __init__(self, name, help, label, read):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.read = read
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self.read().items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            lines.append(f"{self.name}{{{label}}} {_number(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+request_latency = registry.add(
+    Histogram(
+        "flaskcafe_request_duration_seconds",
+        "Time spent handling requests, by endpoint.",
+        "endpoint",
+        LATENCY_BUCKETS,
+    )
+)
+db_time = registry.add(
+    Histogram(
+        "flaskcafe_request_db_seconds",
+        "Time spent running SQL per request, by endpoint.",
+        "endpoint",
+        LATENCY_BUCKETS,
+    )
+)
+db_queries = registry.add(
+    Histogram(
+        "flaskcafe_request_db_queries",
+        "SQL statements run per request, by endpoint.",
+        "endpoint",
+        QUERY_COUNT_BUCKETS,
+    )
+)
+registry.add(
+    Counters(
+        "flaskcafe_login_attempts_total",
+        "Login attempts, by throttle outcome.",
+        "outcome",
+        lambda: login_throttle.counters,
+    )
+)
+registry.add(
+    Counters(
+        "flaskcafe_city_cache_lookups_total",
+        "City cache lookups, by result.",
+        "result",
+        lambda: {"hit": city_cache.hits, "miss": city_cache.misses},
+    )
+)
+registry.add(
+    Counters(
+        "flaskcafe_compressed_responses_total",
+        "Responses compressed, by encoding.",
+        "encoding",
+        lambda: compression.stats.responses,
+    )
+)
+registry.add(
+    Counters(
+        "flaskcafe_compression_saved_bytes_total",
+        "Bytes compression took off response bodies, by encoding.",
+        "encoding",
+        lambda: compression.stats.bytes_saved,
+    )
+)
+
+
+#######################################
+# SQLAlchemy hooks
+
+
+# The start time goes on the statement's execution context rather than the
+# connection, so a statement that raises (and never reaches
+# after_cursor_execute) can't leave it behind on a pooled connection.
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    context._flaskcafe_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    _record_statement(context)
+
+
+def _handle_error(exception_context):
+    # a failed statement still took database time
+    context = exception_context.execution_context
+    if context is not None:
+        _record_statement(context)
+
+
+def _record_statement(context):
+    start = context.__dict__.pop("_flaskcafe_start", None)
+    if start is None:
+        return
+
+    elapsed = time.perf_counter() - start
+    if has_request_context():
+        stats = g.get("sql_stats")
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def _listen_to_engines():
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+
+#######################################
+# Flask hooks
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.sql_stats = [0, 0.0]
+
+
+def _finish_request(response):
+    start = g.pop("request_start", None)
+    stats = g.pop("sql_stats", None)
+    if start is None or stats is None:
+        return response
+
+    elapsed = time.perf_counter() - start
+    queries, sql_time = stats
+    endpoint = request.endpoint or "none"
+
+    request_latency.observe(endpoint, elapsed)
+    db_time.observe(endpoint, sql_time)
+    db_queries.observe(endpoint, queries)
+
+    response.headers.add(
+        "Server-Timing",
+        f'db;dur={sql_time * 1000:.2f};desc="{queries} queries", '
+        f"app;dur={elapsed * 1000:.2f}",
+    )
+    return response
+
+
+def _may_scrape():
+    config = current_app.config
+    token = config.get("METRICS_TOKEN")
+    if token and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        return True
+
+    try:
+        client = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return False
+    return any(
+        client in ipaddress.ip_network(allowed, strict=False)
+        for allowed in config.get("METRICS_ALLOWED_IPS", ())
+    )
+
+
+def metrics_view():
+    """Serve this process's metrics in the Prometheus text format."""
+
+    if not _may_scrape():
+        abort(404)
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_metrics(app):
+    """Instrument `app` and serve its metrics at /metrics."""
+
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+
+    _listen_to_engines()
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
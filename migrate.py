@@ -0,0 +1,57 @@
+"""Schema migrations for Flask Cafe, with Alembic.
+
+The revisions live in migrations/versions. Run them from the project
+directory with the Alembic CLI, against the database of the app's config
+(FLASK_CONFIG / DATABASE_URL):
+
+    alembic upgrade head
+    alembic revision --autogenerate -m "add cafes.phone"
+
+A database the original app created with `db.create_all()` -- just users,
+cities and cafes -- has the schema of the first revision; mark it as such
+once, then upgrade to add everything since:
+
+    alembic stamp 0001
+    alembic upgrade head
+
+One created with `db.create_all()` by this version of the app already has
+the whole schema: `alembic stamp head` instead. Stamping a database with a
+revision it doesn't match makes later upgrades skip or repeat changes.
+
+The full-text search side table (see search.py) is created and filled by
+revision 0002 but is left out of autogenerate, which can't describe it.
+"""
+
+import os
+
+from alembic import command
+from alembic.config import Config
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+
+def alembic_config(connection=None):
+    """Return the Alembic config, set to use `connection` if given."""
+
+    config = Config(ALEMBIC_INI)
+    if connection is not None:
+        config.attributes["connection"] = connection
+    return config
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    """Leave the search side table (and FTS5's shadow tables) alone."""
+
+    return not (type_ == "table" and name.startswith("cafe_search"))
+
+
+def upgrade(connection, revision="head"):
+    """Migrate the database behind `connection` to `revision`."""
+
+    command.upgrade(alembic_config(connection), revision)
+
+
+def downgrade(connection, revision):
+    """Migrate the database behind `connection` back to `revision`."""
+
+    command.downgrade(alembic_config(connection), revision)
@@ -0,0 +1,63 @@
+"""Alembic environment for Flask Cafe; see migrate.py."""
+
+from logging.config import fileConfig
+
+from alembic import context
+
+from migrate import include_object
+from models import db
+
+config = context.config
+target_metadata = db.metadata
+
+
+def configure(**kwargs):
+    context.configure(
+        target_metadata=target_metadata,
+        include_object=include_object,
+        # SQLite can only change most things by copying the table
+        render_as_batch=True,
+        **kwargs,
+    )
+
+
+def run_migrations_offline():
+    """Write the migrations out as SQL (`alembic upgrade head --sql`)."""
+
+    configure(url=app_database_url(), literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        # called from migrate.upgrade() etc.: the caller owns the connection
+        configure(connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
+    from app import create_app
+
+    app = create_app()
+    with app.app_context(), db.engine.connect() as connection:
+        configure(connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+def app_database_url():
+    from app import create_app
+
+    return create_app().config["SQLALCHEMY_DATABASE_URI"]
+
+
+if config.attributes.get("connection") is None and config.config_file_name:
+    # only from the command line; this would reset the app's loggers
+    fileConfig(config.config_file_name)
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,59 @@
+"""The schema as db.create_all() built it before migrations.
+
+That is the original app's users, cities and cafes; everything added to
+it since is in later revisions.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "cities",
+        sa.Column("code", sa.Text(), nullable=False),
+        sa.Column("name", sa.Text(), nullable=False),
+        sa.Column("state", sa.String(length=2), nullable=False),
+        sa.PrimaryKeyConstraint("code"),
+    )
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("username", sa.String(length=25), nullable=False),
+        sa.Column("admin", sa.Boolean(), nullable=False),
+        sa.Column("email", sa.String(length=50), nullable=False),
+        sa.Column("first_name", sa.String(length=25), nullable=False),
+        sa.Column("last_name", sa.String(length=25), nullable=False),
+        sa.Column("description", sa.Text(), nullable=False),
+        sa.Column("image_url", sa.Text(), nullable=False),
+        sa.Column("password", sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("username"),
+    )
+    op.create_table(
+        "cafes",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.Text(), nullable=False),
+        sa.Column("description", sa.Text(), nullable=False),
+        sa.Column("url", sa.Text(), nullable=False),
+        sa.Column("address", sa.Text(), nullable=False),
+        sa.Column("city_code", sa.Text(), nullable=False),
+        sa.Column("image_url", sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(["city_code"], ["cities.code"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("cafes")
+    op.drop_table("users")
+    op.drop_table("cities")
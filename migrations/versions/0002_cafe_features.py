@@ -0,0 +1,121 @@
+"""What the app added to the original schema before migrations.
+
+- cities.updated_at and cafes.updated_at, for conditional GETs; existing
+  rows are stamped with the time of the migration.
+- The (name, address, city_code) natural key bulk imports upsert on.
+- Likes, and the denormalized cafes.like_count they're counted in.
+- Cafe coordinates and the grid cell /cafes/nearby looks them up by.
+- The full-text search side table (see search.py), filled from the
+  existing cafes. Its DDL is spelled out here, as search.py had it at this
+  revision, so later changes to search.py don't change what this does.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+SEARCH_TABLE = {
+    "postgresql": [
+        """
+        CREATE TABLE cafe_search (
+            cafe_id INTEGER PRIMARY KEY
+                REFERENCES cafes (id) ON DELETE CASCADE,
+            document TSVECTOR NOT NULL
+        )
+        """,
+        """
+        CREATE INDEX ix_cafe_search_document
+            ON cafe_search USING GIN (document)
+        """,
+        """
+        INSERT INTO cafe_search (cafe_id, document)
+        SELECT c.id,
+            setweight(to_tsvector('english', c.name), 'A')
+            || setweight(to_tsvector('english', ci.name), 'B')
+            || setweight(to_tsvector('english', c.address), 'C')
+            || setweight(to_tsvector('english', c.description), 'D')
+        FROM cafes c JOIN cities ci ON ci.code = c.city_code
+        """,
+    ],
+    "sqlite": [
+        """
+        CREATE VIRTUAL TABLE cafe_search USING fts5(
+            name, city, address, description,
+            tokenize = 'porter unicode61'
+        )
+        """,
+        """
+        INSERT INTO cafe_search (rowid, name, city, address, description)
+        SELECT c.id, c.name, ci.name, c.address, c.description
+        FROM cafes c JOIN cities ci ON ci.code = c.city_code
+        """,
+    ],
+}
+
+
+def upgrade():
+    for table in ("cities", "cafes"):
+        # the default only fills in the existing rows; the app sets it
+        with op.batch_alter_table(table) as batch:
+            batch.add_column(
+                sa.Column(
+                    "updated_at",
+                    sa.DateTime(),
+                    server_default=sa.text("CURRENT_TIMESTAMP"),
+                    nullable=False,
+                )
+            )
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column("updated_at", server_default=None)
+
+    with op.batch_alter_table("cafes") as batch:
+        batch.add_column(sa.Column("latitude", sa.Float(), nullable=True))
+        batch.add_column(sa.Column("longitude", sa.Float(), nullable=True))
+        batch.add_column(sa.Column("geo_cell", sa.Integer(), nullable=True))
+        batch.add_column(
+            sa.Column("like_count", sa.Integer(), server_default="0", nullable=False)
+        )
+        batch.create_unique_constraint(
+            "uq_cafes_name_address_city", ["name", "address", "city_code"]
+        )
+    op.create_index("ix_cafes_like_count_id", "cafes", ["like_count", "id"])
+    op.create_index("ix_cafes_geo_cell", "cafes", ["geo_cell"])
+    op.create_index("ix_cafes_updated_at", "cafes", ["updated_at"])
+
+    op.create_table(
+        "likes",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("cafe_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["cafe_id"], ["cafes.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id", "cafe_id"),
+    )
+
+    for statement in SEARCH_TABLE.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS cafe_search")
+
+    op.drop_table("likes")
+    op.drop_index("ix_cafes_updated_at", table_name="cafes")
+    op.drop_index("ix_cafes_geo_cell", table_name="cafes")
+    op.drop_index("ix_cafes_like_count_id", table_name="cafes")
+    with op.batch_alter_table("cafes") as batch:
+        batch.drop_constraint("uq_cafes_name_address_city", type_="unique")
+        batch.drop_column("like_count")
+        batch.drop_column("geo_cell")
+        batch.drop_column("longitude")
+        batch.drop_column("latitude")
+        batch.drop_column("updated_at")
+    with op.batch_alter_table("cities") as batch:
+        batch.drop_column("updated_at")
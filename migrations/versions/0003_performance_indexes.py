@@ -0,0 +1,32 @@
+"""Indexes for the cafe list orders, the city filter and likes by cafe.
+
+- ix_cafes_name_id serves ?order=name and -name (scanned backwards)
+  without sorting the table.
+- ix_cafes_city_code_name_id does the same within one city (?city=),
+  and serves any lookup by city_code.
+- ix_likes_cafe_id: the primary key leads with user_id, so recounting a
+  cafe's likes or cascading a cafe's delete would scan every like.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_cafes_name_id", "cafes", ["name", "id"])
+    op.create_index("ix_cafes_city_code_name_id", "cafes", ["city_code", "name", "id"])
+    op.create_index("ix_likes_cafe_id", "likes", ["cafe_id"])
+
+
+def downgrade():
+    op.drop_index("ix_likes_cafe_id", table_name="likes")
+    op.drop_index("ix_cafes_city_code_name_id", table_name="cafes")
+    op.drop_index("ix_cafes_name_id", table_name="cafes")
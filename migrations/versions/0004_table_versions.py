@@ -0,0 +1,33 @@
+"""A change counter per table, for cheap ETags and cache checks.
+
+Each table's counter is split over shards: writers bump one shard at
+random, so concurrent writes to a table don't queue on one row lock, and
+readers add the shards up.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "table_versions",
+        sa.Column("name", sa.Text(), nullable=False),
+        sa.Column("shard", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column("changed_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("name", "shard"),
+    )
+
+
+def downgrade():
+    op.drop_table("table_versions")
@@ -1,14 +1,29 @@
 """Data models for Flask Cafe"""
 
+import random
+from datetime import datetime
+from threading import Lock
+from time import monotonic
 
-from flask_bcrypt import Bcrypt
+from flask import current_app, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Table, event, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import UpdateBase
 
+import geo
+import search
+from bloom import BloomFilter
+from hashing import PasswordHasher
+from replicas import RoutingSession
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+
+password_hasher = PasswordHasher()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 DEFAULT_IMG_URL = "/static/images/default-pic.png"
+DEFAULT_CAFE_IMG_URL = "/static/images/default-cafe.jpg"
 
 
 class User(db.Model):
@@ -16,6 +31,9 @@ class User(db.Model):
 
     __tablename__ = "users"
 
+    # writes are counted in table_versions; see TableVersion
+    __table_args__ = {"info": {"versioned": True}}
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     username = db.Column(db.String(25), nullable=False, unique=True)
@@ -50,6 +68,12 @@ class User(db.Model):
 
     password = db.Column(db.Text, nullable=False)
 
+    # viewonly: likes are written through like()/unlike(), which keep
+    # Cafe.like_count in step
+    liked_cafes = db.relationship(
+        "Cafe", secondary="likes", viewonly=True, order_by="Cafe.name"
+    )
+
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
 
@@ -67,10 +91,11 @@ class User(db.Model):
     ):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Raises HashingBusy if
+        the hashing pool is saturated.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode("UTF-8")
+        hashed_pwd = password_hasher.hash(password)
         user = User(
             username=username,
             password=hashed_pwd,
@@ -84,6 +109,20 @@ class User(db.Model):
         db.session.add(user)
         return user
 
+    @classmethod
+    def username_taken(cls, username):
+        """Is `username` already in use? Never hashes anything.
+
+        Names the Bloom filter has never seen are answered without a query;
+        everything else is checked against the (unique, indexed) column.
+        """
+
+        if not username_index.might_exist(username):
+            return False
+
+        query = cls.query.filter_by(username=username)
+        return db.session.query(query.exists()).scalar()
+
     @classmethod
     def authenticate(cls, username, password):
         """Find user with `username` and `password`.
@@ -94,23 +133,137 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with a different bcrypt cost than the
+        one configured, it's replaced with a fresh hash (the caller commits).
+        Raises HashingBusy if the hashing pool is saturated.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
 
+    def has_liked(self, cafe_id):
+        """Does this user like the cafe with id `cafe_id`?"""
+
+        query = Like.query.filter_by(user_id=self.id, cafe_id=cafe_id)
+        return db.session.query(query.exists()).scalar()
+
+    def like(self, cafe_id):
+        """Like a cafe; returns False if the user already liked it.
+
+        The like and the cafe's like_count go in with two statements in the
+        caller's transaction (the caller commits), so the counter can't
+        drift from the likes table and concurrent likes never lose updates.
+        """
+
+        conn = db.session.connection()
+        stmt = (
+            _dialect_insert(conn)(Like.__table__)
+            .values(
+                user_id=self.id,
+                cafe_id=cafe_id,
+            )
+            .on_conflict_do_nothing()
+        )
+        if not conn.execute(stmt).rowcount:
+            return False
+
+        _bump_like_count(conn, cafe_id, 1)
+        return True
+
+    def unlike(self, cafe_id):
+        """Un-like a cafe; returns False if the user didn't like it."""
+
+        conn = db.session.connection()
+        stmt = Like.__table__.delete().where(
+            Like.user_id == self.id, Like.cafe_id == cafe_id
+        )
+        if not conn.execute(stmt).rowcount:
+            return False
+
+        _bump_like_count(conn, cafe_id, -1)
+        return True
+
+
+class UsernameIndex:
+    """A Bloom filter of every username, held by each process.
+
+    Built from the users table on first use and fed new usernames as this
+    process commits them. Names other processes commit only show up when
+    the filter is rebuilt, every USERNAME_FILTER_MAX_AGE seconds (default
+    300); until then this process can call such a name free, and a signup
+    with it fails at commit on the unique column instead. A name the filter
+    might contain is looked up in the table (see User.username_taken), so
+    false positives only cost a query. The filter is built bigger once it
+    outgrows its capacity.
+    """
+
+    def __init__(self, capacity=100_000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # (bloom filter, monotonic time it was built at)
+        self._filter = None
+        self._lock = Lock()
+
+    def _stale(self, state):
+        max_age = current_app.config.get("USERNAME_FILTER_MAX_AGE", 300)
+        return state is None or monotonic() - state[1] > max_age
+
+    def _build(self):
+        built_at = monotonic()
+        query = select(User.username).execution_options(yield_per=10_000)
+        with db.engine.connect() as conn:
+            usernames = conn.execute(query).scalars().all()
+
+        while len(usernames) * 2 > self.capacity:
+            self.capacity *= 2
+
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        for username in usernames:
+            bloom.add(username)
+        return bloom, built_at
+
+    def might_exist(self, username):
+        state = self._filter
+        if self._stale(state):
+            with self._lock:
+                state = self._filter
+                if self._stale(state):
+                    state = self._filter = self._build()
+        return username in state[0]
+
+    def add(self, username):
+        state = self._filter
+        if state is None:
+            return
+        if state[0].count >= self.capacity:
+            self._filter = None
+        else:
+            state[0].add(username)
+
+    def invalidate(self):
+        self._filter = None
+
+
+username_index = UsernameIndex()
+
 
 class City(db.Model):
     """Cities for cafes."""
 
     __tablename__ = "cities"
 
+    # writes are counted in table_versions; see TableVersion
+    __table_args__ = {"info": {"versioned": True}}
+
     code = db.Column(
         db.Text,
         primary_key=True,
@@ -126,12 +279,33 @@ class City(db.Model):
         nullable=False,
     )
 
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
 
 class Cafe(db.Model):
     """Cafe information."""
 
     __tablename__ = "cafes"
 
+    # the natural key bulk imports upsert on
+    __table_args__ = (
+        db.UniqueConstraint(
+            "name", "address", "city_code", name="uq_cafes_name_address_city"
+        ),
+        # serves ?order=-like_count (scanned backwards) without a sort
+        db.Index("ix_cafes_like_count_id", "like_count", "id"),
+        # ?order=name, in one city or across all of them
+        db.Index("ix_cafes_name_id", "name", "id"),
+        db.Index("ix_cafes_city_code_name_id", "city_code", "name", "id"),
+        db.Index("ix_cafes_geo_cell", "geo_cell"),
+        {"info": {"versioned": True}},
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -166,7 +340,30 @@ class Cafe(db.Model):
     image_url = db.Column(
         db.Text,
         nullable=False,
-        default="/static/images/default-cafe.jpg",
+        default=DEFAULT_CAFE_IMG_URL,
+    )
+
+    latitude = db.Column(db.Float)
+
+    longitude = db.Column(db.Float)
+
+    # grid cell of (latitude, longitude), set on flush; see geo.py
+    geo_cell = db.Column(db.Integer)
+
+    # denormalized count of likes; see User.like() and recount_likes()
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        index=True,
     )
 
     city = db.relationship("City", backref="cafes")
@@ -177,16 +374,435 @@ class Cafe(db.Model):
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = city_cache.get(self.city_code) or self.city
         return f"{city.name}, {city.state}"
 
+    @classmethod
+    def search(cls, q, limit, offset=0, session=None):
+        """Full-text search cafes by name, city, address and description.
+
+        Returns a list of (cafe, rank) pairs, best match first. Queries go
+        through `session` if given (e.g. an async session's sync_session,
+        via run_sync), else db.session.
+        """
+
+        session = session or db.session
+        terms = search.search_terms(q)
+        conn = session.connection()
+        backend = search.backend_for(conn)
+        if not terms or backend is None:
+            return []
+
+        ranks = dict(backend.search(conn, terms, limit, offset))
+        cafes = session.query(cls).filter(cls.id.in_(ranks)).all()
+        cafes.sort(key=lambda cafe: (-ranks[cafe.id], cafe.id))
+        return [(cafe, ranks[cafe.id]) for cafe in cafes]
+
+    @classmethod
+    def nearby(cls, lat, lng, radius_km, limit):
+        """Find cafes within `radius_km` of (lat, lng).
+
+        Returns a list of (cafe, distance in km) pairs, nearest first. The
+        database narrows the search to the grid cells and bounding box
+        around the circle; only those candidates get an exact distance.
+        """
+
+        min_lat, max_lat, lng_ranges = geo.bounding_box(lat, lng, radius_km)
+        candidates = cls.query.filter(
+            cls.geo_cell.in_(geo.cells_for(min_lat, max_lat, lng_ranges)),
+            cls.latitude.between(min_lat, max_lat),
+            db.or_(
+                *(
+                    cls.longitude.between(min_lng, max_lng)
+                    for min_lng, max_lng in lng_ranges
+                )
+            ),
+        )
+
+        results = []
+        for cafe in candidates:
+            distance = geo.distance_km(lat, lng, cafe.latitude, cafe.longitude)
+            if distance <= radius_km:
+                results.append((cafe, distance))
+
+        results.sort(key=lambda pair: (pair[1], pair[0].id))
+        return results[:limit]
+
+    def geocode(self, geocoder):
+        """Locate this cafe from its address; returns False if unknown."""
+
+        city = city_cache.get(self.city_code) or self.city
+        location = geocoder.geocode(f"{self.address}, {city.name}, {city.state}")
+        if location is None:
+            return False
+
+        self.latitude, self.longitude = location
+        return True
+
+
+@event.listens_for(Cafe, "before_insert")
+@event.listens_for(Cafe, "before_update")
+def _set_geo_cell(mapper, connection, target):
+    if target.latitude is None or target.longitude is None:
+        target.geo_cell = None
+    else:
+        target.geo_cell = geo.grid_cell(target.latitude, target.longitude)
+
+
+class Like(db.Model):
+    """A user liking a cafe."""
+
+    __tablename__ = "likes"
+
+    # the primary key leads with user_id; recounts and cascades from a
+    # deleted cafe look likes up by cafe
+    __table_args__ = (
+        db.Index("ix_likes_cafe_id", "cafe_id"),
+        {"info": {"versioned": True}},
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    cafe_id = db.Column(
+        db.Integer,
+        db.ForeignKey("cafes.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+
+class TableVersion(db.Model):
+    """A change counter for a table, bumped by every write to it.
+
+    Tells readers whether a table has changed -- for the generic views'
+    ETags, and for caches held by each process -- with a primary key
+    lookup instead of an aggregate over the table. Tables opt in with
+    `info={"versioned": True}`; Core and ORM writes to them are counted
+    automatically (see `_count_write`), and anything else writing to them,
+    like raw SQL, must call `note_write()`.
+
+    Each table's counter is split over VERSION_SHARDS rows and a write
+    bumps one of them at random, so concurrent writers rarely wait on each
+    other's row lock; readers add the shards up.
+    """
+
+    __tablename__ = "table_versions"
+
+    name = db.Column(db.Text, primary_key=True)
+
+    shard = db.Column(db.Integer, primary_key=True, server_default="0")
+
+    version = db.Column(db.Integer, nullable=False)
+
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+
+VERSION_SHARDS = 16
+
+
+def versions_query(names):
+    """SELECT the (name, version, changed_at) rows for these tables."""
+
+    versions = TableVersion.__table__
+    return (
+        select(
+            versions.c.name,
+            func.sum(versions.c.version).label("version"),
+            func.max(versions.c.changed_at).label("changed_at"),
+        )
+        .where(versions.c.name.in_(names))
+        .group_by(versions.c.name)
+    )
+
+
+def seen_versions():
+    """The table versions read so far in this request, by table name.
+
+    The generic views record the versions they read for their ETags, and
+    CityCache checks against the same ones rather than querying again.
+    Outside a request nothing is kept, so every check queries.
+    """
+
+    if not has_request_context():
+        return {}
+    return request.environ.setdefault("flaskcafe.table_versions", {})
+
+
+def current_version(name):
+    """The version of table `name`, read at most once per request."""
+
+    seen = seen_versions()
+    if name not in seen:
+        with db.engine.connect() as conn:
+            row = conn.execute(versions_query([name])).first()
+        seen[name] = row.version if row else 0
+    return seen[name]
+
+
+def note_write(conn, table):
+    """Bump `table`'s version, once per transaction on `conn`."""
+
+    if not table.info.get("versioned"):
+        return
+
+    # keyed on the innermost transaction, so a rolled back savepoint
+    # doesn't hide later writes
+    transaction = conn.get_nested_transaction() or conn.get_transaction()
+    noted = conn.info.get("versions_noted")
+    if noted is None or noted[0] is not transaction:
+        noted = conn.info["versions_noted"] = (transaction, set())
+    if transaction is not None and table.name in noted[1]:
+        return
+    noted[1].add(table.name)
+
+    versions = TableVersion.__table__
+    now = datetime.utcnow()
+    stmt = _dialect_insert(conn)(versions).values(
+        name=table.name,
+        shard=random.randrange(VERSION_SHARDS),
+        version=1,
+        changed_at=now,
+    )
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["name", "shard"],
+            set_={"version": versions.c.version + 1, "changed_at": now},
+        )
+    )
+
+
+@event.listens_for(Engine, "after_execute")
+def _count_write(conn, clauseelement, multiparams, params, options, result):
+    if isinstance(clauseelement, UpdateBase) and isinstance(clauseelement.table, Table):
+        note_write(conn, clauseelement.table)
+
+
+def _dialect_insert(conn):
+    return {
+        "postgresql": postgresql.insert,
+        "sqlite": sqlite.insert,
+    }[conn.dialect.name]
+
+
+def _bump_like_count(conn, cafe_id, delta):
+    cafes = Cafe.__table__
+    conn.execute(
+        cafes.update()
+        .where(cafes.c.id == cafe_id)
+        .values(like_count=cafes.c.like_count + delta)
+    )
+
+
+def recount_likes(conn, cafe_ids=None):
+    """Recompute like_count from the likes table in one UPDATE.
+
+    For repairs and for changes that bypass User.like()/unlike(), such as
+    deleting users. Pass `cafe_ids` to recount only those cafes.
+    """
+
+    cafes = Cafe.__table__
+    likes = Like.__table__
+    count = select(func.count()).where(likes.c.cafe_id == cafes.c.id).scalar_subquery()
+    stmt = cafes.update().values(like_count=count)
+    if cafe_ids is not None:
+        stmt = stmt.where(cafes.c.id.in_(cafe_ids))
+    conn.execute(stmt)
+
+
+#######################################
+# keep like counts in step with deleted users and cafes
+
+
+@event.listens_for(User, "before_delete")
+def _drop_user_likes(mapper, connection, target):
+    likes = Like.__table__
+    cafe_ids = select(likes.c.cafe_id).where(likes.c.user_id == target.id)
+    cafes = Cafe.__table__
+    connection.execute(
+        cafes.update()
+        .where(cafes.c.id.in_(cafe_ids))
+        .values(like_count=cafes.c.like_count - 1)
+    )
+    connection.execute(likes.delete().where(likes.c.user_id == target.id))
+
+
+@event.listens_for(Cafe, "before_delete")
+def _drop_cafe_likes(mapper, connection, target):
+    likes = Like.__table__
+    connection.execute(likes.delete().where(likes.c.cafe_id == target.id))
+
+
+@event.listens_for(db.session, "after_bulk_delete")
+def _prune_likes(delete_context):
+    # bulk deletes skip the mapper events above (and SQLite doesn't
+    # cascade), so drop orphaned likes and recount the cafes they touched
+    model = delete_context.mapper.class_
+    if model not in (User, Cafe):
+        return
+
+    likes = Like.__table__
+    parent = model.__table__
+    column = likes.c.user_id if model is User else likes.c.cafe_id
+    orphaned = ~column.in_(select(parent.c.id))
+
+    conn = delete_context.session.connection()
+    cafe_ids = (
+        conn.execute(select(likes.c.cafe_id).where(orphaned).distinct()).scalars().all()
+    )
+    conn.execute(likes.delete().where(orphaned))
+    if model is User and cafe_ids:
+        recount_likes(conn, cafe_ids)
+
+
+#######################################
+# keep the search index in step with cafes and cities
+
+
+@event.listens_for(Cafe.__table__, "after_create")
+def _create_search_index(target, connection, **kw):
+    backend = search.backend_for(connection)
+    if backend:
+        backend.create(connection)
+
+
+@event.listens_for(Cafe.__table__, "before_drop")
+def _drop_search_index(target, connection, **kw):
+    backend = search.backend_for(connection)
+    if backend:
+        backend.drop(connection)
+
+
+@event.listens_for(Cafe, "after_insert")
+@event.listens_for(Cafe, "after_update")
+def _index_cafe(mapper, connection, target):
+    backend = search.backend_for(connection)
+    if backend:
+        backend.index(connection, [target.id])
+
+
+@event.listens_for(Cafe, "after_delete")
+def _unindex_cafe(mapper, connection, target):
+    backend = search.backend_for(connection)
+    if backend:
+        backend.remove(connection, [target.id])
+
+
+@event.listens_for(City, "after_update")
+def _reindex_city(mapper, connection, target):
+    backend = search.backend_for(connection)
+    if backend and db.inspect(target).attrs.name.history.has_changes():
+        backend.index_city(connection, target.code)
+
+
+@event.listens_for(db.session, "after_bulk_delete")
+def _prune_search_index(delete_context):
+    if delete_context.mapper.class_ is Cafe:
+        conn = delete_context.session.connection()
+        backend = search.backend_for(conn)
+        if backend:
+            backend.prune(conn)
+
+
+class CityCache:
+    """Process-local read-through cache of the (small, rarely changing)
+    cities table.
+
+    The whole table is read on the first lookup, along with the cities
+    TableVersion it was read at. A commit in this process that touched a
+    City drops it at once (see the session events below). Other writes --
+    Core statements, other processes -- are caught by the first lookup in
+    each request, which reloads the table if its version has moved since.
+    """
+
+    def __init__(self):
+        self._cached = None
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        # Read through our own connection so rows that are still pending in
+        # the caller's session can never end up in the cache. The version
+        # comes first: a write in between only makes the rows newer.
+        version = current_version("cities")
+        query = select(City.code, City.name, City.state).order_by(City.name)
+        with db.engine.connect() as conn:
+            cities = {row.code: row for row in conn.execute(query)}
+        return version, cities
+
+    def all(self):
+        """Return a dict of code -> row (with .code, .name and .state)."""
+
+        cached = self._cached
+        # (a lagging replica can report an older version than the cache's)
+        if cached is not None and current_version("cities") <= cached[0]:
+            self.hits += 1
+            return cached[1]
+
+        with self._lock:
+            if self._cached is cached:
+                self.misses += 1
+                self._cached = self._load()
+            return self._cached[1]
+
+    def get(self, code):
+        return self.all().get(code)
+
+    def choices(self):
+        """Return (code, name) pairs for a select field."""
+
+        return [(city.code, city.name) for city in self.all().values()]
+
+    def invalidate(self):
+        self._cached = None
+
+
+city_cache = CityCache()
+
+
+@event.listens_for(db.session, "after_flush")
+def _note_changes(session, flush_context):
+    changed = session.new | session.dirty | session.deleted
+    if any(isinstance(obj, City) for obj in changed):
+        session.info["cities_changed"] = True
+
+    usernames = session.info.setdefault("new_usernames", set())
+    for obj in session.new | session.dirty:
+        if isinstance(obj, User):
+            usernames.add(obj.username)
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _note_bulk_city_changes(orm_execute_state):
+    if (
+        orm_execute_state.is_update or orm_execute_state.is_delete
+    ) and orm_execute_state.bind_mapper is City.__mapper__:
+        orm_execute_state.session.info["cities_changed"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def _apply_committed_changes(session):
+    if session.info.pop("cities_changed", False):
+        city_cache.invalidate()
+
+    for username in session.info.pop("new_usernames", ()):
+        username_index.add(username)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_changes(session):
+    session.info.pop("cities_changed", None)
+    session.info.pop("new_usernames", None)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Nothing is pushed or connected
+    here; use `app.app_context()` for work outside a request.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
@@ -0,0 +1,237 @@
+"""Keyset (seek) pagination helpers for Flask Cafe."""
+
+import base64
+import binascii
+import json
+from datetime import date, datetime
+
+from sqlalchemy import and_, or_
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+def encode_cursor(values):
+    """Encode a tuple of key values as an opaque, URL-safe cursor."""
+
+    raw = json.dumps(list(values), default=_json_default, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor` back to a list of values."""
+
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+
+    return values
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Can't encode {value!r} in a cursor")
+
+
+class Keyset:
+    """An ordering over `model` that can be paged through by seeking.
+
+    Rows are ordered by `field` and then by the primary key, so every row has
+    a unique position even when `field` has duplicates. `field` must be
+    NOT NULL; NULLs don't compare and would fall out of the seek predicate.
+    """
+
+    def __init__(self, model, field, descending=False):
+        self.model = model
+        self.field = field
+        self.descending = descending
+
+        self.pk = model.__mapper__.primary_key[0]
+        self.columns = [getattr(model, field)]
+        if self.columns[0].key != self.pk.key:
+            self.columns.append(getattr(model, self.pk.key))
+
+    @property
+    def name(self):
+        """The value of `?order=` that selects this keyset."""
+
+        return f"-{self.field}" if self.descending else self.field
+
+    def order_by(self, reverse=False):
+        """Return ORDER BY clauses; `reverse` flips them for paging back."""
+
+        descending = self.descending != reverse
+        return [col.desc() if descending else col.asc() for col in self.columns]
+
+    def seek(self, values, reverse=False):
+        """Return a WHERE clause selecting rows after `values`.
+
+        Written as ``a >= x AND (a > x OR (a = x AND b > y))`` rather
+        than a row-value comparison so that it works on every backend. The
+        redundant ``a >= x`` is what lets the planner seek into a composite
+        index on the ordering columns; without it the OR has SQLite scan
+        the index from the start, so deep pages got slower.
+        """
+
+        if len(values) != len(self.columns):
+            raise InvalidCursor(values)
+
+        values = [_coerce(col, value) for col, value in zip(self.columns, values)]
+        descending = self.descending != reverse
+
+        clauses = []
+        for idx, col in enumerate(self.columns):
+            past = col < values[idx] if descending else col > values[idx]
+            equal = [self.columns[i] == values[i] for i in range(idx)]
+            clauses.append(and_(*equal, past))
+
+        if len(clauses) == 1:
+            return clauses[0]
+
+        first, value = self.columns[0], values[0]
+        bound = first <= value if descending else first >= value
+        return and_(bound, or_(*clauses))
+
+    def cursor_for(self, row):
+        """Return the cursor that points at `row`."""
+
+        return encode_cursor(getattr(row, col.key) for col in self.columns)
+
+
+def _coerce(col, value):
+    """Turn a JSON-decoded cursor value back into the column's Python type."""
+
+    try:
+        python_type = col.type.python_type
+    except NotImplementedError:
+        return value
+
+    if value is None or isinstance(value, python_type):
+        return value
+
+    try:
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is date:
+            return date.fromisoformat(value)
+        return python_type(value)
+    except (TypeError, ValueError) as exc:
+        raise InvalidCursor(value) from exc
+
+
+class Page:
+    """One page of results plus the cursors for its neighbours."""
+
+    def __init__(self, items, keyset, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.keyset = keyset
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StreamedPage:
+    """A forward page that fetches its rows while it's being iterated.
+
+    For streaming a page out as it renders. The cursors, and so
+    `has_next` and `has_prev`, are only final once the rows have all been
+    iterated.
+    """
+
+    def __init__(self, rows, keyset, per_page, after=None):
+        self.rows = rows
+        self.keyset = keyset
+        self.per_page = per_page
+        self.after = after
+        self.next_cursor = None
+        self.prev_cursor = None
+        self.started = False
+
+    has_next = Page.has_next
+    has_prev = Page.has_prev
+
+    def __iter__(self):
+        self.started = True
+        last = None
+        # read the extra row too rather than breaking off, so the
+        # cursor is finished and closed
+        for count, row in enumerate(self.rows):
+            if count == self.per_page:
+                self.next_cursor = self.keyset.cursor_for(last)
+                continue
+            if count == 0 and self.after is not None:
+                self.prev_cursor = self.keyset.cursor_for(row)
+            last = row
+            yield row
+
+
+def paginate(query, keyset, per_page, after=None, before=None):
+    """Fetch the page of `query` after (or before) the given cursor.
+
+    One extra row is fetched to find out whether there is another page in
+    the direction of travel, so no COUNT(*) is ever needed.
+    """
+
+    items = page_query(query, keyset, per_page, after, before).all()
+    return make_page(items, keyset, per_page, after, before)
+
+
+def page_query(query, keyset, per_page, after=None, before=None):
+    """Narrow `query` (a Query or a select()) to one page, plus a row.
+
+    Raises InvalidCursor if the cursor is malformed.
+    """
+
+    reverse = before is not None
+    cursor = before if reverse else after
+
+    query = query.order_by(None).order_by(*keyset.order_by(reverse=reverse))
+    if cursor is not None:
+        query = query.filter(keyset.seek(decode_cursor(cursor), reverse=reverse))
+    return query.limit(per_page + 1)
+
+
+def make_page(items, keyset, per_page, after=None, before=None):
+    """Build the Page from the rows `page_query` returned."""
+
+    reverse = before is not None
+    cursor = before if reverse else after
+
+    has_more = len(items) > per_page
+    items = items[:per_page]
+
+    if reverse:
+        items.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, cursor is not None
+
+    if not items:
+        return Page(items, keyset)
+
+    return Page(
+        items,
+        keyset,
+        next_cursor=keyset.cursor_for(items[-1]) if has_next else None,
+        prev_cursor=keyset.cursor_for(items[0]) if has_prev else None,
+    )
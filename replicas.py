@@ -0,0 +1,163 @@
+"""Read replicas for the read-heavy views.
+
+List the replicas' bind keys in REPLICA_BINDS (their URLs go in
+SQLALCHEMY_BINDS like any other bind, or set DATABASE_REPLICA_URLS; see
+config.py). Views wrapped in `read_from_replica` -- the generic views and
+the JSON API -- send their SELECTs to a replica, each request to the next
+one in turn. Everything else, and every write, goes to the primary.
+
+A replica whose connection fails is ejected for REPLICA_EJECT_SECONDS;
+after that it has to answer a `SELECT 1` before it gets traffic again.
+With every replica out, reads go to the primary.
+
+Replicas lag the primary, so a user who just changed something could read
+the old version back. A request that writes sets a short-lived cookie, and
+for REPLICA_STICKY_SECONDS that browser's requests read from the primary.
+"""
+
+import itertools
+import time
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, exc
+from sqlalchemy.sql.expression import SelectBase, UpdateBase
+
+STICKY_COOKIE = "read_primary"
+
+
+class ReplicaSet:
+    """Round-robin over replica engines, skipping unhealthy ones."""
+
+    def __init__(self, engines, eject_seconds=30):
+        self.engines = list(engines)
+        self.eject_seconds = eject_seconds
+        self._turn = itertools.count()
+        self._ejected = {}
+        self._lock = Lock()
+        for engine in self.engines:
+            event.listen(engine, "handle_error", self._handle_error)
+
+    def _handle_error(self, context):
+        if context.is_disconnect or isinstance(
+            context.sqlalchemy_exception, exc.OperationalError
+        ):
+            self.eject(context.engine)
+
+    def eject(self, engine):
+        with self._lock:
+            self._ejected[engine] = time.monotonic() + self.eject_seconds
+
+    def is_healthy(self, engine):
+        with self._lock:
+            until = self._ejected.get(engine)
+        if until is None:
+            return True
+        if until > time.monotonic():
+            return False
+
+        # time's up: see if it's back (a failure ejects it again)
+        try:
+            with engine.connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+        except exc.DBAPIError:
+            return False
+        with self._lock:
+            self._ejected.pop(engine, None)
+        return True
+
+    def choose(self):
+        """Return the next healthy replica's engine, or None."""
+
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = self.engines[next(self._turn) % len(self.engines)]
+            if self.is_healthy(engine):
+                return engine
+        return None
+
+
+class RoutingSession(Session):
+    """A session that can send reads to a replica.
+
+    Only sessions marked with `info["replica"]` (see `read_from_replica`)
+    use replicas, and only for plain SELECTs until something is written
+    or committed; from then on the session stays on the primary, so it
+    reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+        elif (
+            bind is None
+            and self.info.get("replica")
+            and not self.info.get("wrote")
+            and isinstance(clause, SelectBase)
+            and getattr(clause, "_for_update_arg", None) is None
+        ):
+            # one replica per session, so a page's queries agree
+            if "replica_engine" not in self.info:
+                replicas = current_app.extensions.get("replicas")
+                self.info["replica_engine"] = replicas and replicas.choose()
+            if self.info["replica_engine"] is not None:
+                return self.info["replica_engine"]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        # writes through session.connection() (e.g. User.like) don't pass
+        # through get_bind with a statement, but they are committed
+        if self.in_transaction():
+            self.info["wrote"] = True
+        super().commit()
+
+
+def read_from_replica(view):
+    """Let a view's GET and HEAD requests read from a replica."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if (
+            request.method in ("GET", "HEAD")
+            and STICKY_COOKIE not in request.cookies
+            and "replicas" in current_app.extensions
+        ):
+            current_app.extensions["sqlalchemy"].session.info["replica"] = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _stick_to_primary(response):
+    if not has_request_context():
+        return response
+
+    session = current_app.extensions["sqlalchemy"].session
+    if session.registry.has() and session.info.get("wrote"):
+        response.set_cookie(
+            STICKY_COOKIE,
+            "1",
+            max_age=current_app.config.get("REPLICA_STICKY_SECONDS", 10),
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+def init_replicas(app):
+    """Set up the replicas named in REPLICA_BINDS, if any."""
+
+    keys = app.config.get("REPLICA_BINDS") or ()
+    if not keys:
+        return
+
+    db = app.extensions["sqlalchemy"]
+    with app.app_context():
+        engines = [db.engines[key] for key in keys]
+    app.extensions["replicas"] = ReplicaSet(
+        engines, app.config.get("REPLICA_EJECT_SECONDS", 30)
+    )
+    app.after_request(_stick_to_primary)
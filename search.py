@@ -0,0 +1,223 @@
+"""Full-text search over cafes.
+
+Each backend keeps a side table, `cafe_search`, holding one indexed
+document per cafe (its name, city, address and description). The table is
+created with `cafes` and kept current by the mapper events in models.py.
+"""
+
+import re
+
+from sqlalchemy import bindparam, text
+
+
+class SearchBackend:
+    """A full-text index of cafes for one database dialect."""
+
+    def create(self, conn):
+        raise NotImplementedError
+
+    def drop(self, conn):
+        conn.execute(text("DROP TABLE IF EXISTS cafe_search"))
+
+    def index(self, conn, cafe_ids):
+        """(Re)index the cafes with these ids."""
+
+        raise NotImplementedError
+
+    def index_city(self, conn, city_code):
+        """Reindex every cafe in a city, e.g. after the city is renamed."""
+
+        ids = (
+            conn.execute(
+                text("SELECT id FROM cafes WHERE city_code = :code"),
+                {"code": city_code},
+            )
+            .scalars()
+            .all()
+        )
+        if ids:
+            self.index(conn, ids)
+
+    def remove(self, conn, cafe_ids):
+        raise NotImplementedError
+
+    def prune(self, conn):
+        """Drop documents whose cafe no longer exists."""
+
+        raise NotImplementedError
+
+    def reindex(self, conn):
+        """Rebuild the whole index, e.g. after a bulk load."""
+
+        raise NotImplementedError
+
+    def search(self, conn, terms, limit, offset=0):
+        """Return (cafe_id, rank) pairs, best match first."""
+
+        raise NotImplementedError
+
+
+class PostgresSearch(SearchBackend):
+    """tsvector documents with a GIN index, ranked by ts_rank.
+
+    Name matches weigh most, then the city, address and description.
+    """
+
+    DOCUMENT = """
+        setweight(to_tsvector('english', c.name), 'A')
+        || setweight(to_tsvector('english', ci.name), 'B')
+        || setweight(to_tsvector('english', c.address), 'C')
+        || setweight(to_tsvector('english', c.description), 'D')
+    """
+
+    def create(self, conn):
+        conn.execute(
+            text(
+                """
+            CREATE TABLE IF NOT EXISTS cafe_search (
+                cafe_id INTEGER PRIMARY KEY
+                    REFERENCES cafes (id) ON DELETE CASCADE,
+                document TSVECTOR NOT NULL
+            )
+        """
+            )
+        )
+        conn.execute(
+            text(
+                """
+            CREATE INDEX IF NOT EXISTS ix_cafe_search_document
+                ON cafe_search USING GIN (document)
+        """
+            )
+        )
+
+    def _upsert(self, where):
+        return f"""
+            INSERT INTO cafe_search (cafe_id, document)
+            SELECT c.id, {self.DOCUMENT}
+            FROM cafes c JOIN cities ci ON ci.code = c.city_code
+            {where}
+            ON CONFLICT (cafe_id) DO UPDATE SET document = excluded.document
+        """
+
+    def index(self, conn, cafe_ids):
+        conn.execute(
+            text(self._upsert("WHERE c.id IN :ids")).bindparams(
+                bindparam("ids", expanding=True)
+            ),
+            {"ids": list(cafe_ids)},
+        )
+
+    def remove(self, conn, cafe_ids):
+        conn.execute(
+            text("DELETE FROM cafe_search WHERE cafe_id IN :ids").bindparams(
+                bindparam("ids", expanding=True)
+            ),
+            {"ids": list(cafe_ids)},
+        )
+
+    def prune(self, conn):
+        # Rows go with their cafe through ON DELETE CASCADE.
+        pass
+
+    def reindex(self, conn):
+        conn.execute(text(self._upsert("")))
+
+    def search(self, conn, terms, limit, offset=0):
+        query = " & ".join(terms)
+        return conn.execute(
+            text(
+                """
+                SELECT cafe_id, ts_rank(document, query) AS rank
+                FROM cafe_search, to_tsquery('english', :query) query
+                WHERE document @@ query
+                ORDER BY rank DESC, cafe_id
+                LIMIT :limit OFFSET :offset
+            """
+            ),
+            {"query": query, "limit": limit, "offset": offset},
+        ).all()
+
+
+class SqliteSearch(SearchBackend):
+    """An FTS5 virtual table keyed by cafe id, ranked by bm25."""
+
+    def create(self, conn):
+        conn.execute(
+            text(
+                """
+            CREATE VIRTUAL TABLE IF NOT EXISTS cafe_search USING fts5(
+                name, city, address, description,
+                tokenize = 'porter unicode61'
+            )
+        """
+            )
+        )
+
+    def _insert(self, where):
+        return f"""
+            INSERT INTO cafe_search (rowid, name, city, address, description)
+            SELECT c.id, c.name, ci.name, c.address, c.description
+            FROM cafes c JOIN cities ci ON ci.code = c.city_code
+            {where}
+        """
+
+    def index(self, conn, cafe_ids):
+        self.remove(conn, cafe_ids)
+        conn.execute(
+            text(self._insert("WHERE c.id IN :ids")).bindparams(
+                bindparam("ids", expanding=True)
+            ),
+            {"ids": list(cafe_ids)},
+        )
+
+    def remove(self, conn, cafe_ids):
+        conn.execute(
+            text("DELETE FROM cafe_search WHERE rowid IN :ids").bindparams(
+                bindparam("ids", expanding=True)
+            ),
+            {"ids": list(cafe_ids)},
+        )
+
+    def prune(self, conn):
+        conn.execute(
+            text("DELETE FROM cafe_search WHERE rowid NOT IN (SELECT id FROM cafes)")
+        )
+
+    def reindex(self, conn):
+        conn.execute(text("DELETE FROM cafe_search"))
+        conn.execute(text(self._insert("")))
+
+    def search(self, conn, terms, limit, offset=0):
+        query = " ".join(f'"{term}"' for term in terms)
+        return conn.execute(
+            text(
+                """
+                SELECT rowid AS cafe_id,
+                    -bm25(cafe_search, 10.0, 5.0, 2.0, 1.0) AS rank
+                FROM cafe_search
+                WHERE cafe_search MATCH :query
+                ORDER BY rank DESC, rowid
+                LIMIT :limit OFFSET :offset
+            """
+            ),
+            {"query": query, "limit": limit, "offset": offset},
+        ).all()
+
+
+BACKENDS = {
+    "postgresql": PostgresSearch(),
+    "sqlite": SqliteSearch(),
+}
+
+
+def backend_for(conn):
+    """Return the search backend for this connection's database, if any."""
+
+    return BACKENDS.get(conn.dialect.name)
+
+
+def search_terms(q):
+    """Split a user's query into plain words, dropping any query syntax."""
+
+    return re.findall(r"\w+", q.lower())
@@ -1,26 +1,25 @@
 """Initial data."""
 
-from models import City, Cafe, db, connect_db, User
-from flask import Flask
+from app import create_app
+from geo import get_geocoder
+from migrate import upgrade
+from models import City, Cafe, db, User
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///flaskcafe'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-
-connect_db(app)
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
-db.create_all()
+with db.engine.begin() as conn:
+    conn.exec_driver_sql("DROP TABLE IF EXISTS alembic_version")
+    upgrade(conn)
 
 
 #######################################
 # add cities
 
-sf = City(code='sf', name='San Francisco', state='CA')
-berk = City(code='berk', name='Berkeley', state='CA')
-oak = City(code='oak', name='Oakland', state='CA')
+sf = City(code="sf", name="San Francisco", state="CA")
+berk = City(code="berk", name="Berkeley", state="CA")
+oak = City(code="oak", name="Oakland", state="CA")
 
 db.session.add_all([sf, berk, oak])
 db.session.commit()
@@ -31,22 +30,22 @@ db.session.commit()
 
 c1 = Cafe(
     name="Bernie's Cafe",
-    description='Serving locals in Noe Valley. A great place to sit and write'
-        ' and write Rithm exercises.',
+    description="Serving locals in Noe Valley. A great place to sit and write"
+    " and write Rithm exercises.",
     address="3966 24th St",
-    city_code='sf',
-    url='https://www.yelp.com/biz/bernies-san-francisco',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg'
+    city_code="sf",
+    url="https://www.yelp.com/biz/bernies-san-francisco",
+    image_url="https://s3-media4.fl.yelpcdn.com/bphoto/bVCa2JefOCqxQsM6yWrC-A/o.jpg",
 )
 
 c2 = Cafe(
-    name='Perch Coffee',
-    description='Hip and sleek place to get cardamom lattés when biking'
-        ' around Oakland.',
-    address='440 Grand Ave',
-    city_code='oak',
-    url='https://perchoffee.com',
-    image_url='https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg',
+    name="Perch Coffee",
+    description="Hip and sleek place to get cardamom lattés when biking"
+    " around Oakland.",
+    address="440 Grand Ave",
+    city_code="oak",
+    url="https://perchoffee.com",
+    image_url="https://s3-media4.fl.yelpcdn.com/bphoto/0vhzcgkzIUIEPIyL2rF_YQ/o.jpg",
 )
 
 db.session.add_all([c1, c2])
@@ -82,17 +81,19 @@ db.session.commit()
 #######################################
 # add likes
 
-# u1.liked_cafes.append(c1)
-# u1.liked_cafes.append(c2)
-# ua.liked_cafes.append(c1)
+u1.like(c1.id)
+u1.like(c2.id)
+ua.like(c1.id)
 
-# db.session.commit()
+db.session.commit()
 
 
 #######################################
-# cafe maps
+# cafe locations
+
+geocoder = get_geocoder()
+if geocoder:
+    c1.geocode(geocoder)
+    c2.geocode(geocoder)
 
-# c1.save_map()
-# c2.save_map()
-#
-#db.session.commit()
+    db.session.commit()
@@ -0,0 +1,59 @@
+"""Compiled-template caching for Flask Cafe.
+
+Jinja compiles each template to Python the first time a worker renders it,
+so right after a deploy every worker pays that cost on its first requests.
+With TEMPLATE_CACHE_DIR set, compiled bytecode is kept on disk and shared
+by all workers and restarts (Jinja checks it against the template source,
+so edits are never served stale). `flask cafe compile-templates` fills the
+cache ahead of time, and TEMPLATE_WARMUP loads every template while the app
+is being created, before it takes any requests.
+"""
+
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+
+def _is_template(name):
+    return name.endswith(".html")
+
+
+def compile_templates(app):
+    """Load every template into the app's Jinja environment.
+
+    Returns (number loaded, [(name, error), ...]). With a bytecode cache,
+    this also writes each template's bytecode to it.
+    """
+
+    env = app.jinja_env
+    loaded = 0
+    errors = []
+    for name in env.list_templates(filter_func=_is_template):
+        try:
+            env.get_template(name)
+        except TemplateError as exc:
+            errors.append((name, exc))
+        else:
+            loaded += 1
+    return loaded, errors
+
+
+def init_templates(app):
+    """Set up the bytecode cache and, if configured, warm templates up."""
+
+    cache_dir = app.config.get("TEMPLATE_CACHE_DIR")
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    if app.config.get("TEMPLATE_WARMUP"):
+        start = time.perf_counter()
+        loaded, errors = compile_templates(app)
+        for name, exc in errors:
+            app.logger.error("Template %s failed to compile: %s", name, exc)
+        app.logger.info(
+            "Warmed up %d templates in %.0f ms",
+            loaded,
+            1000 * (time.perf_counter() - start),
+        )
@@ -1,27 +1,57 @@
 """Tests for Flask Cafe."""
 
 
+import asyncio
+import gzip
+import importlib.util
+import io
+import os
 import re
-from unittest import TestCase
-
-from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User #, Like
-
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe_test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
-
-connect_db(app)
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, skipUnless
+
+from flask import g, session
+from PIL import Image
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, event, exc, inspect, text
+from sqlalchemy.engine import make_url
+from app import create_app, CURR_USER_KEY
+from config import CONFIGS
+from models import db, Cafe, City, User, city_cache, Like
+from models import recount_likes, TableVersion, versions_query
+from models import username_index
+from replicas import STICKY_COOKIE
+from bloom import BloomFilter
+from hashing import PasswordHasher, HashingBusy, hash_password
+from throttle import login_throttle, MemoryStorage
+from metrics import Histogram
+from generator import generate
+from importer import upsert
+from compression import CompressionMiddleware
+from assets import build_assets
+import migrate
+import search
+from generic_views import AsyncListView, ListView
+import geo
+from thumbnails import DiskCache, ImageError, get_proxy, thumbnail_url
+import brotli
+
+# The test profile uses the test database (TEST_DATABASE_URL), doesn't
+# clutter tests with SQL, makes Flask errors real errors, doesn't require
+# CSRF and uses the cheapest bcrypt cost so tests don't spend their time
+# hashing
+app = create_app("test")
+
+# Tests query the database outside of requests, so keep an app context
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -35,10 +65,30 @@ def debug_html(response, label="DEBUGGING"):  # pragma: no cover
     """Prints HTML response; useful for debugging tests."""
 
     print("\n\n\n", "*********", label, "\n")
-    print(response.data.decode('utf8'))
+    print(response.data.decode("utf8"))
     print("\n\n")
 
 
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside the block.
+
+    Yields a list that fills up with the statements as they execute, so
+    tests can assert on `len()` to catch N+1 query regressions.
+    """
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
 def login_for_test(client, user_id):
     """Log in this user."""
 
@@ -50,11 +100,7 @@ def login_for_test(client, user_id):
 # data to use for test objects / testing forms
 
 
-CITY_DATA = dict(
-    code="sf",
-    name="San Francisco",
-    state="CA"
-)
+CITY_DATA = dict(code="sf", name="San Francisco", state="CA")
 
 CAFE_DATA = dict(
     name="Test Cafe",
@@ -62,7 +108,7 @@ CAFE_DATA = dict(
     url="http://testcafe.com/",
     address="500 Sansome St",
     city_code="sf",
-    image_url="http://testcafeimg.com/"
+    image_url="http://testcafeimg.com/",
 )
 
 CAFE_DATA_EDIT = dict(
@@ -71,7 +117,7 @@ CAFE_DATA_EDIT = dict(
     url="http://new-image.com/",
     address="500 Sansome St",
     city_code="sf",
-    image_url="http://new-image.com/"
+    image_url="http://new-image.com/",
 )
 
 TEST_USER_DATA = dict(
@@ -112,6 +158,39 @@ ADMIN_USER_DATA = dict(
 )
 
 
+#######################################
+# app factory
+
+
+# the prod profile, with the secret key a deploy would set
+PROD_CONFIG = type("Config", (CONFIGS["prod"],), {"SECRET_KEY": "not-shhhh"})
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for create_app and its config profiles."""
+
+    def test_prod_needs_secret_key(self):
+        config = type("Config", (CONFIGS["prod"],), {"SECRET_KEY": None})
+        with self.assertRaisesRegex(ValueError, "FLASK_SECRET_KEY"):
+            create_app(config)
+
+    def test_profiles(self):
+        prod = create_app(PROD_CONFIG)
+        self.assertFalse(prod.config["SQLALCHEMY_ECHO"])
+        self.assertNotIn("debugtoolbar", prod.extensions)
+        self.assertIn("cafe", prod.cli.commands)
+
+        self.assertTrue(app.config["TESTING"])
+        self.assertFalse(app.config["WTF_CSRF_ENABLED"])
+
+    def test_same_routes_for_every_app(self):
+        other = create_app(PROD_CONFIG)
+        self.assertEqual(
+            sorted(rule.rule for rule in other.url_map.iter_rules()),
+            sorted(rule.rule for rule in app.url_map.iter_rules()),
+        )
+
+
 #######################################
 # homepage
 
@@ -122,7 +201,7 @@ class HomepageViewsTestCase(TestCase):
     def test_homepage(self):
         with app.test_client() as client:
             resp = client.get("/")
-            self.assertIn(b'Where Coffee Dreams Come True', resp.data)
+            self.assertIn(b"Where Coffee Dreams Come True", resp.data)
 
 
 #######################################
@@ -158,6 +237,62 @@ class CityModelTestCase(TestCase):
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
+    def test_city_cache_hits(self):
+        city_cache.invalidate()
+        misses = city_cache.misses
+        hits = city_cache.hits
+
+        db.session.refresh(self.cafe)
+        # the cache checks the cities version once per request
+        with app.test_request_context():
+            self.assertEqual(city_cache.choices(), [("sf", "San Francisco")])
+            with count_queries() as statements:
+                self.assertEqual(city_cache.get("sf").state, "CA")
+                self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
+
+        self.assertEqual(statements, [])
+        self.assertEqual(city_cache.misses, misses + 1)
+        self.assertEqual(city_cache.hits, hits + 2)
+
+    def test_city_cache_invalidated_on_commit(self):
+        city_cache.choices()
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.flush()
+        self.assertIsNone(city_cache.get("oak"))
+
+        db.session.commit()
+        self.assertEqual(city_cache.get("oak").name, "Oakland")
+
+        City.query.filter_by(code="oak").update({"name": "Oaktown"})
+        db.session.commit()
+        self.assertEqual(city_cache.get("oak").name, "Oaktown")
+
+    def test_city_cache_sees_other_writes(self):
+        # e.g. Core statements, or commits in another process
+        with app.test_request_context():
+            self.assertEqual(city_cache.get("sf").name, "San Francisco")
+
+        with db.engine.begin() as conn:
+            conn.execute(City.__table__.update().values(name="San Fran"))
+
+        with app.test_request_context():
+            self.assertEqual(city_cache.get("sf").name, "San Fran")
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe.id}")
+            self.assertIn(b"San Fran, CA", resp.data)
+
+    def test_city_cache_not_invalidated_on_rollback(self):
+        city_cache.choices()
+        misses = city_cache.misses
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertIsNone(city_cache.get("oak"))
+        self.assertEqual(city_cache.misses, misses)
+
 
 #######################################
 # cafes
@@ -224,226 +359,2440 @@ class CafeViewsTestCase(TestCase):
             resp = client.get("/cafes")
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b'src="/img/card/', resp.data)
+
+    def test_list_paginates(self):
+        for name in ["Alpha Cafe", "Beta Cafe", "Zeta Cafe"]:
+            db.session.add(Cafe(**{**CAFE_DATA, "name": name}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?per_page=2")
+            html = resp.data.decode("utf8")
+            self.assertIn("Alpha Cafe", html)
+            self.assertIn("Beta Cafe", html)
+            self.assertNotIn("Test Cafe", html)
+            self.assertNotIn("Previous", html)
+
+            next_url = re.search(r'href="([^"]*after=[^"]*)"', html).group(1)
+            resp = client.get(next_url.replace("&amp;", "&"))
+            html = resp.data.decode("utf8")
+            self.assertIn("Test Cafe", html)
+            self.assertIn("Zeta Cafe", html)
+            self.assertNotIn("Alpha Cafe", html)
+            self.assertIn("Previous", html)
+            self.assertNotIn("Next", html)
+
+            prev_url = re.search(r'href="([^"]*before=[^"]*)"', html).group(1)
+            resp = client.get(prev_url.replace("&amp;", "&"))
+            html = resp.data.decode("utf8")
+            self.assertIn("Alpha Cafe", html)
+            self.assertIn("Beta Cafe", html)
+            self.assertNotIn("Zeta Cafe", html)
+
+    def test_list_order_desc(self):
+        db.session.add(Cafe(**{**CAFE_DATA, "name": "Zeta Cafe"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?order=-name&per_page=1")
+            self.assertIn(b"Zeta Cafe", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+    def test_list_bad_params(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes?order=description")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/cafes?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_list_no_n_plus_one(self):
+        with app.test_client() as client:
+            with count_queries() as one_cafe:
+                client.get("/cafes")
+
+        for i in range(5):
+            db.session.add(City(code=f"c{i}", name=f"City {i}", state="CA"))
+            db.session.add(Cafe(**{**CAFE_DATA, "city_code": f"c{i}"}))
+        db.session.commit()
+
+        with app.test_client() as client:
+            with count_queries() as six_cafes:
+                resp = client.get("/cafes")
+
+        self.assertIn(b"City 4, CA", resp.data)
+        self.assertEqual(len(six_cafes), len(one_cafe))
+
+    def test_list_conditional_get(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            etag = resp.headers["ETag"]
+            self.assertTrue(resp.headers["Last-Modified"])
+
+            with count_queries() as statements:
+                resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(len(statements), 1)
+
+            resp = client.get("/cafes?order=-name", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            db.session.add(Cafe(**{**CAFE_DATA, "name": "Another Cafe"}))
+            db.session.commit()
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Another Cafe", resp.data)
+
+    def test_detail_conditional_get(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            etag = resp.headers["ETag"]
+            last_modified = resp.headers["Last-Modified"]
+
+            resp = client.get(
+                f"/cafes/{self.cafe_id}", headers={"If-Modified-Since": last_modified}
+            )
+            self.assertEqual(resp.status_code, 304)
+
+            City.query.filter_by(code="sf").one().name = "San Fran"
+            db.session.commit()
+            resp = client.get(f"/cafes/{self.cafe_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"San Fran, CA", resp.data)
+
+            resp = client.get("/cafes/0", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_conditional_get_sees_deletes(self):
+        other = Cafe(**{**CAFE_DATA, "name": "Other Cafe", "address": "2 St"})
+        db.session.add(other)
+        db.session.commit()
+        # as if the last change was a while ago
+        db.session.execute(
+            TableVersion.__table__.update().values(changed_at=datetime(2020, 1, 1))
+        )
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            last_modified = resp.headers["Last-Modified"]
+            self.assertIn("2020", last_modified)
+
+            db.session.delete(other)
+            db.session.commit()
+            resp = client.get("/cafes", headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(b"Other Cafe", resp.data)
+
+    def test_conditional_get_logged_in(self):
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.addCleanup(lambda: (User.query.delete(), db.session.commit()))
+
+        with app.test_client() as client:
+            path = f"/cafes/{self.cafe_id}"
+            anonymous = client.get(path)
+            login_for_test(client, user.id)
+
+            resp = client.get(
+                path,
+                headers={
+                    "If-None-Match": anonymous.headers["ETag"],
+                    "If-Modified-Since": anonymous.headers["Last-Modified"],
+                },
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Like</button>", resp.data)
+            self.assertNotIn("Last-Modified", resp.headers)
+            self.assertTrue(resp.cache_control.private)
+            self.assertIn("Cookie", resp.vary)
+
+            etag = resp.headers["ETag"]
+            resp = client.get(path, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            user.like(self.cafe_id)
+            db.session.commit()
+            resp = client.get(path, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Unlike</button>", resp.data)
+
+    def test_conditional_get_sees_profile_edits(self):
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        self.addCleanup(lambda: (User.query.delete(), db.session.commit()))
+
+        with app.test_client() as client:
+            login_for_test(client, user.id)
+            for path in ["/cafes", f"/cafes/{self.cafe_id}"]:
+                etag = client.get(path).headers["ETag"]
+
+                user.first_name = f"Renamed{len(path)}"
+                db.session.commit()
+                resp = client.get(path, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(f"Renamed{len(path)} MacTest".encode(), resp.data)
+
+    def test_versions_are_sharded(self):
+        def version():
+            with db.engine.connect() as conn:
+                return conn.execute(versions_query(["cities"])).one().version
+
+        before = version()
+        city = City.query.get("sf")
+        for i in range(20):
+            city.name = f"San Francisco {i}"
+            db.session.commit()
+
+        self.assertEqual(version(), before + 20)
+        shards = TableVersion.query.filter_by(name="cities").count()
+        self.assertGreater(shards, 1)
+
+    def test_version_is_a_key_lookup(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                client.get("/cafes")
+
+        versions = [sql for sql in statements if "table_versions" in sql]
+        self.assertEqual(len(versions), 1)
+        self.assertNotIn("count(", " ".join(statements).lower())
 
     def test_detail(self):
         with app.test_client() as client:
             resp = client.get(f"/cafes/{self.cafe_id}")
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"Test Cafe", resp.data)
-            self.assertIn(b'testcafe.com', resp.data)
+            self.assertIn(b"testcafe.com", resp.data)
 
 
-class CafeAdminViewsTestCase(TestCase):
-    """Tests for add/edit views on cafes."""
+class StreamedListTestCase(TestCase):
+    """Tests for ListView's streaming mode."""
 
     def setUp(self):
-        """Before each test, add sample city, users, and cafes"""
-
+        Cafe.query.delete()
         City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add_all(
+            [
+                Cafe(**{**CAFE_DATA, "name": f"Cafe {i:02}", "address": f"{i} St"})
+                for i in range(30)
+            ]
+        )
+        db.session.commit()
+
+        self.stream_app = create_app(
+            type("Config", (CONFIGS["test"],), {"STREAM_LIST_PAGES": True})
+        )
+
+    def tearDown(self):
         Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
 
-        sf = City(**CITY_DATA)
-        db.session.add(sf)
+    def _pages(self, test_app, path):
+        """GET `path` and the pages after it; returns their HTML."""
+
+        pages = []
+        with test_app.test_client() as client:
+            while path:
+                resp = client.get(path)
+                self.assertEqual(resp.status_code, 200)
+                pages.append(resp.text)
+                match = re.search(r'href="([^"]*after=[^"]*)"', resp.text)
+                path = match and match.group(1).replace("&amp;", "&")
+        return pages
+
+    def test_same_pages_as_rendered(self):
+        path = "/cafes?order=-name&per_page=12"
+        streamed = self._pages(self.stream_app, path)
+        self.assertEqual(len(streamed), 3)
+        self.assertEqual(streamed, self._pages(app, path))
+        self.assertIn("Cafe 29", streamed[0])
+        self.assertIn("Previous", streamed[1])
+        self.assertNotIn("Next", streamed[2])
+
+        # going back isn't streamed, but works the same
+        with self.stream_app.test_client() as client:
+            prev_url = re.search(r'href="([^"]*before=[^"]*)"', streamed[2]).group(1)
+            resp = client.get(prev_url.replace("&amp;", "&"))
+            self.assertIn("Cafe 17", resp.text)
+            self.assertNotIn("Cafe 18", resp.text)
+
+    def test_chunks(self):
+        with mock.patch.object(ListView, "chunk_size", 2000):
+            with self.stream_app.test_client() as client:
+                resp = client.get("/cafes?per_page=30", buffered=False)
+                self.assertTrue(resp.is_streamed)
+                self.assertTrue(resp.headers["ETag"])
+                chunks = [chunk.decode("utf8") for chunk in resp.response]
+
+        self.assertIn("Cafe 29", "".join(chunks))
+        # the top of the page goes out before the first card...
+        first_card = next(i for i, chunk in enumerate(chunks) if "card-title" in chunk)
+        self.assertGreater(first_card, 0)
+        self.assertIn('class="navbar', "".join(chunks[:first_card]))
+        # ...and the cards in chunks
+        self.assertGreater(len(chunks) - first_card, 2)
+        for chunk in chunks[first_card:-1]:
+            self.assertGreaterEqual(len(chunk), 2000)
+
+    def test_conditional_and_bad_params(self):
+        with self.stream_app.test_client() as client:
+            etag = client.get("/cafes").headers["ETag"]
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get("/cafes?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+
+class CafeNearbyTestCase(TestCase):
+    """Tests for locating cafes and finding nearby ones."""
 
-        cafe = Cafe(**CAFE_DATA)
-        db.session.add(cafe)
+    def setUp(self):
+        """Before each test, add a city and cafes at known spots."""
 
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+
+        # Ferry Building, ~1.3 km away, ~12.5 km away
+        spots = [(37.7955, -122.3937), (37.7880, -122.4075), (37.8716, -122.2727)]
+        cafes = [
+            Cafe(**{**CAFE_DATA, "name": f"Cafe {n}"}, latitude=lat, longitude=lng)
+            for n, (lat, lng) in enumerate(spots)
+        ]
+        db.session.add_all(cafes)
         db.session.commit()
 
-        self.cafe_id = cafe.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
 
     def tearDown(self):
-        """After each test, delete the cities."""
+        """After each test, remove all cafes."""
 
         Cafe.query.delete()
         City.query.delete()
         db.session.commit()
 
-    def test_add(self):
-        with app.test_client() as client:
-            resp = client.get(f"/cafes/add")
-            self.assertIn(b'Add Cafe', resp.data)
+    def test_distance(self):
+        # SFO to JFK is about 4150 km
+        self.assertAlmostEqual(
+            geo.distance_km(37.6213, -122.3790, 40.6413, -73.7781), 4152, delta=5
+        )
 
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'added', resp.data)
+    def test_bounding_box_wraps(self):
+        min_lat, max_lat, lng_ranges = geo.bounding_box(0, 179.99, 10)
+        self.assertEqual(len(lng_ranges), 2)
+        cells = geo.cells_for(min_lat, max_lat, lng_ranges)
+        self.assertIn(geo.grid_cell(0, -179.99), cells)
+        self.assertIn(geo.grid_cell(0, 179.99), cells)
 
-    def test_dynamic_cities_vocab(self):
-       id = self.cafe_id
+    def test_geo_cell_set_on_flush(self):
+        cafe = db.session.get(Cafe, self.cafe_ids[0])
+        self.assertEqual(cafe.geo_cell, geo.grid_cell(37.7955, -122.3937))
 
-       # the following is a regular expression for the HTML for the drop-down
-       # menu pattern we want to check for
-       choices_pattern = re.compile(
-           r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
-           r'San Francisco</option></select>')
+        cafe.latitude = cafe.longitude = None
+        db.session.commit()
+        self.assertIsNone(cafe.geo_cell)
 
-       with app.test_client() as client:
-           resp = client.get(f"/cafes/add")
-           self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+    def test_nearby(self):
+        ids = self.cafe_ids
 
-           resp = client.get(f"/cafes/{id}/edit")
-           self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+        results = Cafe.nearby(37.7955, -122.3937, 2, limit=10)
+        self.assertEqual([cafe.id for cafe, dist in results], ids[:2])
+        self.assertAlmostEqual(results[1][1], 1.4, delta=0.2)
 
-    def test_edit(self):
-        id = self.cafe_id
+        results = Cafe.nearby(37.7955, -122.3937, 20, limit=10)
+        self.assertEqual([cafe.id for cafe, dist in results], ids)
 
+    def test_nearby_view(self):
         with app.test_client() as client:
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Edit Test Cafe', resp.data)
+            resp = client.get("/cafes/nearby?lat=37.7955&lng=-122.3937&radius=2")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Cafe 1", resp.data)
+            self.assertNotIn(b"Cafe 2", resp.data)
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'edited', resp.data)
+            resp = client.get("/cafes/nearby?lat=37.7955&lng=-122.3937&format=json")
+            self.assertEqual(
+                [r["name"] for r in resp.json["results"]], ["Cafe 0", "Cafe 1"]
+            )
 
-    def test_edit_form_shows_curr_data(self):
-       id = self.cafe_id
+            resp = client.get("/cafes/nearby?lat=37.7955")
+            self.assertEqual(resp.status_code, 400)
+            resp = client.get("/cafes/nearby?lat=37.7955&lng=-122.3937&radius=500")
+            self.assertEqual(resp.status_code, 400)
 
-       with app.test_client() as client:
-           resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-           self.assertIn(b'Test description', resp.data)
+    def test_add_geocodes(self):
+        with app.test_client() as client:
+            client.post("/cafes/add", data={**CAFE_DATA, "name": "Located"})
 
+        cafe = Cafe.query.filter_by(name="Located").one()
+        self.assertEqual(
+            (cafe.latitude, cafe.longitude),
+            geo.StubGeocoder().geocode("500 Sansome St, San Francisco, CA"),
+        )
+        self.assertIsNotNone(cafe.geo_cell)
 
-#######################################
-# users
+    def test_geocode_command(self):
+        runner = app.test_cli_runner(mix_stderr=False)
+        result = runner.invoke(args=["cafe", "geocode"])
+        self.assertIn("Located 0 of 0 cafes.", result.stdout)
 
+        result = runner.invoke(args=["cafe", "geocode", "--all"])
+        self.assertIn("Located 3 of 3 cafes.", result.stdout)
+        self.assertNotEqual(db.session.get(Cafe, self.cafe_ids[0]).latitude, 37.7955)
 
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
+
+class CafeSearchTestCase(TestCase):
+    """Tests for full-text search of cafes."""
 
     def setUp(self):
-        """Before each test, add sample users."""
+        """Before each test, add sample cities and cafes."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+
+        cafe = Cafe(**CAFE_DATA)
+        perch = Cafe(
+            **{
+                **CAFE_DATA,
+                "name": "Perch Coffee",
+                "description": "Cardamom lattes",
+                "address": "440 Grand Ave",
+                "city_code": "oak",
+            }
+        )
+        roaster = Cafe(
+            **{
+                **CAFE_DATA,
+                "name": "Grand Roasters",
+                "description": "Coffee near Perch",
+                "address": "1 Market St",
+            }
+        )
+        db.session.add_all([cafe, perch, roaster])
 
         db.session.commit()
 
-        self.user = user
+        self.cafe_id = cafe.id
+        self.perch_id = perch.id
+        self.roaster_id = roaster.id
 
     def tearDown(self):
-        """After each test, remove all users."""
+        """After each test, remove all cafes."""
 
-        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
+    def test_search_fields(self):
+        self.assertEqual(
+            [cafe.id for cafe, rank in Cafe.search("sansome", 10)], [self.cafe_id]
+        )
+        self.assertEqual(
+            [cafe.id for cafe, rank in Cafe.search("oakland", 10)], [self.perch_id]
+        )
+        self.assertEqual(
+            [cafe.id for cafe, rank in Cafe.search("lattes", 10)], [self.perch_id]
+        )
+        self.assertEqual(Cafe.search("", 10), [])
+        self.assertEqual(Cafe.search('"*:', 10), [])
+
+    def test_search_ranks_name_first(self):
+        results = Cafe.search("perch", 10)
+        self.assertEqual(
+            [cafe.id for cafe, rank in results], [self.perch_id, self.roaster_id]
+        )
+
+    def test_search_follows_updates(self):
+        cafe = Cafe.query.get(self.cafe_id)
+        cafe.name = "Bernie's"
+        db.session.commit()
+        self.assertEqual(
+            [cafe.id for cafe, rank in Cafe.search("bernie", 10)], [self.cafe_id]
+        )
 
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertFalse(rez)
+        City.query.get("oak").name = "Oaktown"
+        db.session.commit()
+        self.assertEqual(Cafe.search("oakland", 10), [])
+        self.assertEqual(len(Cafe.search("oaktown", 10)), 1)
 
-        rez = User.authenticate("test", "password")
-        self.assertFalse(rez)
+        db.session.delete(Cafe.query.get(self.perch_id))
+        db.session.commit()
+        self.assertEqual(Cafe.search("oaktown", 10), [])
 
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+    def test_search_view(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes/search?q=perch")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Perch Coffee", resp.data)
+            self.assertIn(b"Grand Roasters", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            resp = client.get("/cafes/search?q=perch&format=json")
+            self.assertEqual(
+                [r["id"] for r in resp.json["results"]],
+                [self.perch_id, self.roaster_id],
+            )
+            self.assertEqual(resp.json["results"][0]["city"], "Oakland, CA")
 
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.password[:4], "$2b$")
-        db.session.rollback()
+            resp = client.get(
+                "/cafes/search?q=grand", headers={"Accept": "application/json"}
+            )
+            self.assertEqual(len(resp.json["results"]), 2)
 
 
-class AuthViewsTestCase(TestCase):
-    """Tests for views on logging in/logging out/registration."""
+ASYNC_DRIVER = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}.get(
+    make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name()
+)
 
-    def setUp(self):
-        """Before each test, add sample users."""
 
-        User.query.delete()
+@skipUnless(
+    ASYNC_DRIVER and importlib.util.find_spec(ASYNC_DRIVER),
+    "needs the async driver for the test database",
+)
+class AsyncViewsTestCase(TestCase):
+    """Tests for the async cafe list, detail and search views."""
 
-        user = User.register(**TEST_USER_DATA)
-        db.session.add(user)
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
 
+        db.session.add(City(**CITY_DATA))
+        cafes = [
+            Cafe(**{**CAFE_DATA, "name": name})
+            for name in ["Alpha Cafe", "Beta Cafe", "Perch Coffee"]
+        ]
+        db.session.add_all(cafes)
         db.session.commit()
+        self.cafe_ids = [cafe.id for cafe in cafes]
 
-        self.user_id = user.id
+        self.async_app = create_app(
+            type("Config", (CONFIGS["test"],), {"ASYNC_VIEWS": True})
+        )
 
     def tearDown(self):
-        """After each test, remove all users."""
-
-        User.query.delete()
+        self.async_app.extensions["async_db"].close()
+        Cafe.query.delete()
+        City.query.delete()
         db.session.commit()
 
-    def test_signup(self):
-        with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
-
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA_NEW,
-                follow_redirects=True,
-            )
-
-            self.assertIn(b"You are signed up and logged in.", resp.data)
-            self.assertTrue(session.get(CURR_USER_KEY))
+    def test_reads_overlap(self):
+        # the views are sync; what the async engine buys is running a
+        # page's table versions and rows at the same time
+        view = self.async_app.view_functions["cafes.cafe_list"]
+        self.assertEqual(view.view_class.__name__, "AsyncListView")
+        self.assertNotIn("async_db", app.extensions)
 
-    def test_signup_username_taken(self):
-        with app.test_client() as client:
-            resp = client.get("/signup")
-            self.assertIn(b'Sign Up', resp.data)
+        def slow(read):
+            async def wrapper(*args):
+                await asyncio.sleep(0.3)
+                return await read(*args)
 
-            # signup with same data as the already-added user
-            resp = client.post(
-                "/signup",
-                data=TEST_USER_DATA,
-                follow_redirects=True,
-            )
+            return wrapper
 
-            # breakpoint()
+        with mock.patch.object(
+            AsyncListView, "get_version", slow(AsyncListView.get_version)
+        ), mock.patch.object(AsyncListView, "get_items", slow(AsyncListView.get_items)):
+            with self.async_app.test_client() as client:
+                start = time.perf_counter()
+                resp = client.get("/cafes")
+                elapsed = time.perf_counter() - start
 
-            self.assertIn(b"Username already taken", resp.data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(elapsed, 0.55)
 
-    def test_login(self):
+    def test_list(self):
+        with self.async_app.test_client() as client:
+            resp = client.get("/cafes?order=name&per_page=2")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Alpha Cafe", resp.data)
+            self.assertIn(b"Beta Cafe", resp.data)
+            self.assertNotIn(b"Perch Coffee", resp.data)
+            self.assertIn(b"San Francisco, CA", resp.data)
+
+            next_url = re.search(r'href="([^"]*after=[^"]*)"', resp.text).group(1)
+            resp = client.get(next_url.replace("&amp;", "&"))
+            self.assertIn(b"Perch Coffee", resp.data)
+            self.assertNotIn(b"Alpha Cafe", resp.data)
+
+            resp = client.get("/cafes?after=garbage")
+            self.assertEqual(resp.status_code, 400)
+            resp = client.get("/cafes?order=description")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_etags_match_sync_views(self):
+        with self.async_app.test_client() as client:
+            async_resp = client.get("/cafes")
         with app.test_client() as client:
-            resp = client.get("/login")
-            self.assertIn(b'Welcome Back!', resp.data)
+            sync_resp = client.get("/cafes")
+        self.assertEqual(async_resp.get_etag(), sync_resp.get_etag())
+        self.assertIsNotNone(async_resp.get_etag()[0])
+
+    def test_not_modified(self):
+        with self.async_app.test_client() as client:
+            for path in ["/cafes", f"/cafes/{self.cafe_ids[0]}"]:
+                etag = client.get(path).get_etag()[0]
+                resp = client.get(path, headers={"If-None-Match": f'"{etag}"'})
+                self.assertEqual(resp.status_code, 304)
+
+            Cafe.query.get(self.cafe_ids[0]).name = "Renamed Cafe"
+            db.session.commit()
+            resp = client.get("/cafes", headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Renamed Cafe", resp.data)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "WRONG"},
-                follow_redirects=True,
-            )
+    def test_detail(self):
+        with self.async_app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_ids[2]}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Perch Coffee", resp.data)
 
-            self.assertIn(b"Invalid credentials", resp.data)
+            resp = client.get("/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+            resp = client.get("/cafes/0", headers={"If-None-Match": '"stale"'})
+            self.assertEqual(resp.status_code, 404)
 
-            resp = client.post(
-                "/login",
-                data={"username": "test", "password": "secret"},
-                follow_redirects=True,
-            )
+    def test_logged_in(self):
+        # templates read g.user and g.user.has_liked(); those sync queries
+        # must run on the request thread, not on the async engine's loop
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+        user.like(self.cafe_ids[0])
+        db.session.commit()
 
-            self.assertIn(b"Hello, test", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+        threads = []
+
+        def before_cursor_execute(*args):
+            threads.append(threading.current_thread().name)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            with self.async_app.test_client() as client:
+                login_for_test(client, user.id)
+                for path in [
+                    "/cafes",
+                    f"/cafes/{self.cafe_ids[0]}",
+                    "/cafes/search?q=perch",
+                ]:
+                    resp = client.get(path)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn(b"Testy MacTest", resp.data)
+                resp = client.get(f"/cafes/{self.cafe_ids[0]}")
+                self.assertIn(b"Unlike", resp.data)
+                resp = client.get(f"/cafes/{self.cafe_ids[1]}")
+                self.assertNotIn(b"Unlike", resp.data)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+            Like.query.delete()
+            User.query.delete()
+            db.session.commit()
+
+        self.assertTrue(threads)
+        self.assertNotIn("async-db", threads)
+
+    def test_search(self):
+        with self.async_app.test_client() as client:
+            resp = client.get("/cafes/search?q=perch&format=json")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [r["id"] for r in resp.json["results"]], [self.cafe_ids[2]]
+            )
+            self.assertEqual(resp.json["results"][0]["city"], "San Francisco, CA")
 
-    def test_logout(self):
+    def test_queries_counted(self):
+        # the async engine's queries show up in Server-Timing as usual
+        city_cache.get("sf")
+        with self.async_app.test_client() as client:
+            async_timing = client.get("/cafes").headers["Server-Timing"]
         with app.test_client() as client:
-            login_for_test(client, self.user_id)
-            resp = client.post("/logout", follow_redirects=True)
+            sync_timing = client.get("/cafes").headers["Server-Timing"]
+        pattern = r'desc="(\d+) queries"'
+        self.assertEqual(
+            re.search(pattern, async_timing).group(1),
+            re.search(pattern, sync_timing).group(1),
+        )
 
-            self.assertIn(b"successfully logged out", resp.data)
-            self.assertEqual(session.get(CURR_USER_KEY), None)
 
+class CafeApiTestCase(TestCase):
+    """Tests for the JSON API for cafes."""
 
-# class NavBarTestCase(TestCase):
-#     """Tests navigation bar."""
+    def setUp(self):
+        """Before each test, add sample cities and cafes."""
 
-#     def setUp(self):
-#         """Before tests, add sample user."""
+        Cafe.query.delete()
+        City.query.delete()
 
-#         User.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
 
-#         user = User.register(**TEST_USER_DATA)
+        cafes = [
+            Cafe(**{**CAFE_DATA, "name": "Alpha Cafe"}),
+            Cafe(**{**CAFE_DATA, "name": "Beta Cafe", "city_code": "oak"}),
+            Cafe(**{**CAFE_DATA, "name": "Gamma Cafe"}),
+        ]
+        db.session.add_all(cafes)
+
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+    def tearDown(self):
+        """After each test, remove all cafes."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_list(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes")
+            items = resp.json["items"]
+            self.assertEqual(
+                [item["name"] for item in items],
+                ["Alpha Cafe", "Beta Cafe", "Gamma Cafe"],
+            )
+            self.assertEqual(items[0]["address"], "500 Sansome St")
+            self.assertIsNone(resp.json["next"])
+
+    def test_list_sparse_fields(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get("/api/cafes?fields=id,name")
+
+            self.assertEqual(
+                resp.json["items"][0], {"id": self.cafe_ids[0], "name": "Alpha Cafe"}
+            )
+            select = [s for s in statements if "LIMIT" in s][0]
+            self.assertNotIn("description", select)
+
+            resp = client.get("/api/cafes?fields=name,password")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("password", resp.json["error"])
+
+            for fields in ["", ",", "%20"]:
+                for path in ["/api/cafes", f"/api/cafes/{self.cafe_ids[0]}"]:
+                    resp = client.get(f"{path}?fields={fields}")
+                    self.assertEqual(resp.status_code, 400)
+                    self.assertIn("No fields", resp.json["error"])
+
+    def test_list_cursor_and_filter(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes?fields=name&per_page=2")
+            self.assertEqual(len(resp.json["items"]), 2)
+
+            resp = client.get(resp.json["next_url"])
+            self.assertEqual(resp.json["items"], [{"name": "Gamma Cafe"}])
+            self.assertTrue(resp.json["prev"])
+
+            resp = client.get("/api/cafes?fields=name&city=oak")
+            self.assertEqual(resp.json["items"], [{"name": "Beta Cafe"}])
+
+    def test_detail(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.cafe_ids[1]}?fields=name,city_code")
+            self.assertEqual(resp.json, {"name": "Beta Cafe", "city_code": "oak"})
+
+            etag = resp.headers["ETag"]
+            resp = client.get(
+                f"/api/cafes/{self.cafe_ids[1]}?fields=name,city_code",
+                headers={"If-None-Match": etag},
+            )
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get("/api/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+            self.assertIn("error", resp.json)
+
+
+class ReplicaTestCase(TestCase):
+    """Tests for sending the generic views' reads to replicas.
+
+    Each database is its own SQLite file holding a differently named copy
+    of the same cafe, so a page shows which one it was read from.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.urls = {
+            name: f"sqlite:///{os.path.join(self.tmpdir.name, name)}.db"
+            for name in ["primary", "replica1", "replica2"]
+        }
+        self.test_app = self._app(["replica1", "replica2"])
+
+    def tearDown(self):
+        with self.test_app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+        self.tmpdir.cleanup()
+
+    def _app(self, replicas, **settings):
+        test_app = create_app(
+            type(
+                "Config",
+                (CONFIGS["test"],),
+                {
+                    "SQLALCHEMY_DATABASE_URI": self.urls["primary"],
+                    "SQLALCHEMY_BINDS": {name: self.urls[name] for name in replicas},
+                    "REPLICA_BINDS": tuple(replicas),
+                    **settings,
+                },
+            )
+        )
+        with test_app.app_context():
+            db.create_all()
+            for name in replicas:
+                self._fill(db.engines[name], name)
+            self._fill(db.engine, "primary")
+            user = User.register(**TEST_USER_DATA)
+            db.session.commit()
+            self.user_id = user.id
+        return test_app
+
+    def _fill(self, engine, name):
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(City.__table__.insert(), [CITY_DATA])
+            conn.execute(
+                Cafe.__table__.insert(),
+                [{**CAFE_DATA, "id": 1, "name": f"{name} cafe"}],
+            )
+
+    def _read_from(self, client, path="/cafes"):
+        resp = client.get(path)
+        self.assertEqual(resp.status_code, 200)
+        return re.search(r"(primary|replica\d) cafe", resp.text).group(1)
+
+    def test_round_robin(self):
+        with self.test_app.test_client() as client:
+            seen = [self._read_from(client) for _ in range(4)]
+            self.assertEqual(seen, ["replica1", "replica2"] * 2)
+            self.assertEqual(self._read_from(client, "/api/cafes/1"), "replica1")
+            self.assertEqual(self._read_from(client, "/cafes/1"), "replica2")
+
+        # reads outside the wrapped views use the primary
+        with self.test_app.app_context():
+            self.assertEqual(Cafe.query.one().name, "primary cafe")
+
+    def test_read_your_writes(self):
+        with self.test_app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/cafes/1/like")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn(STICKY_COOKIE, resp.headers["Set-Cookie"])
+            self.assertIn("Max-Age=10", resp.headers["Set-Cookie"])
+
+            self.assertEqual(self._read_from(client), "primary")
+            self.assertEqual(self._read_from(client, "/cafes/1"), "primary")
+            resp = client.get("/cafes/1")
+            self.assertIn(b"1 like", resp.data)
+
+            client.delete_cookie("localhost", STICKY_COOKIE)
+            self.assertTrue(self._read_from(client).startswith("replica"))
+
+    def test_failed_replica_is_ejected(self):
+        # replica2 is in a directory that doesn't exist (yet)
+        missing = os.path.join(self.tmpdir.name, "later")
+        self.urls["replica2"] = f"sqlite:///{os.path.join(missing, 'r2.db')}"
+        test_app = create_app(
+            type(
+                "Config",
+                (CONFIGS["test"],),
+                {
+                    "SQLALCHEMY_DATABASE_URI": self.urls["primary"],
+                    "SQLALCHEMY_BINDS": {
+                        "replica1": self.urls["replica1"],
+                        "replica2": self.urls["replica2"],
+                    },
+                    "REPLICA_BINDS": ("replica1", "replica2"),
+                    "REPLICA_EJECT_SECONDS": 0,
+                },
+            )
+        )
+
+        with test_app.test_client() as client:
+            self.assertEqual(self._read_from(client), "replica1")
+            with self.assertRaises(exc.OperationalError):
+                client.get("/cafes")
+
+            # its pings keep failing, so it stays out
+            seen = {self._read_from(client) for _ in range(3)}
+            self.assertEqual(seen, {"replica1"})
+
+            # once it answers, it's back in the rotation
+            os.mkdir(missing)
+            with test_app.app_context():
+                self._fill(db.engines["replica2"], "replica2")
+            seen = {self._read_from(client) for _ in range(4)}
+            self.assertEqual(seen, {"replica1", "replica2"})
+
+            with test_app.app_context():
+                db.session.remove()
+                for engine in db.engines.values():
+                    engine.dispose()
+
+    def test_all_replicas_out(self):
+        replicas = self.test_app.extensions["replicas"]
+        for engine in replicas.engines:
+            replicas.eject(engine)
+        with self.test_app.test_client() as client:
+            self.assertEqual(self._read_from(client), "primary")
+
+
+class MetricsTestCase(TestCase):
+    """Tests for request instrumentation and /metrics."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.add(City(**CITY_DATA))
+        db.session.add(Cafe(**CAFE_DATA))
+        db.session.commit()
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.get("/cafes")
+
+        timing = resp.headers["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+        queries = int(re.search(r'"(\d+) queries"', timing).group(1))
+        self.assertEqual(queries, len(statements))
+
+    def test_metrics_endpoint(self):
+        with app.test_client() as client, mock.patch.dict(
+            app.config, {"METRICS_ALLOWED_IPS": ("127.0.0.0/8",)}
+        ):
+            client.get("/cafes")
+            resp = client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        text = resp.data.decode("utf8")
+        self.assertIn("# TYPE flaskcafe_request_duration_seconds histogram", text)
+        self.assertIn(
+            'flaskcafe_request_db_queries_bucket{endpoint="cafes.cafe_list",le="+Inf"}',
+            text,
+        )
+        self.assertIn('flaskcafe_city_cache_lookups_total{result="hit"}', text)
+
+    def test_failed_statement(self):
+        """A statement that raises is timed and leaves nothing behind."""
+
+        with app.test_request_context():
+            app.preprocess_request()
+            with db.engine.connect() as conn:
+                with self.assertRaises(exc.OperationalError):
+                    conn.exec_driver_sql("SELECT * FROM no_such_table")
+                conn.exec_driver_sql("SELECT 1")
+                self.assertNotIn("query_start", conn.info)
+            queries, sql_time = g.sql_stats
+
+        self.assertEqual(queries, 2)
+        self.assertGreaterEqual(sql_time, 0)
+
+    def test_metrics_access(self):
+        with app.test_client() as client:
+            # not public by default
+            self.assertEqual(client.get("/metrics").status_code, 404)
+
+            with mock.patch.dict(app.config, {"METRICS_ALLOWED_IPS": ("10.0.0.0/8",)}):
+                resp = client.get("/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(client.get("/metrics").status_code, 404)
+
+            with mock.patch.dict(app.config, {"METRICS_TOKEN": "s3cret"}):
+                resp = client.get(
+                    "/metrics", headers={"Authorization": "Bearer s3cret"}
+                )
+                self.assertEqual(resp.status_code, 200)
+                resp = client.get("/metrics", headers={"Authorization": "Bearer guess"})
+                self.assertEqual(resp.status_code, 404)
+
+    def test_histogram(self):
+        hist = Histogram("h", "help", "endpoint", (1, 5))
+        hist.observe("a", 0.5)
+        hist.observe("a", 3)
+        hist.observe("a", 10)
+
+        lines = hist.render()
+        self.assertIn('h_bucket{endpoint="a",le="1"} 1', lines)
+        self.assertIn('h_bucket{endpoint="a",le="5"} 2', lines)
+        self.assertIn('h_bucket{endpoint="a",le="+Inf"} 3', lines)
+        self.assertIn('h_sum{endpoint="a"} 13.5', lines)
+        self.assertIn('h_count{endpoint="a"} 3', lines)
+
+
+class CafeAdminViewsTestCase(TestCase):
+    """Tests for add/edit views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        City.query.delete()
+        Cafe.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_add(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/add")
+            self.assertIn(b"Add Cafe", resp.data)
+
+            resp = client.post(
+                f"/cafes/add", data=CAFE_DATA_EDIT, follow_redirects=True
+            )
+            self.assertIn(b"added", resp.data)
+
+    def test_dynamic_cities_vocab(self):
+        id = self.cafe_id
+
+        # the following is a regular expression for the HTML for the drop-down
+        # menu pattern we want to check for
+        choices_pattern = re.compile(
+            r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">'
+            + r"San Francisco</option></select>"
+        )
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/add")
+            self.assertRegex(resp.data.decode("utf8"), choices_pattern)
+
+            resp = client.get(f"/cafes/{id}/edit")
+            self.assertRegex(resp.data.decode("utf8"), choices_pattern)
+
+    def test_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b"Edit Test Cafe", resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit", data=CAFE_DATA_EDIT, follow_redirects=True
+            )
+            self.assertIn(b"edited", resp.data)
+
+    def test_add_duplicate(self):
+        with app.test_client() as client:
+            resp = client.post(
+                f"/cafes/add",
+                data={**CAFE_DATA, "url": "http://testcafe.com/"},
+                follow_redirects=True,
+            )
+            self.assertIn(b"already a cafe", resp.data)
+
+    def test_edit_form_shows_curr_data(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b"Test description", resp.data)
+
+
+class ImportCommandTestCase(TestCase):
+    """Tests for `flask cafe import`."""
+
+    def setUp(self):
+        """Before each test, clear cafes and cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """After each test, remove all cafes and temp files."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+        self.tmpdir.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def _import(self, *args):
+        return app.test_cli_runner(mix_stderr=False).invoke(
+            args=["cafe", "import", *args]
+        )
+
+    def test_import_cities_and_cafes(self):
+        cities = self._write(
+            "cities.csv", "code,name,state\n" "sf,San Francisco,ca\n" "oak,Oakland,CA\n"
+        )
+        result = self._import("cities", cities)
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn("Imported 2 cities", result.stdout)
+        self.assertEqual(city_cache.get("sf").state, "CA")
+
+        cafes = self._write(
+            "cafes.jsonl",
+            '{"name": "Perch", "address": "440 Grand Ave", "city_code": "oak"}\n'
+            '{"name": "Bernie\'s", "address": "3966 24th St", "city_code": "sf",'
+            ' "description": "Noe Valley"}\n',
+        )
+        result = self._import("cafes", cafes, "--chunk-size", "1")
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertEqual(Cafe.query.count(), 2)
+
+        perch = Cafe.query.filter_by(name="Perch").one()
+        self.assertEqual(perch.image_url, "/static/images/default-cafe.jpg")
+        self.assertEqual(
+            [cafe.id for cafe, rank in Cafe.search("noe valley", 10)],
+            [Cafe.query.filter_by(city_code="sf").one().id],
+        )
+
+    def test_import_upserts(self):
+        cities = self._write(
+            "cities.jsonl", '{"code": "sf", "name": "SF", "state": "CA"}\n'
+        )
+        self._import("cities", cities)
+
+        cafes = self._write(
+            "cafes.csv",
+            "name,address,city_code,description\n"
+            "Perch,440 Grand Ave,sf,old\n"
+            "Perch,440 Grand Ave,sf,newer\n",
+        )
+        self._import("cafes", cafes)
+        self.assertEqual(Cafe.query.one().description, "newer")
+
+        cafes = self._write(
+            "cafes.csv",
+            "name,address,city_code,description\n" "Perch,440 Grand Ave,sf,newest\n",
+        )
+        self._import("cafes", cafes)
+        self.assertEqual(Cafe.query.one().description, "newest")
+
+    def test_import_reindexes_touched_cafes(self):
+        cities = self._write(
+            "cities.csv", "code,name,state\nsf,SF,CA\noak,Oakland,CA\n"
+        )
+        self._import("cities", cities)
+        cafes = self._write(
+            "cafes.csv",
+            "name,address,city_code\n"
+            "Perch,440 Grand Ave,oak\n"
+            "Bernie's,3966 24th St,sf\n",
+        )
+        self._import("cafes", cafes)
+        bernies = Cafe.query.filter_by(city_code="sf").one()
+
+        backend = search.BACKENDS[db.engine.dialect.name]
+        cities = self._write("cities.csv", "code,name,state\nsf,San Francisco,CA\n")
+        with mock.patch.object(backend, "reindex") as reindex, mock.patch.object(
+            backend, "index", wraps=backend.index
+        ) as index:
+            result = self._import("cities", cities)
+
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        reindex.assert_not_called()
+        self.assertEqual(
+            [cafe_id for call in index.call_args_list for cafe_id in call.args[1]],
+            [bernies.id],
+        )
+        self.assertEqual(
+            [cafe.id for cafe, rank in Cafe.search("francisco", 10)], [bernies.id]
+        )
+
+    def test_import_reports_bad_rows(self):
+        cities = self._write(
+            "cities.jsonl",
+            '{"code": "sf", "name": "SF", "state": "CA"}\n'
+            "not json\n"
+            '{"code": "oak", "name": "Oakland", "state": "Calif"}\n'
+            '{"code": "", "name": "Nowhere", "state": "CA"}\n',
+        )
+        result = self._import("cities", cities)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Imported 1 cities; 3 rows skipped.", result.stdout)
+        self.assertIn("cities.jsonl:2: invalid JSON", result.stderr)
+        self.assertIn("cities.jsonl:3: state is longer", result.stderr)
+        self.assertIn("cities.jsonl:4: code is required", result.stderr)
+
+        cafes = self._write(
+            "cafes.csv", "name,address,city_code\n" "Perch,440 Grand Ave,nyc\n"
+        )
+        result = self._import("cafes", cafes)
+        self.assertIn("cafes.csv:2: unknown city_code 'nyc'", result.stderr)
+        self.assertEqual(Cafe.query.count(), 0)
+
+    def test_import_keeps_empty_strings(self):
+        cities = self._write(
+            "cities.jsonl", '{"code": "sf", "name": "SF", "state": "CA"}\n'
+        )
+        self._import("cities", cities)
+
+        cafes = self._write(
+            "cafes.csv", "name,address,city_code\n" "Perch,440 Grand Ave,sf\n"
+        )
+        result = self._import("cafes", cafes)
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        perch = Cafe.query.one()
+        self.assertEqual((perch.description, perch.url), ("", ""))
+
+    def test_upsert_chunks_with_other_columns(self):
+        # on Postgres, chunks go through COPY and a staging table, which
+        # must read "" as an empty string and fit each chunk's columns
+        keys = ["name", "address", "city_code"]
+        cafe = dict(
+            name="Perch",
+            address="440 Grand Ave",
+            city_code="sf",
+            description="",
+            url="",
+            image_url="",
+        )
+        with db.engine.begin() as conn:
+            upsert(
+                conn, City.__table__, [dict(code="sf", name="SF", state="CA")], ["code"]
+            )
+            upsert(conn, Cafe.__table__, [cafe], keys)
+        with db.engine.begin() as conn:
+            upsert(conn, Cafe.__table__, [cafe | {"latitude": 37.8}], keys)
+            upsert(conn, Cafe.__table__, [cafe | {"description": "d"}], keys)
+
+        perch = Cafe.query.one()
+        self.assertEqual((perch.description, perch.url, perch.image_url), ("d", "", ""))
+        self.assertEqual(perch.latitude, 37.8)
+
+
+class GenerateCommandTestCase(TestCase):
+    """Tests for `flask cafe generate`."""
+
+    def setUp(self):
+        """Before each test, clear cafes, cities and users."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """After each test, remove everything generated."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def _generate(self, *args):
+        return app.test_cli_runner(mix_stderr=False).invoke(
+            args=["cafe", "generate", *args]
+        )
+
+    def test_generate(self):
+        backend = search.BACKENDS[db.engine.dialect.name]
+        with mock.patch.object(backend, "reindex") as reindex:
+            result = self._generate(
+                "--cities", "3", "--cafes", "20", "--users", "5", "--chunk-size", "7"
+            )
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        # each chunk indexes its own cafes; nothing rebuilds the index
+        reindex.assert_not_called()
+        self.assertIn("Generated 3 cities, 20 cafes and 5 users.", result.stdout)
+        self.assertEqual(City.query.count(), 3)
+        self.assertEqual(Cafe.query.count(), 20)
+
+        user = User.query.first()
+        self.assertEqual(User.authenticate(user.username, "password"), user)
+        self.assertTrue(User.username_taken(user.username))
+
+        for cafe in Cafe.query:
+            self.assertIn(cafe.id, [c.id for c, rank in Cafe.search(cafe.address, 20)])
+
+    def test_generate_is_deterministic(self):
+        self._generate("--cities", "2", "--cafes", "10", "--seed", "7")
+        first = sorted((c.name, c.address) for c in Cafe.query)
+
+        self._generate("--cities", "2", "--cafes", "10", "--seed", "7")
+        self.assertEqual(sorted((c.name, c.address) for c in Cafe.query), first)
+
+    def test_generate_needs_cities(self):
+        result = self._generate("--cafes", "5")
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("no cities", result.stderr)
+
+
+#######################################
+# image proxy
+
+
+class ImageStub(BaseHTTPRequestHandler):
+    """Serves generated images: /photo.jpg, /logo.png; redirects from
+    /redirect/...; anything else 404s."""
+
+    hits = 0
+    REDIRECTS = {
+        "/redirect/photo": "/photo.jpg",
+        "/redirect/file": "file:///etc/passwd",
+        "/redirect/loop": "/redirect/loop",
+    }
+
+    def do_GET(self):
+        type(self).hits += 1
+        if self.path in self.REDIRECTS:
+            self.send_response(302)
+            self.send_header("Location", self.REDIRECTS[self.path])
+            self.end_headers()
+            return
+        if self.path == "/photo.jpg":
+            body, ctype = _image_bytes("JPEG", "RGB", (1600, 1200)), "image/jpeg"
+        elif self.path == "/logo.png":
+            body, ctype = _image_bytes("PNG", "RGBA", (500, 500)), "image/png"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _image_bytes(fmt, mode, size):
+    out = io.BytesIO()
+    Image.new(mode, size, "orange").save(out, fmt)
+    return out.getvalue()
+
+
+class ImageProxyTestCase(TestCase):
+    """Tests for the /img resizing proxy."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app.config["IMAGE_CACHE_DIR"] = self.tmpdir.name
+        # the stub server is on localhost
+        app.config["IMAGE_ALLOW_PRIVATE_HOSTS"] = True
+        app.extensions.pop("image_proxy", None)
+        ImageStub.hits = 0
+
+    def tearDown(self):
+        get_proxy().shutdown()
+        app.extensions.pop("image_proxy", None)
+        app.config.pop("IMAGE_CACHE_DIR")
+        app.config.pop("IMAGE_ALLOW_PRIVATE_HOSTS")
+        self.tmpdir.cleanup()
+
+    def _url(self, path, size="card"):
+        with app.test_request_context():
+            return thumbnail_url(self.base + path, size)
+
+    def test_resizes_and_caches(self):
+        url = self._url("/photo.jpg")
+        with app.test_client() as client:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/jpeg")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (600, 320))
+
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(ImageStub.hits, 1)
+
+    def test_keeps_transparency(self):
+        with app.test_client() as client:
+            resp = client.get(self._url("/logo.png", "large"))
+            self.assertEqual(resp.mimetype, "image/png")
+            # "large" shrinks to fit and never enlarges
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (500, 500))
+
+    def test_rejects_bad_requests(self):
+        url = self._url("/photo.jpg")
+        with app.test_client() as client:
+            resp = client.get(url.replace("/card/", "/large/"))
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.get(url.replace("photo", "other"))
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.get(self._url("/missing.jpg"))
+            self.assertEqual(resp.status_code, 502)
+
+    def test_caches_failures(self):
+        url = self._url("/missing.jpg")
+        with app.test_client() as client:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 502)
+            self.assertEqual(resp.cache_control.max_age, 60)
+
+            # other sizes of the same source aren't fetched either
+            for url in [url, self._url("/missing.jpg", "large")]:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 404)
+                self.assertEqual(resp.cache_control.max_age, 60)
+            self.assertEqual(ImageStub.hits, 1)
+
+            later = time.monotonic() + 61
+            with mock.patch("thumbnails.time.monotonic", return_value=later):
+                resp = client.get(url)
+            self.assertEqual(resp.status_code, 502)
+            self.assertEqual(ImageStub.hits, 2)
+
+    def test_checks_every_redirect(self):
+        with app.test_client() as client:
+            resp = client.get(self._url("/redirect/photo"))
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get(self._url("/redirect/file"))
+            self.assertEqual(resp.status_code, 502)
+
+            resp = client.get(self._url("/redirect/loop"))
+            self.assertEqual(resp.status_code, 502)
+            # the redirect and the photo, one redirect, and four of them
+            self.assertEqual(ImageStub.hits, 2 + 1 + 4)
+
+    def test_refuses_private_hosts(self):
+        app.config["IMAGE_ALLOW_PRIVATE_HOSTS"] = False
+        with app.test_client() as client:
+            resp = client.get(self._url("/photo.jpg"))
+            self.assertEqual(resp.status_code, 502)
+            self.assertEqual(ImageStub.hits, 0)
+
+        proxy = get_proxy()
+        for url in [
+            "http://169.254.169.254/latest/meta-data/",
+            "http://localhost/photo.jpg",
+            "http://10.0.0.7/photo.jpg",
+            "http://[::ffff:127.0.0.1]/photo.jpg",
+            "ftp://93.184.216.34/photo.jpg",
+        ]:
+            with self.assertRaises(ImageError, msg=url):
+                proxy.check_url(url)
+        proxy.check_url("https://93.184.216.34/photo.jpg")
+
+    def test_local_images_not_proxied(self):
+        with app.test_request_context():
+            self.assertEqual(
+                thumbnail_url("/static/images/default-cafe.jpg", "card"),
+                "/static/images/default-cafe.jpg",
+            )
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        cache = DiskCache(self.tmpdir.name, max_bytes=250)
+        cache.put("a", b"x" * 100)
+        cache.put("b", b"x" * 100)
+        os.utime(cache.get("a"), (1, 1))
+        os.utime(cache.get("b"), (2, 2))
+        cache.get("a")
+
+        cache.put("c", b"x" * 100)
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+
+
+#######################################
+# static assets
+
+
+class AssetsTestCase(TestCase):
+    """Tests for fingerprinted, precompressed assets."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app.config["ASSETS_DIST_DIR"] = self.tmpdir.name
+        app.extensions.pop("assets", None)
+
+    def tearDown(self):
+        app.config.pop("ASSETS_DIST_DIR")
+        app.extensions.pop("assets", None)
+        self.tmpdir.cleanup()
+
+    def _build(self):
+        result = app.test_cli_runner(mix_stderr=False).invoke(
+            args=["cafe", "build-assets"]
+        )
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        match = re.search(r"vendor/jquery.min.js -> (\S+)", result.stdout)
+        return match.group(1)
+
+    def test_unbuilt_assets_use_static(self):
+        with app.test_client() as client:
+            resp = client.get("/")
+            self.assertIn(b'src="/static/vendor/jquery.min.js" defer', resp.data)
+
+    def test_built_assets(self):
+        jquery = self._build()
+        self.assertRegex(jquery, r"^jquery\.min\.[0-9a-f]{12}\.js$")
+        with open(os.path.join(app.static_folder, "vendor/jquery.min.js"), "rb") as f:
+            original = f.read()
+
+        with app.test_client() as client:
+            resp = client.get("/")
+            self.assertIn(f'src="/assets/{jquery}" defer'.encode(), resp.data)
+            self.assertNotIn(b"unpkg.com", resp.data)
+
+            resp = client.get(
+                f"/assets/{jquery}", headers={"Accept-Encoding": "gzip, br"}
+            )
+            self.assertEqual(resp.headers["Content-Encoding"], "br")
+            self.assertEqual(resp.mimetype, "text/javascript")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertEqual(brotli.decompress(resp.data), original)
+
+            resp = client.get(f"/assets/{jquery}", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertEqual(gzip.decompress(resp.data), original)
+
+            resp = client.get(f"/assets/{jquery}")
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertEqual(resp.data, original)
+
+            resp = client.get("/assets/manifest.json")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_rebuild_changes_etags(self):
+        self._build()
+        with app.test_client() as client:
+            etag = client.get("/cafes").headers["ETag"]
+
+            # a build of changed assets, as a restarted app would load it
+            with tempfile.TemporaryDirectory() as static:
+                os.mkdir(os.path.join(static, "vendor"))
+                with open(os.path.join(static, "vendor", "app.js"), "w") as f:
+                    f.write("console.log('v2');")
+                build_assets(static, self.tmpdir.name)
+            app.extensions.pop("assets")
+
+            resp = client.get("/cafes", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers["ETag"]
+
+            app.config["BUILD_ID"] = "v2"
+            try:
+                resp = client.get("/cafes", headers={"If-None-Match": etag})
+            finally:
+                app.config["BUILD_ID"] = None
+            self.assertEqual(resp.status_code, 200)
+
+    def test_rebuild_removes_stale_files(self):
+        stale = os.path.join(self.tmpdir.name, "old.0123456789ab.js")
+        open(stale, "w").close()
+        self._build()
+        self.assertFalse(os.path.exists(stale))
+
+
+#######################################
+# templates
+
+
+class CompressionTestCase(TestCase):
+    """Tests for the response compression middleware."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.add_all(
+            [
+                Cafe(**{**CAFE_DATA, "name": f"Cafe {i:02}", "address": f"{i} St"})
+                for i in range(30)
+            ]
+        )
+        db.session.commit()
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def _wsgi(self, body, headers, status="200 OK"):
+        """A WSGI app returning `body`, a list of byte strings."""
+
+        def wsgi_app(environ, start_response):
+            start_response(status, list(headers.items()))
+            return body
+
+        return wsgi_app
+
+    def _call(self, wsgi_app, accept="gzip, br", **kwargs):
+        middleware = CompressionMiddleware(wsgi_app, **kwargs)
+        environ = {"REQUEST_METHOD": "GET", "HTTP_ACCEPT_ENCODING": accept}
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response.update(status=status, headers=dict(headers))
+
+        chunks = list(middleware(environ, start_response))
+        return response["headers"], chunks
+
+    def test_html(self):
+        with app.test_client() as client:
+            plain = client.get("/cafes")
+            resp = client.get("/cafes", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertEqual(int(resp.headers["Content-Length"]), len(resp.data))
+        self.assertLess(len(resp.data), len(plain.data) / 4)
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+        # a 304 still works with the weakened ETag
+        self.assertEqual(resp.headers["ETag"], "W/" + plain.headers["ETag"])
+        with app.test_client() as client:
+            resp = client.get(
+                "/cafes",
+                headers={
+                    "Accept-Encoding": "gzip",
+                    "If-None-Match": resp.headers["ETag"],
+                },
+            )
+        self.assertEqual(resp.status_code, 304)
+
+    def test_negotiation(self):
+        body = [b"x" * 1000]
+        wsgi_app = self._wsgi(body, {"Content-Type": "application/json"})
+        for accept, encoding in [
+            ("gzip, deflate, br", "br"),
+            ("br;q=0.5, gzip", "gzip"),
+            ("br;q=0, *", "gzip"),
+            ("identity", None),
+            ("", None),
+        ]:
+            headers, chunks = self._call(wsgi_app, accept)
+            self.assertEqual(headers.get("Content-Encoding"), encoding, accept)
+
+        headers, chunks = self._call(wsgi_app, "br")
+        self.assertEqual(brotli.decompress(b"".join(chunks)), body[0])
+
+    def test_skipped(self):
+        big = [b"x" * 1000]
+        for headers in [
+            {"Content-Type": "image/png"},
+            {"Content-Type": "text/css", "Content-Encoding": "br"},
+            {"Content-Type": "text/html", "Cache-Control": "no-transform"},
+            {"Content-Type": "text/html", "Content-Length": "1000"},
+        ]:
+            out, chunks = self._call(self._wsgi(big, headers), min_size=2000)
+            self.assertEqual(
+                out.get("Content-Encoding"), headers.get("Content-Encoding"), headers
+            )
+            self.assertEqual(chunks, big)
+
+        # too small once the whole stream has been read, too
+        out, chunks = self._call(
+            self._wsgi([b"a" * 100, b"b" * 100], {"Content-Type": "text/html"})
+        )
+        self.assertNotIn("Content-Encoding", out)
+        self.assertEqual(out["Content-Length"], "200")
+        self.assertEqual(b"".join(chunks), b"a" * 100 + b"b" * 100)
+
+        out, chunks = self._call(
+            self._wsgi(big, {"Content-Type": "text/html"}, status="206 Partial Content")
+        )
+        self.assertNotIn("Content-Encoding", out)
+
+    def test_streamed(self):
+        stream_app = create_app(
+            type("Config", (CONFIGS["test"],), {"STREAM_LIST_PAGES": True})
+        )
+
+        with mock.patch.object(ListView, "chunk_size", 2000):
+            with stream_app.test_client() as client:
+                plain = client.get("/cafes?per_page=30").data
+                resp = client.get(
+                    "/cafes?per_page=30",
+                    headers={"Accept-Encoding": "gzip"},
+                    buffered=False,
+                )
+                self.assertTrue(resp.is_streamed)
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertNotIn("Content-Length", resp.headers)
+                chunks = list(resp.response)
+
+        self.assertGreater(len(chunks), 3)
+        # each chunk is flushed, so the top of the page can be read from
+        # the first one alone
+        self.assertIn(b'class="navbar', zlib.decompressobj(31).decompress(chunks[0]))
+        self.assertEqual(gzip.decompress(b"".join(chunks)), plain)
+
+    def test_metrics(self):
+        with app.test_client() as client, mock.patch.dict(
+            app.config, {"METRICS_ALLOWED_IPS": ("127.0.0.1",)}
+        ):
+            client.get("/cafes", headers={"Accept-Encoding": "br"})
+            resp = client.get("/metrics")
+
+        saved = re.search(
+            r'flaskcafe_compression_saved_bytes_total\{encoding="br"\} (\d+)', resp.text
+        )
+        self.assertGreater(int(saved.group(1)), 1000)
+        self.assertIn('flaskcafe_compressed_responses_total{encoding="br"}', resp.text)
+
+
+class TemplateCacheTestCase(TestCase):
+    """Tests for the template bytecode cache and warm-up."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _app(self, **settings):
+        return create_app(type("Config", (CONFIGS["test"],), settings))
+
+    def _count(self, test_app):
+        return len(
+            test_app.jinja_env.list_templates(
+                filter_func=lambda name: name.endswith(".html")
+            )
+        )
+
+    def test_compile_templates_command(self):
+        cache_dir = os.path.join(self.tmpdir.name, "jinja")
+        test_app = self._app(TEMPLATE_CACHE_DIR=cache_dir)
+
+        # commands use the app context that's already pushed, if any
+        with test_app.app_context():
+            result = test_app.test_cli_runner(mix_stderr=False).invoke(
+                args=["cafe", "compile-templates"]
+            )
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        count = self._count(test_app)
+        self.assertIn(f"Compiled {count} templates; 0 failed.", result.stdout)
+        self.assertEqual(len(os.listdir(cache_dir)), count)
+
+        # a fresh app (a new worker) loads the bytecode instead of compiling
+        fresh = self._app(TEMPLATE_CACHE_DIR=cache_dir)
+        with mock.patch.object(fresh.jinja_env, "compile", side_effect=AssertionError):
+            fresh.jinja_env.get_template("base.html")
+
+    def test_warmup(self):
+        self.assertEqual(len(self._app().jinja_env.cache), 0)
+
+        test_app = self._app(TEMPLATE_WARMUP=True)
+        self.assertEqual(len(test_app.jinja_env.cache), self._count(test_app))
+
+
+#######################################
+# schema
+
+
+class MigrationsTestCase(TestCase):
+    """Tests that the migrations build the schema the models describe."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            "sqlite:///" + os.path.join(self.tmpdir.name, "migrated.db")
+        )
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_upgrade_matches_models(self):
+        with self.engine.begin() as conn:
+            migrate.upgrade(conn)
+
+        with self.engine.connect() as conn:
+            context = MigrationContext.configure(
+                conn,
+                opts={
+                    "include_object": migrate.include_object,
+                },
+            )
+            self.assertEqual(compare_metadata(context, db.metadata), [])
+            self.assertIn("cafe_search", inspect(conn).get_table_names())
+
+    def test_upgrade_original_schema(self):
+        """A database from before the migrations keeps its rows."""
+
+        with self.engine.begin() as conn:
+            migrate.upgrade(conn, "0001")
+            conn.execute(
+                text(
+                    """
+                INSERT INTO cities (code, name, state)
+                VALUES ('sf', 'San Francisco', 'CA')
+            """
+                )
+            )
+            conn.execute(
+                text(
+                    """
+                INSERT INTO cafes
+                    (id, name, description, url, address, city_code,
+                     image_url)
+                VALUES (1, 'Test Cafe', 'Test description', '',
+                        '500 Sansome St', 'sf', '')
+            """
+                )
+            )
+            migrate.upgrade(conn)
+
+        with self.engine.connect() as conn:
+            context = MigrationContext.configure(
+                conn,
+                opts={
+                    "include_object": migrate.include_object,
+                },
+            )
+            self.assertEqual(compare_metadata(context, db.metadata), [])
+
+            cafe = conn.execute(
+                text("SELECT like_count, updated_at FROM cafes WHERE id = 1")
+            ).one()
+            self.assertEqual(cafe.like_count, 0)
+            self.assertIsNotNone(cafe.updated_at)
+
+            backend = search.backend_for(conn)
+            self.assertEqual(
+                [cafe_id for cafe_id, _ in backend.search(conn, ["sansome"], 10)], [1]
+            )
+
+    def test_downgrade(self):
+        with self.engine.begin() as conn:
+            migrate.upgrade(conn)
+            migrate.downgrade(conn, "0002")
+            indexes = {i["name"] for i in inspect(conn).get_indexes("cafes")}
+            self.assertNotIn("ix_cafes_name_id", indexes)
+            self.assertIn("ix_cafes_like_count_id", indexes)
+
+            migrate.downgrade(conn, "0001")
+            self.assertEqual(
+                sorted(inspect(conn).get_table_names()),
+                ["alembic_version", "cafes", "cities", "users"],
+            )
+            columns = {c["name"] for c in inspect(conn).get_columns("cafes")}
+            self.assertNotIn("like_count", columns)
+
+            migrate.downgrade(conn, "base")
+            self.assertEqual(inspect(conn).get_table_names(), ["alembic_version"])
+
+
+SQLITE_SCAN = re.compile(
+    r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?" r"(?: USING (?:COVERING )?INDEX (\w+))?"
+)
+
+
+def walks_ordering_index(statement, table, index):
+    """Is scanning `index` (None: the primary key) just reading a page?
+
+    That's so for an unfiltered `ORDER BY ... LIMIT` when the index is
+    the one in that order: the scan stops at the LIMIT. A scan with a
+    filter could read any amount of the table before filling the page.
+    """
+
+    order = re.search(r"\bORDER BY (.*?)\s+LIMIT\b", statement, re.S)
+    if not order or re.search(r"\bWHERE\b", statement):
+        return False
+
+    # newer SQLite names an aliased table by its alias alone
+    table = db.metadata.tables.get(table)
+    if table is None:
+        return False
+    if index is None:
+        columns = [column.name for column in table.primary_key]
+    else:
+        columns = next(
+            (
+                [column.name for column in i.columns]
+                for i in table.indexes
+                if i.name == index
+            ),
+            [],
+        )
+    ordered_by = [term.split()[0].split(".")[-1] for term in order.group(1).split(",")]
+    return columns[: len(ordered_by)] == ordered_by
+
+
+def full_scans(conn, statement, parameters):
+    """Return the steps of `statement`'s plan that read a whole table.
+
+    On SQLite those are scans of a table or any of its indexes, except
+    walking the index a page is ordered by, and sorts into a temporary
+    b-tree, except ranking full-text matches. On Postgres, with
+    sequential scans discouraged as far as the planner allows, they're
+    any Seq Scan that's left.
+    """
+
+    if conn.dialect.name == "sqlite":
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+        details = [detail for *_, detail in rows]
+        scans = [
+            detail
+            for detail in details
+            if (match := SQLITE_SCAN.match(detail))
+            and "VIRTUAL TABLE" not in detail
+            and detail != "SCAN CONSTANT ROW"
+            and not walks_ordering_index(statement, *match.groups())
+        ]
+        # full-text matches can only be ranked by sorting them
+        if not any("VIRTUAL TABLE" in detail for detail in details):
+            scans += [detail for detail in details if "TEMP B-TREE" in detail]
+        return scans
+
+    conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    rows = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).all()
+    return [line for line, in rows if "Seq Scan" in line]
+
+
+class QueryPlanTestCase(TestCase):
+    """Checks that the hot read queries are all served by indexes."""
+
+    # on top of the usual reads: g.user and each page's table versions
+    PATHS = [
+        "/cafes",
+        "/cafes?order=-name",
+        "/cafes?order=-like_count",
+        "/cafes?order=id&per_page=5",
+        "/cafes/{cafe_id}",
+        "/cafes/nearby?lat={lat}&lng={lng}&radius=5",
+        "/cafes/search?q=coffee",
+        "/api/cafes",
+        "/api/cafes?city={city_code}",
+        "/api/cafes?city={city_code}&order=-name",
+        "/api/cafes/{cafe_id}",
+        "/api/cafes/{cafe_id}?fields=id,name",
+        "/api/likes?cafe_id={cafe_id}",
+    ]
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        generate(db.engine, cities=20, cafes=2000, users=50, seed=1, rounds=4)
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+
+        cafe = Cafe.query.filter(Cafe.latitude.is_not(None)).first()
+        self.params = dict(
+            cafe_id=cafe.id,
+            city_code=cafe.city_code,
+            lat=cafe.latitude,
+            lng=cafe.longitude,
+        )
+        self.user_id = User.query.first().id
+        # a lookup table held in memory; requests just check its version
+        city_cache.get(cafe.city_code)
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def _statements(self, path):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user_id)
+                resp = client.get(path)
+                self.assertEqual(resp.status_code, 200, path)
+                next_url = re.search(r'href="([^"]*after=[^"]*)"', resp.text)
+                if next_url:
+                    client.get(next_url.group(1).replace("&amp;", "&"))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        return statements
+
+    def test_no_full_scans(self):
+        checked = 0
+        failures = []
+        for path in self.PATHS:
+            path = path.format(**self.params)
+            for statement, parameters in self._statements(path):
+                with db.engine.connect() as conn, conn.begin():
+                    scans = full_scans(conn, statement, parameters)
+                # a few shard rows per versioned table (VERSION_SHARDS at
+                # most), all of them summed; SQLite rightly just reads them
+                scans = [s for s in scans if s != "SCAN table_versions"]
+                if scans:
+                    failures.append(f"{path}: {scans}\n{statement}")
+                checked += 1
+
+        self.assertEqual(failures, [], "\n\n".join(failures))
+        self.assertGreater(checked, len(self.PATHS))
+
+
+#######################################
+# users
+
+
+class UserModelTestCase(TestCase):
+    """Tests for the user model."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user = user
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+        username_index.invalidate()
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertFalse(rez)
+
+        rez = User.authenticate("test", "password")
+        self.assertFalse(rez)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.password[:4], "$2b$")
+        db.session.rollback()
+
+    def test_username_taken(self):
+        self.assertTrue(User.username_taken("test"))
+        self.assertFalse(User.username_taken("no-such-user"))
+
+        # names the Bloom filter hasn't seen are answered without a query
+        username_index.might_exist("warm-up")
+        with count_queries() as statements:
+            self.assertFalse(User.username_taken("no-such-user"))
+        self.assertEqual(statements, [])
+
+        # new users are added to the filter when committed, without a
+        # rebuild
+        for username in ("newbie", "newbie2", "newbie3"):
+            User.register(**{**TEST_USER_DATA, "username": username})
+            db.session.commit()
+        with count_queries() as statements:
+            self.assertFalse(User.username_taken("no-such-user"))
+            self.assertTrue(User.username_taken("newbie"))
+        self.assertEqual(len(statements), 1)
+
+    def test_username_taken_in_another_process(self):
+        username_index.might_exist("warm-up")
+        # as another worker would: this process's filter never sees it
+        with db.engine.begin() as conn:
+            conn.execute(
+                User.__table__.insert().values(
+                    **{**TEST_USER_DATA, "username": "elsewhere"},
+                    image_url="",
+                    admin=False,
+                )
+            )
+
+        # until the filter is rebuilt, the unique column catches it
+        self.assertFalse(User.username_taken("elsewhere"))
+
+        later = time.monotonic() + 301
+        with mock.patch("models.monotonic", return_value=later):
+            self.assertTrue(User.username_taken("elsewhere"))
+            with app.test_client() as client:
+                resp = client.get("/api/username-available?username=elsewhere")
+                self.assertFalse(resp.json["available"])
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        names = [f"user-{i}" for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+        false_positives = sum(f"other-{i}" in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_authenticate_rehashes(self):
+        self.user.password = hash_password("secret", 5)
+        db.session.commit()
+
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+        self.assertEqual(self.user.password[:7], "$2b$04$")
+
+        # unchanged when the cost is already right
+        password = self.user.password
+        User.authenticate("test", "secret")
+        self.assertEqual(self.user.password, password)
+
+    def test_hashing_busy(self):
+        hasher = PasswordHasher(workers=1, max_queue=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        def submit_blocking():
+            with app.app_context():
+                hasher.submit(block)
+
+        blocker = threading.Thread(target=submit_blocking)
+        blocker.start()
+        try:
+            started.wait()
+            with self.assertRaises(HashingBusy):
+                hasher.hash("secret")
+        finally:
+            release.set()
+            blocker.join()
+
+        self.assertTrue(hasher.check(hasher.hash("secret"), "secret"))
+        hasher.shutdown()
+
+    def test_hashing_timeout(self):
+        hasher = PasswordHasher(workers=1, max_queue=2)
+        release = threading.Event()
+
+        app.config["PASSWORD_HASH_TIMEOUT"] = 0.05
+        try:
+            with self.assertRaises(HashingBusy):
+                hasher.submit(release.wait)
+        finally:
+            del app.config["PASSWORD_HASH_TIMEOUT"]
+            release.set()
+        hasher.shutdown()
+
+
+class AuthViewsTestCase(TestCase):
+    """Tests for views on logging in/logging out/registration."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        login_throttle.reset()
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_signup(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b"Sign Up", resp.data)
+
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA_NEW,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"You are signed up and logged in.", resp.data)
+            self.assertTrue(session.get(CURR_USER_KEY))
+
+    def test_signup_username_taken(self):
+        with app.test_client() as client:
+            resp = client.get("/signup")
+            self.assertIn(b"Sign Up", resp.data)
+
+            # signup with same data as the already-added user
+            resp = client.post(
+                "/signup",
+                data=TEST_USER_DATA,
+                follow_redirects=True,
+            )
+
+            # breakpoint()
+
+            self.assertIn(b"Username already taken", resp.data)
+
+    def test_signup_username_taken_no_hash(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                resp = client.post("/signup", data=TEST_USER_DATA)
+
+            self.assertIn(b"Username already taken", resp.data)
+            self.assertFalse([s for s in statements if s.startswith("INSERT")])
+
+    def test_username_available(self):
+        with app.test_client() as client:
+            resp = client.get("/api/username-available?username=test")
+            self.assertEqual(resp.json, {"username": "test", "available": False})
+
+            resp = client.get("/api/username-available?username=someone")
+            self.assertEqual(resp.json, {"username": "someone", "available": True})
+
+            resp = client.get("/api/username-available")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_login(self):
+        with app.test_client() as client:
+            resp = client.get("/login")
+            self.assertIn(b"Welcome Back!", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "WRONG"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Invalid credentials", resp.data)
+
+            resp = client.post(
+                "/login",
+                data={"username": "test", "password": "secret"},
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"Hello, test", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
+
+    def test_logout(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.post("/logout", follow_redirects=True)
+
+            self.assertIn(b"successfully logged out", resp.data)
+            self.assertEqual(session.get(CURR_USER_KEY), None)
+
+
+class LoginThrottleTestCase(TestCase):
+    """Tests for throttling login attempts."""
+
+    def setUp(self):
+        """Before each test, add a sample user and tighten the limits."""
+
+        login_throttle.reset()
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        app.config["LOGIN_THROTTLE_USER_BURST"] = 2
+        app.config["LOGIN_THROTTLE_IP_BURST"] = 3
+
+    def tearDown(self):
+        """After each test, remove all users and restore the limits."""
+
+        del app.config["LOGIN_THROTTLE_USER_BURST"]
+        del app.config["LOGIN_THROTTLE_IP_BURST"]
+        login_throttle.reset()
+
+        User.query.delete()
+        db.session.commit()
+
+    def _login(self, client, username="test"):
+        return client.post(
+            "/login", data={"username": username, "password": "wrong-pw"}
+        )
+
+    def test_throttled_by_username(self):
+        app.config["LOGIN_THROTTLE_IP_BURST"] = 10
+
+        with app.test_client() as client:
+            self.assertEqual(self._login(client).status_code, 200)
+            self.assertEqual(self._login(client).status_code, 200)
+
+            with count_queries() as statements:
+                resp = self._login(client)
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn(b"Too many login attempts", resp.data)
+            self.assertTrue(resp.headers["Retry-After"])
+            self.assertEqual(statements, [])
+
+            # same name, different case, is the same bucket
+            self.assertEqual(self._login(client, "TEST").status_code, 429)
+
+        self.assertEqual(login_throttle.counters["allowed"], 2)
+        self.assertEqual(login_throttle.counters["throttled_user"], 2)
+
+    def test_throttled_by_ip(self):
+        with app.test_client() as client:
+            for username in ["a", "b", "c"]:
+                self.assertEqual(self._login(client, username).status_code, 200)
+            self.assertEqual(self._login(client, "d").status_code, 429)
+
+        self.assertEqual(login_throttle.counters["throttled_ip"], 1)
+
+    def test_throttled_by_forwarded_ip(self):
+        # behind a proxy, each client gets its own bucket
+        proxied = create_app(
+            type(
+                "Config",
+                (CONFIGS["test"],),
+                {
+                    "TRUSTED_PROXIES": 1,
+                    "LOGIN_THROTTLE_IP_BURST": 3,
+                    "LOGIN_THROTTLE_USER_BURST": 10,
+                },
+            )
+        )
+
+        def login(client, username, ip):
+            return client.post(
+                "/login",
+                data={"username": username, "password": "wrong-pw"},
+                headers={"X-Forwarded-For": ip},
+                environ_base={"REMOTE_ADDR": "10.0.0.1"},
+            )
+
+        with proxied.test_client() as client:
+            for username in ["a", "b", "c"]:
+                self.assertEqual(
+                    login(client, username, "203.0.113.1").status_code, 200
+                )
+            self.assertEqual(login(client, "d", "203.0.113.1").status_code, 429)
+            self.assertEqual(login(client, "d", "203.0.113.2").status_code, 200)
+
+            # only the proxy's own entry counts, not what the client sent
+            self.assertEqual(
+                login(client, "e", "198.51.100.7, 203.0.113.1").status_code, 429
+            )
+
+    def test_bucket_refills(self):
+        storage = MemoryStorage()
+        self.assertEqual(storage.consume("k", 1, 0.5, now=0), (True, 0))
+        self.assertEqual(storage.consume("k", 1, 0.5, now=1), (False, 1.0))
+        self.assertEqual(storage.consume("k", 1, 0.5, now=2), (True, 0))
+
+    def test_memory_storage_bounded(self):
+        storage = MemoryStorage(max_keys=2)
+        for key in ["a", "b", "c"]:
+            storage.consume(key, 1, 1, now=0)
+        self.assertEqual(list(storage._buckets), ["b", "c"])
+
+
+class CurrentUserTestCase(TestCase):
+    """Tests for loading the logged-in user onto `g`."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def _user_queries(self, statements):
+        return [s for s in statements if "FROM users" in s]
+
+    def test_user_loaded_once(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            with count_queries() as statements:
+                resp = client.get("/profile")
+
+            self.assertIn(b"Testy MacTest", resp.data)
+            self.assertEqual(len(self._user_queries(statements)), 1)
+
+    def test_user_not_loaded_when_unused(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            with count_queries() as statements:
+                resp = client.get("/static/images/default-pic.png")
+                resp.close()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(statements, [])
+
+    def test_user_not_leaked_between_requests(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            resp = client.get("/")
+            self.assertIn(b"Testy MacTest", resp.data)
+
+        with app.test_client() as client:
+            resp = client.get("/")
+            self.assertNotIn(b"Testy MacTest", resp.data)
+            self.assertIn(b"Sign Up", resp.data)
+
+
+# class NavBarTestCase(TestCase):
+#     """Tests navigation bar."""
+
+#     def setUp(self):
+#         """Before tests, add sample user."""
+
+#         User.query.delete()
+
+#         user = User.register(**TEST_USER_DATA)
 
 #         db.session.add_all([user])
 #         db.session.commit()
@@ -502,6 +2851,166 @@ class AuthViewsTestCase(TestCase):
 
 
 class LikeViewsTestCase(TestCase):
-    """Tests for views on cafes."""
+    """Tests for liking cafes."""
+
+    def setUp(self):
+        """Before each test, add a city, a cafe and a user."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        user = User.register(**TEST_USER_DATA)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        """After each test, remove everything."""
+
+        Like.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def _like_count(self):
+        return db.session.get(Cafe, self.cafe_id).like_count
+
+    def test_like_is_idempotent(self):
+        user = db.session.get(User, self.user_id)
+        self.assertTrue(user.like(self.cafe_id))
+        self.assertFalse(user.like(self.cafe_id))
+        db.session.commit()
+
+        self.assertEqual(self._like_count(), 1)
+        self.assertEqual([c.id for c in user.liked_cafes], [self.cafe_id])
+
+        self.assertTrue(user.unlike(self.cafe_id))
+        self.assertFalse(user.unlike(self.cafe_id))
+        db.session.commit()
+
+        self.assertEqual(self._like_count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_like_views(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.post(f"/cafes/{self.cafe_id}/like", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"1 like", resp.data)
+            self.assertIn(b"Unlike", resp.data)
+
+            client.post(f"/cafes/{self.cafe_id}/like")
+            self.assertEqual(self._like_count(), 1)
+
+            resp = client.post(f"/cafes/{self.cafe_id}/unlike", follow_redirects=True)
+            self.assertIn(b"0 likes", resp.data)
+
+            resp = client.post("/cafes/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_like_views_check_csrf(self):
+        csrf_app = create_app(
+            type("Config", (CONFIGS["test"],), {"WTF_CSRF_ENABLED": True})
+        )
+        with csrf_app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            resp = client.post(f"/cafes/{self.cafe_id}/like")
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(self._like_count(), 0)
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            token = re.search(rb'name="csrf_token" value="([^"]+)"', resp.data)
+            resp = client.post(
+                f"/cafes/{self.cafe_id}/like",
+                data={"csrf_token": token.group(1).decode()},
+            )
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self._like_count(), 1)
+
+    def test_like_views_need_login(self):
+        with app.test_client() as client:
+            resp = client.post(f"/cafes/{self.cafe_id}/like")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn("/login", resp.location)
+            self.assertEqual(self._like_count(), 0)
+
+    def test_like_api(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.status_code, 401)
+
+            login_for_test(client, self.user_id)
+
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": False})
+
+            resp = client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.json, {"liked": self.cafe_id, "like_count": 1})
+            resp = client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.json["like_count"], 1)
+
+            resp = client.get(f"/api/likes?cafe_id={self.cafe_id}")
+            self.assertEqual(resp.json, {"likes": True})
+
+            resp = client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            self.assertEqual(resp.json, {"unliked": self.cafe_id, "like_count": 0})
+
+            resp = client.post("/api/like", json={})
+            self.assertEqual(resp.status_code, 400)
+            resp = client.post("/api/like", json={"cafe_id": 0})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_most_liked_order(self):
+        other = Cafe(**{**CAFE_DATA, "name": "Other Cafe"})
+        db.session.add(other)
+        db.session.commit()
+        db.session.get(User, self.user_id).like(other.id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/cafes?order=-like_count&fields=id,like_count")
+            self.assertEqual(
+                [item["id"] for item in resp.json["items"]], [other.id, self.cafe_id]
+            )
 
-    # FIXME: add setup/teardown/inidividual tests
+    def test_deleting_user_drops_likes(self):
+        user = db.session.get(User, self.user_id)
+        user.like(self.cafe_id)
+        db.session.commit()
+
+        User.query.delete()
+        db.session.commit()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(self._like_count(), 0)
+
+    def test_edit_cannot_set_like_count(self):
+        db.session.get(User, self.user_id).like(self.cafe_id)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.post(
+                f"/cafes/{self.cafe_id}/edit",
+                data={**CAFE_DATA, "name": "Renamed Cafe", "like_count": 100},
+            )
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(self._like_count(), 1)
+
+    def test_recount_likes(self):
+        db.session.add(Like(user_id=self.user_id, cafe_id=self.cafe_id))
+        db.session.commit()
+        self.assertEqual(self._like_count(), 0)
+
+        recount_likes(db.session.connection())
+        db.session.commit()
+        self.assertEqual(self._like_count(), 1)
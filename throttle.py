@@ -0,0 +1,117 @@
+"""Token-bucket throttling for login attempts.
+
+Every login attempt checks a bucket for the client IP and one for the
+username; an attempt is only let through (to the database and bcrypt) if
+both have a token left. Buckets refill at a steady rate, so a person who
+mistypes their password is barely slowed down while a credential-stuffing
+run is cut to a trickle.
+
+Configuration (read from the current app):
+
+- LOGIN_THROTTLE_ENABLED: default True.
+- LOGIN_THROTTLE_USER_BURST / LOGIN_THROTTLE_USER_PER_MINUTE: attempts per
+  username (default 5 at once, then 5 a minute).
+- LOGIN_THROTTLE_IP_BURST / LOGIN_THROTTLE_IP_PER_MINUTE: attempts per IP
+  (default 20 at once, then 20 a minute).
+"""
+
+import time
+from collections import Counter, OrderedDict
+from threading import Lock
+
+from flask import current_app
+
+
+class ThrottleStorage:
+    """Where bucket state lives.
+
+    The in-memory store is per process; replace it with one backed by a
+    shared store (e.g. Redis) so all workers enforce the same limits.
+    """
+
+    def consume(self, key, capacity, per_second, now):
+        """Take a token from `key`'s bucket.
+
+        Returns (allowed, retry_after) where retry_after is the number of
+        seconds until a token is available (0 if one was taken).
+        """
+
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+
+class MemoryStorage(ThrottleStorage):
+    """Buckets in a dict, least recently used dropped past `max_keys`."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def consume(self, key, capacity, per_second, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * per_second)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        retry_after = 0 if allowed else (1 - tokens) / per_second
+        return allowed, retry_after
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class LoginThrottle:
+    """Decides whether a login attempt may go ahead.
+
+    `counters` tallies allowed and throttled attempts for monitoring.
+    """
+
+    DEFAULTS = {
+        "ip": (20, 20),
+        "user": (5, 5),
+    }
+
+    def __init__(self, storage=None):
+        self.storage = storage or MemoryStorage()
+        self.counters = Counter()
+
+    def _consume(self, kind, key, now):
+        config = current_app.config
+        prefix = f"LOGIN_THROTTLE_{kind.upper()}"
+        burst = config.get(f"{prefix}_BURST", self.DEFAULTS[kind][0])
+        per_minute = config.get(f"{prefix}_PER_MINUTE", self.DEFAULTS[kind][1])
+        return self.storage.consume(f"{kind}:{key}", burst, per_minute / 60, now)
+
+    def check(self, ip, username):
+        """Return 0 if the attempt may proceed, else seconds to wait."""
+
+        if not current_app.config.get("LOGIN_THROTTLE_ENABLED", True):
+            return 0
+
+        now = time.monotonic()
+        for kind, key in (("ip", ip), ("user", username.strip().lower())):
+            allowed, retry_after = self._consume(kind, key, now)
+            if not allowed:
+                self.counters[f"throttled_{kind}"] += 1
+                return retry_after
+
+        self.counters["allowed"] += 1
+        return 0
+
+    def reset(self):
+        self.storage.reset()
+        self.counters.clear()
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,374 @@
+"""Resized, cached copies of remote cafe and user images.
+
+Templates used to hotlink full-size originals (often several MB) into
+small cards. Instead, `thumbnail_url(src, size)` points at /img/<size>/<sig>
+?src=..., which fetches the original once, resizes it on a process pool,
+keeps the result in a size-bounded on-disk LRU cache and serves it with
+far-future, immutable cache headers.
+
+The signature is an HMAC of (size, src) under SECRET_KEY, so the proxy only
+serves images the app itself linked to -- it's not an open proxy. Even so,
+`src` comes from user-entered image URLs, so only http(s) URLs whose host
+resolves to public addresses are fetched, and each redirect is checked the
+same way: a signed URL can't reach the cloud metadata service, localhost or
+the internal network.
+
+Configuration (read from the current app):
+
+- IMAGE_PROXY_ENABLED: default True; if False templates link originals.
+- IMAGE_CACHE_DIR: default <instance path>/image-cache.
+- IMAGE_CACHE_MAX_BYTES: default 512 MB.
+- IMAGE_FETCH_TIMEOUT: seconds, default 10.
+- IMAGE_MAX_SOURCE_BYTES: largest original fetched, default 20 MB.
+- IMAGE_MAX_REDIRECTS: redirects followed per fetch, default 3.
+- IMAGE_FAILURE_TTL: seconds a source that failed to load is answered with
+  a 404 instead of being fetched again, default 60.
+- IMAGE_ALLOW_PRIVATE_HOSTS: default False; True lets the proxy fetch from
+  loopback, private and link-local addresses (for tests and development).
+- IMAGE_RESIZE_EXECUTOR: "process" (default) or "thread".
+- IMAGE_RESIZE_WORKERS: pool size (default: number of CPUs).
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+
+from forking import reset_after_fork
+
+# name -> (width, height, crop to fill); sized for 2x screens
+SIZES = {
+    "card": (600, 320, True),
+    "avatar": (240, 240, True),
+    "large": (1200, 1200, False),
+}
+JPEG_QUALITY = 82
+# sources remembered as failing, per process
+MAX_FAILURES = 10_000
+
+
+class ImageError(Exception):
+    """The original image couldn't be fetched or decoded."""
+
+
+class ImageUnavailable(ImageError):
+    """The original failed to load recently, so it isn't tried again yet."""
+
+
+def sign(size, src):
+    key = current_app.config["SECRET_KEY"].encode("utf-8")
+    msg = f"{size}\n{src}".encode("utf-8")
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()[:32]
+
+
+def thumbnail_url(src, size):
+    """URL of `src` resized to `size`, or `src` itself if not proxied.
+
+    Local paths (our own static files) and empty values aren't proxied.
+    """
+
+    if (
+        not src
+        or not src.startswith(("http://", "https://"))
+        or not current_app.config.get("IMAGE_PROXY_ENABLED", True)
+    ):
+        return src
+    return url_for("images.thumbnail", size=size, signature=sign(size, src), src=src)
+
+
+def is_public_address(address):
+    """Is `address` (an IP address string) on the public internet?"""
+
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def resize(data, width, height, crop):
+    """Return JPEG (or PNG, if it has transparency) bytes of a resized image.
+
+    Runs in a worker process, so it only takes and returns bytes.
+    """
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        # let the JPEG decoder downscale while decoding
+        img.draft("RGB", (width, height))
+        img = ImageOps.exif_transpose(img)
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise ImageError(str(exc))
+
+    if crop:
+        img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+    else:
+        img.thumbnail((width, height), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img.save(out, "PNG", optimize=True)
+    else:
+        img.convert("RGB").save(
+            out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True
+        )
+    return out.getvalue()
+
+
+def mimetype_of(path):
+    with open(path, "rb") as f:
+        return "image/png" if f.read(4) == b"\x89PNG" else "image/jpeg"
+
+
+class DiskCache:
+    """Files in a directory, least recently used removed past `max_bytes`.
+
+    Reads touch a file's mtime, so mtime order is LRU order. Several
+    processes can share the directory: writes are atomic renames and
+    eviction works from what's actually on disk.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _entries(self):
+        with os.scandir(self.directory) as it:
+            return [
+                entry
+                for entry in it
+                if entry.is_file() and not entry.name.startswith(".")
+            ]
+
+    def get(self, key):
+        """Return the path of `key`'s file, or None."""
+
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(e.stat().st_size for e in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+        return self._path(key)
+
+    def _evict(self):
+        entries = sorted(
+            ((e.stat().st_mtime, e.stat().st_size, e.path) for e in self._entries()),
+        )
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+
+class ImageProxy:
+    """Fetches, resizes and caches images for one app."""
+
+    def __init__(self, app):
+        config = app.config
+        self.cache = DiskCache(
+            config.get("IMAGE_CACHE_DIR")
+            or os.path.join(app.instance_path, "image-cache"),
+            config.get("IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024),
+        )
+        self.timeout = config.get("IMAGE_FETCH_TIMEOUT", 10)
+        self.max_source_bytes = config.get("IMAGE_MAX_SOURCE_BYTES", 20 * 1024 * 1024)
+        self.max_redirects = config.get("IMAGE_MAX_REDIRECTS", 3)
+        self.allow_private_hosts = config.get("IMAGE_ALLOW_PRIVATE_HOSTS", False)
+        self.executor = config.get("IMAGE_RESIZE_EXECUTOR", "process")
+        self.workers = config.get("IMAGE_RESIZE_WORKERS", os.cpu_count() or 1)
+        self.failure_ttl = config.get("IMAGE_FAILURE_TTL", 60)
+
+        # src -> monotonic time to try it again at, oldest first
+        self._failures = OrderedDict()
+        self._forget_pool()
+        reset_after_fork(self, ImageProxy._forget_pool)
+
+    def _forget_pool(self):
+        self._pool = None
+        self._lock = Lock()
+        self._inflight = {}
+
+    def _submit(self, fn, *args):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    pool_class = (
+                        ProcessPoolExecutor
+                        if self.executor == "process"
+                        else ThreadPoolExecutor
+                    )
+                    self._pool = pool_class(max_workers=self.workers)
+        return self._pool.submit(fn, *args).result()
+
+    def check_url(self, url):
+        """Raise ImageError unless `url` is http(s) on a public host."""
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ImageError(f"{url} is not an http(s) URL")
+        if self.allow_private_hosts:
+            return
+
+        try:
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            addresses = socket.getaddrinfo(
+                parts.hostname, port, proto=socket.IPPROTO_TCP
+            )
+        except (OSError, UnicodeError, ValueError) as exc:
+            raise ImageError(f"can't resolve {url}: {exc}")
+        for *_, sockaddr in addresses:
+            if not is_public_address(sockaddr[0]):
+                raise ImageError(f"{url} is not on a public address")
+
+    def fetch(self, src):
+        """Download `src`, refusing non-images and oversized files.
+
+        Redirects are followed by hand, up to `max_redirects`, so that each
+        hop's URL goes through `check_url`.
+        """
+
+        url = src
+        try:
+            for _ in range(self.max_redirects + 1):
+                self.check_url(url)
+                resp = requests.get(
+                    url,
+                    timeout=self.timeout,
+                    stream=True,
+                    allow_redirects=False,
+                    headers={"User-Agent": "flask-cafe image proxy"},
+                )
+                if not resp.is_redirect:
+                    break
+                resp.close()
+                url = urljoin(url, resp.headers["Location"])
+            else:
+                raise ImageError(f"{src} redirects too many times")
+
+            with resp:
+                resp.raise_for_status()
+                if not resp.headers.get("Content-Type", "").startswith("image/"):
+                    raise ImageError(f"{src} is not an image")
+
+                data = bytearray()
+                for chunk in resp.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > self.max_source_bytes:
+                        raise ImageError(f"{src} is too large")
+        except requests.RequestException as exc:
+            raise ImageError(str(exc))
+        return bytes(data)
+
+    def _check_failed(self, src):
+        with self._lock:
+            retry_at = self._failures.get(src)
+            if retry_at is None:
+                return
+            if time.monotonic() >= retry_at:
+                del self._failures[src]
+                return
+        raise ImageUnavailable(f"{src} failed to load recently")
+
+    def _failed(self, src):
+        with self._lock:
+            self._failures.pop(src, None)
+            self._failures[src] = time.monotonic() + self.failure_ttl
+            while len(self._failures) > MAX_FAILURES:
+                self._failures.popitem(last=False)
+
+    def get(self, size, src):
+        """Return the path of `src` resized to `size`, making it if needed.
+
+        Concurrent requests for the same thumbnail wait for one fetch and
+        resize rather than each doing their own. A source that fails raises
+        ImageUnavailable for `failure_ttl` seconds after, without another
+        fetch, so a broken or slow image URL costs one timeout a minute
+        rather than one per page view.
+        """
+
+        key = hashlib.sha256(f"{size}\n{src}".encode("utf-8")).hexdigest()
+        path = self.cache.get(key)
+        if path:
+            return path
+        self._check_failed(src)
+
+        with self._lock:
+            key_lock = self._inflight.setdefault(key, Lock())
+
+        with key_lock:
+            try:
+                path = self.cache.get(key)
+                if path:
+                    return path
+                # the fetch we waited for may have just failed
+                self._check_failed(src)
+
+                width, height, crop = SIZES[size]
+                try:
+                    data = self._submit(resize, self.fetch(src), width, height, crop)
+                except ImageError:
+                    self._failed(src)
+                    raise
+                return self.cache.put(key, data)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+_proxies_lock = Lock()
+
+
+def get_proxy():
+    """Return the current app's ImageProxy."""
+
+    app = current_app._get_current_object()
+    if "image_proxy" not in app.extensions:
+        with _proxies_lock:
+            if "image_proxy" not in app.extensions:
+                app.extensions["image_proxy"] = ImageProxy(app)
+    return app.extensions["image_proxy"]
@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, flash, redirect, g
 
 # from generic_views import ListView, DetailView
-from models import User, db
+from models import db
 
 from user.forms import ProfileEditForm
 from decorators import login_required
@@ -14,8 +14,7 @@ users = Blueprint("users", __name__)
 def show_profile():
     """Show profile page."""
 
-    user = User.query.get(g.user.id)
-    return render_template("profile/detail.html", user=user)
+    return render_template("profile/detail.html", user=g.user)
 
 
 @users.route("/profile/edit", methods=["POST", "GET"])
@@ -23,7 +22,7 @@ def show_profile():
 def edit_profile():
     """Edit profile page."""
 
-    user = User.query.get(g.user.id)
+    user = g.user
     form = ProfileEditForm(obj=user)
 
     if form.validate_on_submit():
@@ -33,4 +32,3 @@ def edit_profile():
         return redirect("/profile")
     else:
         return render_template("profile/edit-form.html", form=form, user=user)
-
@@ -0,0 +1,15 @@
+"""WSGI entry point for Flask Cafe.
+
+    gunicorn --preload --workers 4 wsgi:app
+
+The profile comes from FLASK_CONFIG (default "prod"). The prod profile
+needs FLASK_SECRET_KEY set, and expects one reverse proxy in front of
+gunicorn; set TRUSTED_PROXIES to the number there really are (0 if clients
+connect directly).
+"""
+
+import os
+
+from app import create_app
+
+app = create_app(os.environ.get("FLASK_CONFIG", "prod"))